@@ -33,7 +33,10 @@ Options:
     --fixed_flux               Fixed flux thermal BCs
     --dynamic_diffusivities    If flagged, use equations formulated in terms of dynamic diffusivities (μ,κ)
 
-    --rk222                    Use RK222 as timestepper
+    --rk222                    Use RK222 as timestepper (same as --timestepper=RK222)
+    --timestepper=<ts>         Timestepper (e.g. RK443, RK222, SBDF2, SBDF3, CNAB2), or auto to benchmark [default: RK443]
+    --benchmark_file=<file>    Timestepper benchmark record for --timestepper=auto [default: timestepper_benchmarks.json]
+    --safety_factor=<safety>   Determines CFL Danger.  Higher=Faster [default: 0.2]
 
     --superstep                Superstep equations by using average rather than actual vertical grid spacing
     --dense                    Oversample matching region with extra chebyshev domain
@@ -49,6 +52,10 @@ Options:
     --no_join                  If flagged, skip join operation at end of run
 
     --verbose                  Produce diagnostic plots
+    --report_cadence=<n>       Iterations between flow property reports [default: 1]
+    --detailed_telemetry       Also time transforms, transposes and pencil solves in telemetry.h5
+    --rollback_cadence=<n>     Iterations between in-memory snapshots for blow-up recovery (0 to disable) [default: 100]
+    --adaptive_safety          Adapt the CFL safety factor to the stability of the run
 
     --init_file=<init_file>    The equilibrated, low Ra run from which the bootstrap process begins
     --ra_end=<ra_end>          Ending Rayleigh number [default: 1e6]
@@ -70,7 +77,8 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=3, m_rz=3, gamma=5/3,
                   nx = None,
                   width=None,
                   single_chebyshev=False,
-                  rk222=False,
+                  rk222=False, safety_factor=0.2,
+                  timestepper='RK443', benchmark_file='timestepper_benchmarks.json',
                   superstep=False,
                   dense=False, nz_dense=64,
                   oz=False,
@@ -78,7 +86,9 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=3, m_rz=3, gamma=5/3,
                   run_time=23.5, run_time_buoyancies=np.inf, run_time_iter=np.inf,
                   dynamic_diffusivities=False,
                   max_writes=20,out_cadence=0.1, no_coeffs=False, no_join=False,
-                  restart=None, data_dir='./', verbose=False, label=None):
+                  restart=None, data_dir='./', verbose=False, label=None,
+                  report_cadence=1, detailed_telemetry=False, rollback_cadence=100,
+                  adaptive_safety=False):
     
     def format_number(number, no_format_min=0.1, no_format_max=10):
         if number > no_format_max or number < no_format_min:
@@ -130,15 +140,20 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=3, m_rz=3, gamma=5/3,
     logger.info("saving run in: {}".format(data_dir))
     
     import dedalus.public as de
-    from dedalus.tools  import post
-    from dedalus.extras import flow_tools
 
 
     from dedalus.core.future import FutureField
     from stratified_dynamics import multitropes
     from tools.checkpointing import Checkpoint
+    from tools.diagnostics import FlowDiagnostics
+    from tools.run_controller import RunController
+    from tools.rollback import Rollback
+    from tools import timestepper_benchmark
+    from tools import cfl
 
     checkpoint_min = 30
+    checkpoint_keep = 5
+    checkpoint_milestone_buoyancies = 100
         
     initial_time = time.time()
 
@@ -153,10 +168,8 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=3, m_rz=3, gamma=5/3,
         nx = nz_cz*4
         
     if single_chebyshev:
-        nz = nz_cz
         nz_list = [nz_cz]
     else:
-        nz = nz_rz+nz_cz
         nz_list = [nz_rz, nz_cz]
     
     eqns_dict = {'stiffness' : stiffness,
@@ -186,13 +199,9 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=3, m_rz=3, gamma=5/3,
             os.mkdir('{:s}/'.format(data_dir))
 
     if rk222:
-        logger.info("timestepping using RK222")
-        ts = de.timesteppers.RK222
-        cfl_safety_factor = 0.2*2
-    else:
-        logger.info("timestepping using RK443")
-        ts = de.timesteppers.RK443
-        cfl_safety_factor = 0.2*4
+        timestepper = 'RK222'
+    initial_timestepper = 'RK443' if timestepper == 'auto' else timestepper
+    ts = getattr(de.timesteppers, initial_timestepper)
 
     # Build solver
     solver = problem.build_solver(ts)
@@ -212,7 +221,20 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=3, m_rz=3, gamma=5/3,
         logger.info("restarting from {}".format(restart))
         dt = checkpoint.restart(restart, solver)
         
-    checkpoint.set_checkpoint(solver, wall_dt=checkpoint_min*60, mode=mode)
+    if timestepper == 'auto':
+        velocities = [('u', 'w')]
+        if MHD:
+            velocities.append(('Bx/sqrt(4*pi*rho_full)', 'Bz/sqrt(4*pi*rho_full)'))
+        timestepper = timestepper_benchmark.select(problem, atmosphere, solver, safety_factor,
+                                                   atmosphere.buoyancy_time*out_cadence, velocities,
+                                                   filename=benchmark_file)
+        if timestepper != initial_timestepper:
+            solver = timestepper_benchmark.rebuild(problem, solver, timestepper)
+    logger.info("timestepping using {}".format(timestepper))
+    cfl_safety_factor = safety_factor*timestepper_benchmark.SAFETY_SCALE[timestepper]
+
+    checkpoint.set_checkpoint(solver, wall_dt=checkpoint_min*60, mode=mode, keep=checkpoint_keep,
+                              milestone_sim_dt=checkpoint_milestone_buoyancies*atmosphere.buoyancy_time)
         
     logger.info("thermal_time = {:g}, top_thermal_time = {:g}".format(atmosphere.thermal_time, atmosphere.top_thermal_time))
     
@@ -220,7 +242,6 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=3, m_rz=3, gamma=5/3,
     max_dt = atmosphere.buoyancy_time*out_cadence
     if dt is None: dt = max_dt
     
-    report_cadence = 1
     output_time_cadence = out_cadence*atmosphere.buoyancy_time
     solver.stop_sim_time  = solver.sim_time + run_time_buoyancies*atmosphere.buoyancy_time
     solver.stop_iteration = solver.iteration + run_time_iter
@@ -232,91 +253,39 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=3, m_rz=3, gamma=5/3,
 
     
     cfl_cadence = 1
-    CFL = flow_tools.CFL(solver, initial_dt=dt, cadence=cfl_cadence, safety=cfl_safety_factor,
-                         max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1)
+    CFL = cfl.CFL(solver, initial_dt=dt, cadence=cfl_cadence, safety=cfl_safety_factor,
+                  max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1)
 
     CFL.add_velocities(('u', 'w'))
     if MHD:
         CFL.add_velocities(('Bx/sqrt(4*pi*rho_full)', 'Bz/sqrt(4*pi*rho_full)'))
         
     # Flow properties
-    flow = flow_tools.GlobalFlowProperty(solver, cadence=1)
+    flow = FlowDiagnostics(solver, CFL, cadence=report_cadence)
     flow.add_property("Re_rms", name='Re')
+    if adaptive_safety:
+        flow.add_property("KE", name='KE')
     if MHD:
         flow.add_property("abs(dx(Bx) + dz(Bz))", name='divB')
         
-    try:
-        start_time = time.time()
-        while solver.ok:
-
-            dt = CFL.compute_dt()
-            # advance
-            solver.step(dt)
-
-            # update lists
-            if solver.iteration % report_cadence == 0:
-                Re_avg = flow.grid_average('Re')
-                if not np.isfinite(Re_avg):
-                    solver.ok = False
-                log_string = 'Iteration: {:5d}, Time: {:8.3e} ({:8.3e}), dt: {:8.3e}, '.format(solver.iteration, solver.sim_time, solver.sim_time/atmosphere.buoyancy_time, dt)
-                log_string += 'Re: {:8.3e}/{:8.3e}'.format(Re_avg, flow.max('Re'))
-                if MHD:
-                     log_string += ', divB: {:8.3e}/{:8.3e}'.format(flow.grid_average('divB'), flow.max('divB'))
-
-                logger.info(log_string)
-    except:
-        logger.error('Exception raised, triggering end of main loop.')
-        raise
-    finally:
-        end_time = time.time()
-
-        # Print statistics
-        elapsed_time = end_time - start_time
-        elapsed_sim_time = solver.sim_time
-        N_iterations = solver.iteration 
-        logger.info('main loop time: {:e}'.format(elapsed_time))
-        logger.info('Iterations: {:d}'.format(N_iterations))
-        logger.info('iter/sec: {:g}'.format(N_iterations/(elapsed_time)))
-        logger.info('Average timestep: {:e}'.format(elapsed_sim_time / N_iterations))
-
-        if not no_join:
-            logger.info('beginning join operation')
-            logger.info(data_dir+'/checkpoint/')
-            post.merge_process_files(data_dir+'/checkpoint/', cleanup=False)
-
-            for task in analysis_tasks:
-                logger.info(analysis_tasks[task].base_path)
-                post.merge_process_files(analysis_tasks[task].base_path, cleanup=False)
-
-        if (atmosphere.domain.distributor.rank==0):
-
-            logger.info('main loop time: {:e}'.format(elapsed_time))
-            logger.info('Iterations: {:d}'.format(N_iterations))
-            logger.info('iter/sec: {:g}'.format(N_iterations/(elapsed_time)))
-            logger.info('Average timestep: {:e}'.format(elapsed_sim_time / N_iterations))
- 
-            N_TOTAL_CPU = atmosphere.domain.distributor.comm_cart.size
-
-            # Print statistics
-            print('-' * 40)
-            total_time = end_time-initial_time
-            main_loop_time = end_time - start_time
-            startup_time = start_time-initial_time
-            n_steps = solver.iteration-1
-            print('  startup time:', startup_time)
-            print('main loop time:', main_loop_time)
-            print('    total time:', total_time)
-            print('Iterations:', solver.iteration)
-            print('Average timestep:', solver.sim_time / n_steps)
-            print("          N_cores, Nx, Nz, startup     main loop,   main loop/iter, main loop/iter/grid, n_cores*main loop/iter/grid")
-            print('scaling:',
-                  ' {:d} {:d} {:d}'.format(N_TOTAL_CPU,nx,nz),
-                  ' {:8.3g} {:8.3g} {:8.3g} {:8.3g} {:8.3g}'.format(startup_time,
-                                                                    main_loop_time, 
-                                                                    main_loop_time/n_steps, 
-                                                                    main_loop_time/n_steps/(nx*nz), 
-                                                                    N_TOTAL_CPU*main_loop_time/n_steps/(nx*nz)))
-            print('-' * 40)
+    def report(controller, dt):
+        log_string = 'Iteration: {:5d}, Time: {:8.3e} ({:8.3e}), dt: {:8.3e}, '.format(solver.iteration, solver.sim_time, solver.sim_time/atmosphere.buoyancy_time, dt)
+        log_string += 'Re: {:8.3e}/{:8.3e}'.format(flow.grid_average('Re'), flow.max('Re'))
+        if MHD:
+             log_string += ', divB: {:8.3e}/{:8.3e}'.format(flow.grid_average('divB'), flow.max('divB'))
+        return log_string
+
+    rollback = None
+    if rollback_cadence > 0 and timestepper.startswith('RK'):
+        rollback = Rollback(solver, flow, cadence=rollback_cadence)
+    safety = None
+    if adaptive_safety:
+        safety = cfl.SafetyController(flow, rollback=rollback)
+
+    controller = RunController(solver, atmosphere, flow, data_dir, checkpoint=checkpoint,
+                               analysis_tasks=analysis_tasks, initial_time=initial_time,
+                               detailed_telemetry=detailed_telemetry, rollback=rollback, safety=safety)
+    controller.run(report=report, final_checkpoint=not(no_join), join=not(no_join))
 
 if __name__ == "__main__":
     from bootstrap import bootstrap
@@ -372,12 +341,19 @@ if __name__ == "__main__":
               "dense":args['--dense'],
               "nz_dense":int(args['--nz_dense']),
               "rk222":args['--rk222'],
+              "timestepper":args['--timestepper'],
+              "benchmark_file":args['--benchmark_file'],
+              "safety_factor":float(args['--safety_factor']),
               "max_writes":int(float(args['--writes'])),
               "superstep":args['--superstep'],
               "run_time":float(args['--run_time']),
               "run_time_buoyancies":run_time_buoy,
               "run_time_iter":run_time_iter,
-              "label":args['--label']}
+              "label":args['--label'],
+              "report_cadence":int(args['--report_cadence']),
+              "detailed_telemetry":args['--detailed_telemetry'],
+              "rollback_cadence":int(args['--rollback_cadence']),
+              "adaptive_safety":args['--adaptive_safety']}
     
     if args['bootstrap']:
         logger.info("Bootstrapping...")
@@ -0,0 +1,198 @@
+"""
+Dedalus script for running an ensemble of FC_poly and FC_multi runs
+concurrently in one MPI job.
+
+COMM_WORLD is split into one group of processes per run, sized in
+proportion to the predicted cost of the run, and each group runs its own
+parameter set with its own output directory, so that one allocation serves
+a whole parameter sweep.
+
+The ensemble file is a JSON list of runs, each a dictionary with
+    "script"     "FC_poly" or "FC_multi"
+    "kwargs"     keyword arguments of FC_poly.FC_polytrope or
+                 FC_multi.FC_convection (optional)
+    "label"      name of the run, used in its output directory (optional)
+    "cost"       relative cost of the run, instead of the prediction (optional)
+    "processes"  number of processes of the run, instead of balancing (optional)
+e.g.
+    [{"script": "FC_multi", "kwargs": {"nz_cz": 256, "stiffness": 1e2}, "label": "S1e2"},
+     {"script": "FC_multi", "kwargs": {"nz_cz": 256, "stiffness": 1e3}, "label": "S1e3"}]
+
+The predicted cost of a run is N log N, for N grid points, and a group is
+never larger than the run can use (nx/2 or nz processes, or the product of
+a 3D run's mesh).
+
+Usage:
+    FC_ensemble.py <ensemble_file> [options]
+
+Options:
+    --root_dir=<root_dir>      Root directory to save data dirs in [default: ./]
+    --run_time=<run_time>      Run time of each run, in hours, unless set in its kwargs [default: 23.5]
+    --dry_run                  Log the process groups and stop
+    --processes=<n>            Number of processes to plan for with --dry_run (default: size of COMM_WORLD)
+"""
+import os
+import json
+import time
+import inspect
+import traceback
+
+import numpy as np
+from mpi4py import MPI
+
+import FC_poly
+import FC_multi
+
+import logging
+logger = logging.getLogger(__name__.split('.')[-1])
+
+SCRIPTS = {'FC_poly':  FC_poly.FC_polytrope,
+           'FC_multi': FC_multi.FC_convection}
+
+def run_parameters(run):
+    """Keyword arguments of a run, with the defaults of its script filled in."""
+    function = SCRIPTS[run['script']]
+    parameters = {name: parameter.default for name, parameter in inspect.signature(function).parameters.items()}
+    parameters.update(run.get('kwargs', {}))
+    return parameters
+
+def resolution(run):
+    """Grid size (nx, ny, nz) of a run; ny is 1 in 2D."""
+    p = run_parameters(run)
+    if run['script'] == 'FC_poly':
+        nz = p['nz']
+        nx = p['nx'] if p['nx'] is not None else int(np.round(nz*p['aspect_ratio']))
+        ny = 1
+        if p['threeD']:
+            ny = p['ny'] if p['ny'] is not None else nx
+    else:
+        if p['single_chebyshev']:
+            nz = p['nz_cz']
+        else:
+            nz = p['nz_rz'] + p['nz_cz'] + (p['nz_dense'] if p['dense'] else 0)
+        nx = p['nx'] if p['nx'] is not None else 4*p['nz_cz']
+        ny = 1
+    return nx, ny, nz
+
+def predicted_cost(run):
+    """Relative cost of a run per iteration: N log N for N grid points."""
+    if 'cost' in run:
+        return float(run['cost'])
+    n_points = np.prod(resolution(run))
+    return n_points*np.log2(n_points)
+
+def max_processes(run):
+    """Largest number of processes a run can use."""
+    if 'processes' in run:
+        return int(run['processes'])
+    mesh = run_parameters(run).get('mesh')
+    if mesh is not None:
+        return int(np.prod(mesh))
+    nx, ny, nz = resolution(run)
+    return max(1, min(nx//2, nz))
+
+def balance(costs, caps, size, fixed=None):
+    """
+    Processes per run, minimizing the largest cost per process.
+
+    Each run gets at least one process and no more than its cap; runs with a
+    fixed number of processes get exactly that.  Processes left over once
+    every run is at its cap are not assigned.
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    caps = np.asarray(caps, dtype=int)
+    if fixed is None:
+        fixed = np.zeros(len(costs), dtype=bool)
+    sizes = np.where(fixed, caps, 1)
+    if np.sum(sizes) > size:
+        raise ValueError("ensemble needs at least {:d} processes, but has {:d}".format(np.sum(sizes), size))
+    for i in range(size - np.sum(sizes)):
+        load = costs/sizes
+        load[fixed | (sizes >= caps)] = -np.inf
+        if not np.isfinite(np.max(load)):
+            break
+        sizes[np.argmax(load)] += 1
+    return sizes
+
+def run_member(run, comm, root_dir, run_time):
+    """Run one member of the ensemble on comm; returns its data directory."""
+    kwargs = dict(run.get('kwargs', {}))
+    kwargs.setdefault('run_time', run_time)
+    if run['script'] == 'FC_poly':
+        kwargs.setdefault('data_dir', os.path.join(root_dir, 'FC_poly_{}/'.format(run['label'])))
+        FC_poly.FC_polytrope(comm=comm, **kwargs)
+        return kwargs['data_dir']
+    else:
+        kwargs.setdefault('data_dir', root_dir)
+        kwargs.setdefault('label', run['label'])
+        return FC_multi.FC_convection(comm=comm, **kwargs)
+
+def FC_ensemble(runs, root_dir='./', run_time=23.5, dry_run=False, processes=None):
+    world = MPI.COMM_WORLD
+    if processes is None or not dry_run:
+        processes = world.size
+    for i, run in enumerate(runs):
+        if run['script'] not in SCRIPTS:
+            raise ValueError("unknown script {} (not one of {})".format(run['script'], ', '.join(SCRIPTS)))
+        run.setdefault('label', '{:d}'.format(i))
+
+    costs = [predicted_cost(run) for run in runs]
+    caps = [max_processes(run) for run in runs]
+    fixed = np.array(['processes' in run or run_parameters(run).get('mesh') is not None for run in runs])
+    sizes = balance(costs, caps, processes, fixed=fixed)
+    if world.rank == 0:
+        logger.info("ensemble of {:d} runs on {:d} processes".format(len(runs), processes))
+        mean_load = np.sum(costs)/np.sum(sizes)
+        for run, cost, size in zip(runs, costs, sizes):
+            logger.info("  {:>8s} {:>10s}: {:4d} processes, resolution {}, cost per process {:.3g} times the mean".format(
+                        run['script'], run['label'], size, resolution(run), cost/size/mean_load))
+        if np.sum(sizes) < processes:
+            logger.warning("{:d} processes are not used by any run".format(processes - np.sum(sizes)))
+    if dry_run:
+        return
+
+    colors = np.repeat(np.arange(len(runs)), sizes)
+    color = int(colors[world.rank]) if world.rank < len(colors) else MPI.UNDEFINED
+    comm = world.Split(color, world.rank)
+
+    result = None
+    if color != MPI.UNDEFINED:
+        run = runs[color]
+        if comm.rank == 0:
+            # dedalus only logs INFO on world rank 0; let each run's root process log too
+            logging.root.setLevel(0)
+        start_time = time.time()
+        try:
+            data_dir = run_member(run, comm, root_dir, run_time)
+            status = 'finished'
+        except Exception:
+            logger.error("run {} failed:\n{}".format(run['label'], traceback.format_exc()))
+            data_dir, status = None, 'failed'
+        if comm.rank == 0:
+            result = (run['label'], status, time.time()-start_time, data_dir)
+        comm.Free()
+
+    results = world.gather(result, root=0)
+    if world.rank == 0:
+        logger.info("ensemble complete:")
+        for label, status, elapsed, data_dir in (result for result in results if result is not None):
+            logger.info("  {:>10s}: {} after {:.1f} sec, in {}".format(label, status, elapsed, data_dir))
+
+if __name__ == "__main__":
+    from docopt import docopt
+    args = docopt(__doc__)
+
+    # dedalus sets up logging from its config when the drivers import it, so
+    # set it first, logging to one directory for the ensemble
+    from dedalus.tools.config import config
+    config['logging']['filename'] = os.path.join(args['--root_dir'], 'ensemble_logs/dedalus_log')
+    config['logging']['file_level'] = 'DEBUG'
+
+    with open(args['<ensemble_file>']) as ensemble_file:
+        runs = json.load(ensemble_file)
+
+    FC_ensemble(runs,
+                root_dir=args['--root_dir'],
+                run_time=float(args['--run_time']),
+                dry_run=args['--dry_run'],
+                processes=int(args['--processes']) if args['--processes'] else None)
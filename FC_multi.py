@@ -29,9 +29,13 @@ Options:
     --fixed_flux               Fixed flux thermal BCs
     --dynamic_diffusivities    If flagged, use equations formulated in terms of dynamic diffusivities (μ,κ)
 
-    --rk222                    Use RK222 as timestepper
+    --rk222                    Use RK222 as timestepper (same as --timestepper=RK222)
+    --timestepper=<ts>         Timestepper (e.g. RK443, RK222, SBDF2, SBDF3, CNAB2), or auto to benchmark [default: RK443]
+    --benchmark_file=<file>    Timestepper benchmark record for --timestepper=auto [default: timestepper_benchmarks.json]
+    --safety_factor=<safety>   Determines CFL Danger.  Higher=Faster [default: 0.2]
 
-    --superstep                Superstep equations by using average rather than actual vertical grid spacing
+    --superstep                Superstep equations by using the mean rather than actual vertical grid spacing of each z domain in the CFL
+    --cfl_exclude_rz           Ignore vertical velocities in the stable (radiative) zone in the CFL
     --dense                    Oversample matching region with extra chebyshev domain
     --nz_dense=<nz_dense>      Vertical z (chebyshev) resolution in oversampling region   [default: 64]
    
@@ -45,8 +49,15 @@ Options:
     --writes=<writes>          Writes per file [default: 20]
     --no_coeffs                If flagged, coeffs will not be output
     --no_join                  If flagged, skip join operation at end of run
+    --async_checkpoint         Write checkpoints on a background thread while timestepping continues
+    --storage=<storage>        HDF5 storage options by output (JSON file or string), e.g. {"coeffs": {"compression": "gzip", "shuffle": true}}
+    --crop_coeffs=<modes>      Store only the lowest modes in coeffs output, e.g. 64,96 for x,z
 
     --verbose                  Produce diagnostic plots
+    --report_cadence=<n>       Iterations between flow property reports [default: 1]
+    --detailed_telemetry       Also time transforms, transposes and pencil solves in telemetry.h5
+    --rollback_cadence=<n>     Iterations between in-memory snapshots for blow-up recovery (0 to disable) [default: 100]
+    --adaptive_safety          Adapt the CFL safety factor to the stability of the run
 
     --init_file=<init_file>    The equilibrated, low Ra run from which the bootstrap process begins
     --ra_end=<ra_end>          Ending Rayleigh number [default: 1e6]
@@ -67,15 +78,18 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=1e4, m_rz=3, gamma=5/3,
                       nx = None,
                       width=None,
                       single_chebyshev=False,
-                      rk222=False,
-                      superstep=False,
+                      rk222=False, safety_factor=0.2,
+                      timestepper='RK443', benchmark_file='timestepper_benchmarks.json',
+                      superstep=False, cfl_exclude_rz=False,
                       dense=False, nz_dense=64,
                       oz=False,
                       fixed_flux=False,
                       run_time=23.5, run_time_buoyancies=np.inf, run_time_iter=np.inf,
                       dynamic_diffusivities=False,
                       max_writes=20,out_cadence=0.1, no_coeffs=False, no_join=False,
-                      restart=None, data_dir='./', verbose=False, label=None):
+                      restart=None, data_dir='./', verbose=False, label=None,
+                      report_cadence=1, detailed_telemetry=False, rollback_cadence=100,
+                      adaptive_safety=False, async_checkpoint=False, storage=None, crop_coeffs=None, comm=None):
 
     def format_number(number, no_format_min=0.1, no_format_max=10):
         if number > no_format_max or number < no_format_min:
@@ -120,7 +134,9 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=1e4, m_rz=3, gamma=5/3,
     config['logging']['file_level'] = 'DEBUG'
 
     import mpi4py.MPI
-    if mpi4py.MPI.COMM_WORLD.rank == 0:
+    if comm is None:
+        comm = mpi4py.MPI.COMM_WORLD
+    if comm.rank == 0:
         if not os.path.exists('{:s}/'.format(data_dir)):
             os.makedirs('{:s}/'.format(data_dir))
         logdir = os.path.join(data_dir,'logs')
@@ -130,17 +146,25 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=1e4, m_rz=3, gamma=5/3,
     logger.info("saving run in: {}".format(data_dir))
     
     import dedalus.public as de
-    from dedalus.tools  import post
-    from dedalus.extras import flow_tools
 
 
-    from dedalus.core.future import FutureField
     from stratified_dynamics import multitropes
     from tools.checkpointing import Checkpoint
+    from tools.diagnostics import FlowDiagnostics
+    from tools.run_controller import RunController, plot_sparsity_patterns
+    from tools.rollback import Rollback
+    from tools import timestepper_benchmark
+    from tools import cfl
+    from tools.output import read_storage, read_crop
     
     checkpoint_min = 30
+    checkpoint_keep = 5
+    checkpoint_milestone_buoyancies = 100
     
     initial_time = time.time()
+    storage = read_storage(storage)
+    if crop_coeffs is not None:
+        storage = dict(storage, coeffs=dict(storage.get('coeffs', {}), crop=read_crop(crop_coeffs, ('x', 'z'))))
 
     logger.info("Starting Dedalus script {:s}".format(sys.argv[0]))
 
@@ -158,15 +182,12 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=1e4, m_rz=3, gamma=5/3,
         nx = nz_cz*4
         
     if single_chebyshev:
-        nz = nz_cz
         nz_list = [nz_cz]
     else:
         if dense:
-            nz = nz_rz+nz_dense+nz_cz
             #nz_list = [nz_rz, int(nz_dense/2), int(nz_dense/2), nz_cz]
             nz_list = [nz_rz, nz_dense, nz_cz]
         else:
-            nz = nz_rz+nz_cz
             nz_list = [nz_rz, nz_cz]
     
     if dynamic_diffusivities:
@@ -174,13 +195,13 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=1e4, m_rz=3, gamma=5/3,
                                          n_rho_cz=n_rho_cz, n_rho_rz=n_rho_rz, 
                                          verbose=verbose, width=width,
                                          constant_Prandtl=constant_Prandtl,
-                                         stable_top=stable_top)
+                                         stable_top=stable_top, comm=comm)
     else:
         atmosphere = multitropes.FC_multitrope(nx=nx, nz=nz_list, stiffness=stiffness, m_rz=m_rz, gamma=gamma,
                                          n_rho_cz=n_rho_cz, n_rho_rz=n_rho_rz, 
                                          verbose=verbose, width=width,
                                          constant_Prandtl=constant_Prandtl,
-                                         stable_top=stable_top)
+                                         stable_top=stable_top, comm=comm)
     
     atmosphere.set_IVP_problem(Rayleigh, Prandtl)
         
@@ -193,13 +214,9 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=1e4, m_rz=3, gamma=5/3,
             os.makedirs('{:s}/'.format(data_dir))
 
     if rk222:
-        logger.info("timestepping using RK222")
-        ts = de.timesteppers.RK222
-        cfl_safety_factor = 0.2*2
-    else:
-        logger.info("timestepping using RK443")
-        ts = de.timesteppers.RK443
-        cfl_safety_factor = 0.2*4
+        timestepper = 'RK222'
+    initial_timestepper = 'RK443' if timestepper == 'auto' else timestepper
+    ts = getattr(de.timesteppers, initial_timestepper)
 
     # Build solver
     solver = problem.build_solver(ts)
@@ -220,7 +237,18 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=1e4, m_rz=3, gamma=5/3,
         logger.info("restarting from {}".format(restart))
         dt = checkpoint.restart(restart, solver)
         
-    checkpoint.set_checkpoint(solver, wall_dt=checkpoint_min*60, mode=mode)
+    if timestepper == 'auto':
+        timestepper = timestepper_benchmark.select(problem, atmosphere, solver, safety_factor,
+                                                   atmosphere.buoyancy_time*out_cadence, [('u', 'w')],
+                                                   filename=benchmark_file)
+        if timestepper != initial_timestepper:
+            solver = timestepper_benchmark.rebuild(problem, solver, timestepper)
+    logger.info("timestepping using {}".format(timestepper))
+    cfl_safety_factor = safety_factor*timestepper_benchmark.SAFETY_SCALE[timestepper]
+
+    checkpoint.set_checkpoint(solver, wall_dt=checkpoint_min*60, mode=mode, keep=checkpoint_keep,
+                              milestone_sim_dt=checkpoint_milestone_buoyancies*atmosphere.buoyancy_time,
+                              asynchronous=async_checkpoint, storage=storage.get('checkpoint'))
     
     logger.info("thermal_time = {:g}, top_thermal_time = {:g}".format(atmosphere.thermal_time, atmosphere.top_thermal_time))
     
@@ -228,7 +256,6 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=1e4, m_rz=3, gamma=5/3,
     max_dt = atmosphere.buoyancy_time*out_cadence
     if dt is None: dt = max_dt/5
         
-    report_cadence = 1
     output_time_cadence = out_cadence*atmosphere.buoyancy_time
     solver.stop_sim_time  = solver.sim_time + run_time_buoyancies*atmosphere.buoyancy_time
     solver.stop_iteration = solver.iteration + run_time_iter
@@ -236,150 +263,64 @@ def FC_convection(Rayleigh=1e6, Prandtl=1, stiffness=1e4, m_rz=3, gamma=5/3,
 
     logger.info("output cadence = {:g}".format(output_time_cadence))
 
-    analysis_tasks = atmosphere.initialize_output(solver, data_dir, coeffs_output=not(no_coeffs), sim_dt=output_time_cadence, max_writes=max_writes, mode=mode)
+    analysis_tasks = atmosphere.initialize_output(solver, data_dir, coeffs_output=not(no_coeffs), sim_dt=output_time_cadence, max_writes=max_writes, mode=mode, storage=storage)
 
     
     cfl_cadence = 1
-    CFL = flow_tools.CFL(solver, initial_dt=dt, cadence=cfl_cadence, safety=cfl_safety_factor,
-                         max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1)
-
-    if superstep:
-        CFL_traditional = flow_tools.CFL(solver, initial_dt=max_dt, cadence=cfl_cadence, safety=cfl_safety_factor,
-                                         max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1)
-
+    subdomain_cfl = superstep or cfl_exclude_rz
+    if subdomain_cfl:
+        exclude = []
+        if cfl_exclude_rz:
+            if single_chebyshev:
+                logger.warning("--cfl_exclude_rz needs separate stable and unstable z domains; ignored with --single_chebyshev")
+            else:
+                exclude = [0 if atmosphere.stable_bottom else -1]
+        CFL = cfl.SubdomainCFL(solver, initial_dt=dt, cadence=cfl_cadence, safety=cfl_safety_factor,
+                               max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1,
+                               spacing='mean' if superstep else 'grid', exclude=exclude)
+
+        CFL_traditional = cfl.CFL(solver, initial_dt=dt, cadence=cfl_cadence, safety=cfl_safety_factor,
+                                  max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1)
         CFL_traditional.add_velocities(('u', 'w'))
-    
-        vel_u = FutureField.parse('u', CFL.solver.evaluator.vars, CFL.solver.domain)
-        delta_x = atmosphere.Lx/nx
-        CFL.add_frequency(vel_u/delta_x)
-        vel_w = FutureField.parse('w', CFL.solver.evaluator.vars, CFL.solver.domain)
-        mean_delta_z_cz = atmosphere.Lz_cz/nz_cz
-        CFL.add_frequency(vel_w/mean_delta_z_cz)
     else:
-        CFL.add_velocities(('u', 'w'))
+        CFL = cfl.CFL(solver, initial_dt=dt, cadence=cfl_cadence, safety=cfl_safety_factor,
+                      max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1)
+    CFL.add_velocities(('u', 'w'))
 
 
     
     # Flow properties
-    flow = flow_tools.GlobalFlowProperty(solver, cadence=1)
+    flow = FlowDiagnostics(solver, CFL, cadence=report_cadence)
     flow.add_property("Re_rms", name='Re')
-
-    try:
-        logger.info("starting main loop")
-        start_time = time.time()
-        start_iter = solver.iteration
-        good_solution = True
-        first_step = True
-        while solver.ok and good_solution:
-
-            dt = CFL.compute_dt()
-            # advance
-            solver.step(dt)
-
-            effective_iter = solver.iteration - start_iter
-
-            # update lists
-            if effective_iter % report_cadence == 0:
-                Re_avg = flow.grid_average('Re')
-                log_string = 'Iteration: {:5d}, Time: {:8.3e} ({:8.3e}), '.format(solver.iteration, solver.sim_time, solver.sim_time/atmosphere.buoyancy_time)
-                log_string += 'dt: {:8.3e}'.format(dt)
-                if superstep:
-                    dt_traditional = CFL_traditional.compute_dt()
-                    log_string += ' (vs {:8.3e})'.format(dt_traditional)
-                log_string += ', '
-                log_string += 'Re: {:8.3e}/{:8.3e}'.format(Re_avg, flow.max('Re'))
-                logger.info(log_string)
-
-            if not np.isfinite(Re_avg):
-                good_solution = False
-                logger.info("Terminating run.  Trapped on Reynolds = {}".format(Re_avg))
-                
-            if first_step:
-                if verbose:
-                    import matplotlib
-                    matplotlib.use('Agg')
-                    import matplotlib.pyplot as plt
-                    fig = plt.figure()
-                    ax = fig.add_subplot(1,1,1)
-                    ax.spy(solver.pencils[0].L, markersize=0.5, markeredgewidth=0.0)
-                    fig.savefig(data_dir+"sparsity_pattern.png", dpi=2400)
-                    #fig.savefig(data_dir+"sparsity_pattern.svg", format="svg")
-
-                    import scipy.sparse.linalg as sla
-                    LU = sla.splu(solver.pencils[0].LHS.tocsc(), permc_spec='NATURAL')
-                    fig = plt.figure()
-                    ax = fig.add_subplot(1,2,1)
-                    ax.spy(LU.L.A, markersize=1, markeredgewidth=0.0)
-                    ax = fig.add_subplot(1,2,2)
-                    ax.spy(LU.U.A, markersize=1, markeredgewidth=0.0)
-                    fig.savefig(data_dir+"sparsity_pattern_LU.png", dpi=1200)
-                    #fig.savefig(data_dir+"sparsity_pattern_LU.svg", format="svg")
-
-                    logger.info("{} nonzero entries in LU".format(LU.nnz))
-                    logger.info("{} nonzero entries in LHS".format(solver.pencils[0].LHS.tocsc().nnz))
-                    logger.info("{} fill in factor".format(LU.nnz/solver.pencils[0].LHS.tocsc().nnz))
-                first_step = False
-                start_time = time.time()
-
-    except:
-        logger.error('Exception raised, triggering end of main loop.')
-        raise
-    finally:
-        end_time = time.time()
-
-        # Print statistics
-        elapsed_time = end_time - start_time
-        elapsed_sim_time = solver.sim_time
-        N_iterations = solver.iteration - 1
-        logger.info('main loop time: {:e}'.format(elapsed_time))
-        logger.info('Iterations: {:d}'.format(N_iterations))
-        logger.info('iter/sec: {:g}'.format(N_iterations/(elapsed_time)))
-        if N_iterations > 0:
-            logger.info('Average timestep: {:e}'.format(elapsed_sim_time / N_iterations))
-        
-        logger.info('beginning join operation')
-        try:
-            final_checkpoint = Checkpoint(data_dir, checkpoint_name='final_checkpoint')
-            final_checkpoint.set_checkpoint(solver, wall_dt=1, mode="append")
-            solver.step(dt) #clean this up in the future...works for now.
-            post.merge_process_files(data_dir+'/final_checkpoint/')
-        except:
-            print('cannot save final checkpoint')
-
-        if not(no_join):
-            logger.info(data_dir+'/checkpoint/')
-            post.merge_process_files(data_dir+'/checkpoint/')
-
-            for task in analysis_tasks:
-                logger.info(analysis_tasks[task].base_path)
-                post.merge_process_files(analysis_tasks[task].base_path)
-
-        if (atmosphere.domain.distributor.rank==0):
- 
-            N_TOTAL_CPU = atmosphere.domain.distributor.comm_cart.size
-
-            # Print statistics
-            print('-' * 40)
-            total_time = end_time-initial_time
-            main_loop_time = end_time - start_time
-            startup_time = start_time-initial_time
-            n_steps = solver.iteration-1
-            print('  startup time:', startup_time)
-            print('main loop time:', main_loop_time)
-            print('    total time:', total_time)
-            if n_steps > 0:
-                print('    iterations:', n_steps)
-                print(' loop sec/iter:', main_loop_time/n_steps)
-                print('    average dt:', solver.sim_time/n_steps)
-                print("          N_cores, Nx, Nz, startup     main loop,   main loop/iter, main loop/iter/grid, n_cores*main loop/iter/grid")
-                print('scaling:',
-                    ' {:d} {:d} {:d}'.format(N_TOTAL_CPU,nx,nz),
-                    ' {:8.3g} {:8.3g} {:8.3g} {:8.3g} {:8.3g}'.format(startup_time,
-                                                                    main_loop_time, 
-                                                                    main_loop_time/n_steps, 
-                                                                    main_loop_time/n_steps/(nx*nz), 
-                                                                    N_TOTAL_CPU*main_loop_time/n_steps/(nx*nz)))
-            print('-' * 40)
+    if adaptive_safety:
+        flow.add_property("KE", name='KE')
+    if subdomain_cfl:
+        flow.add_CFL(CFL_traditional, 'traditional')
+
+    def report(controller, dt):
+        log_string = 'Iteration: {:5d}, Time: {:8.3e} ({:8.3e}), '.format(solver.iteration, solver.sim_time, solver.sim_time/atmosphere.buoyancy_time)
+        log_string += 'dt: {:8.3e}'.format(dt)
+        if subdomain_cfl:
+            log_string += ' (vs {:8.3e})'.format(flow.dt('traditional'))
+        log_string += ', '
+        log_string += 'Re: {:8.3e}/{:8.3e}'.format(flow.grid_average('Re'), flow.max('Re'))
+        return log_string
+
+    def first_step(solver):
+        if verbose:
+            plot_sparsity_patterns(solver, data_dir, markersize=0.5, dpi=2400)
+
+    rollback = None
+    if rollback_cadence > 0 and timestepper.startswith('RK'):
+        rollback = Rollback(solver, flow, cadence=rollback_cadence)
+    safety = None
+    if adaptive_safety:
+        safety = cfl.SafetyController(flow, rollback=rollback)
+
+    controller = RunController(solver, atmosphere, flow, data_dir, checkpoint=checkpoint,
+                               analysis_tasks=analysis_tasks, initial_time=initial_time,
+                               detailed_telemetry=detailed_telemetry, rollback=rollback, safety=safety)
+    controller.run(report=report, first_step=first_step, join=not(no_join))
     return data_dir
 
 if __name__ == "__main__":
@@ -432,12 +373,23 @@ if __name__ == "__main__":
               "dense":args['--dense'],
               "nz_dense":int(args['--nz_dense']),
               "rk222":args['--rk222'],
+              "timestepper":args['--timestepper'],
+              "benchmark_file":args['--benchmark_file'],
+              "safety_factor":float(args['--safety_factor']),
               "max_writes":int(float(args['--writes'])),
               "superstep":args['--superstep'],
+              "cfl_exclude_rz":args['--cfl_exclude_rz'],
               "run_time":float(args['--run_time']),
               "run_time_buoyancies":run_time_buoy,
               "run_time_iter":run_time_iter,
-              "label":args['--label']}
+              "label":args['--label'],
+              "report_cadence":int(args['--report_cadence']),
+              "detailed_telemetry":args['--detailed_telemetry'],
+              "rollback_cadence":int(args['--rollback_cadence']),
+              "adaptive_safety":args['--adaptive_safety'],
+              "async_checkpoint":args['--async_checkpoint'],
+              "storage":args['--storage'],
+              "crop_coeffs":args['--crop_coeffs']}
     if args['bootstrap']:
         logger.info("Bootstrapping...")
         if args['--init_file']:
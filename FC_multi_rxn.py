@@ -20,9 +20,13 @@ Options:
     --n_rho_cz=<n_rho_cz>      Density scale heights across unstable layer [default: 3.5]
     --n_rho_rz=<n_rho_rz>      Density scale heights across stable layer   [default: 1]
 
-    --rk222                    Use RK222 as timestepper
+    --rk222                    Use RK222 as timestepper (same as --timestepper=RK222)
+    --timestepper=<ts>         Timestepper (e.g. RK443, RK222, SBDF2, SBDF3, CNAB2), or auto to benchmark [default: RK443]
+    --benchmark_file=<file>    Timestepper benchmark record for --timestepper=auto [default: timestepper_benchmarks.json]
+    --safety_factor=<safety>   Determines CFL Danger.  Higher=Faster [default: 0.2]
 
-    --superstep                Superstep equations by using average rather than actual vertical grid spacing
+    --superstep                Superstep equations by using the mean rather than actual vertical grid spacing of each z domain in the CFL
+    --cfl_exclude_rz           Ignore vertical velocities in the stable (radiative) zone in the CFL
     --dense                    Oversample matching region with extra chebyshev domain
     --nz_dense=<nz_dense>      Vertical z (chebyshev) resolution in oversampling region   [default: 64]
    
@@ -32,19 +36,15 @@ Options:
     
     --label=<label>            Additional label for run output directory
     --verbose                  Produce diagnostic plots
+    --report_cadence=<n>       Iterations between flow property reports [default: 1]
+    --detailed_telemetry       Also time transforms, transposes and pencil solves in telemetry.h5
+    --rollback_cadence=<n>     Iterations between in-memory snapshots for blow-up recovery (0 to disable) [default: 100]
+    --adaptive_safety          Adapt the CFL safety factor to the stability of the run
 """
 import logging
 logger = logging.getLogger(__name__)
 
 import dedalus.public as de
-from dedalus.tools  import post
-from dedalus.extras import flow_tools
-try:
-    from dedalus.extras.checkpointing import Checkpoint
-    do_checkpointing=True
-except:
-    logger.info("No checkpointing available; disabling capability")
-    do_checkpointing=False
 
 def FC_convection(Rayleigh=1e6, Prandtl=1,
                   ChemicalPrandtl=1, ChemicalReynolds=10, stiffness=1e4,
@@ -53,16 +53,24 @@ def FC_convection(Rayleigh=1e6, Prandtl=1,
                       nx = None,
                       width=None,
                       single_chebyshev=False,
-                      rk222=False,
-                      superstep=False,
+                      rk222=False, safety_factor=0.2,
+                      timestepper='RK443', benchmark_file='timestepper_benchmarks.json',
+                      superstep=False, cfl_exclude_rz=False,
                       dense=False, nz_dense=64,
                       oz=False,
-                      restart=None, data_dir='./', verbose=False):
+                      restart=None, data_dir='./', verbose=False, report_cadence=1,
+                      detailed_telemetry=False, rollback_cadence=100,
+                      adaptive_safety=False):
     import numpy as np
     import time
     from stratified_dynamics import multitropes
+    from tools.diagnostics import FlowDiagnostics
+    from tools.run_controller import RunController
+    from tools.rollback import Rollback
+    from tools import timestepper_benchmark
+    from tools.checkpointing import Checkpoint
+    from tools import cfl
     import os
-    from dedalus.core.future import FutureField
     
     initial_time = time.time()
 
@@ -82,15 +90,12 @@ def FC_convection(Rayleigh=1e6, Prandtl=1,
         nx = nz_cz*4
         
     if single_chebyshev:
-        nz = nz_cz
         nz_list = [nz_cz]
     else:
         if dense:
-            nz = nz_rz+nz_dense+nz_cz
             #nz_list = [nz_rz, int(nz_dense/2), int(nz_dense/2), nz_cz]
             nz_list = [nz_rz, nz_dense, nz_cz]
         else:
-            nz = nz_rz+nz_cz
             nz_list = [nz_rz, nz_cz]
 
     atmosphere = multitropes.FC_multitrope_rxn(nx=nx, nz=nz_list, stiffness=stiffness, 
@@ -113,38 +118,39 @@ def FC_convection(Rayleigh=1e6, Prandtl=1,
             os.mkdir('{:s}/'.format(data_dir))
 
     if rk222:
-        logger.info("timestepping using RK222")
-        ts = de.timesteppers.RK222
-        cfl_safety_factor = 0.2*2
-    else:
-        logger.info("timestepping using RK443")
-        ts = de.timesteppers.RK443
-        cfl_safety_factor = 0.2*4
+        timestepper = 'RK222'
+    initial_timestepper = 'RK443' if timestepper == 'auto' else timestepper
+    ts = getattr(de.timesteppers, initial_timestepper)
 
     # Build solver
     solver = problem.build_solver(ts)
 
-    if do_checkpointing:
-        checkpoint = Checkpoint(data_dir)
-        checkpoint.set_checkpoint(solver, wall_dt=1800)
+    checkpoint = Checkpoint(data_dir)
 
     # initial conditions
     if restart is None:
         atmosphere.set_IC(solver)
+        mode = "overwrite"
     else:
-        if do_checkpointing:
-            logger.info("restarting from {}".format(restart))
-            checkpoint.restart(restart, solver)
-        else:
-            logger.error("No checkpointing capability in this branch of Dedalus.  Aborting.")
-            raise
+        logger.info("restarting from {}".format(restart))
+        checkpoint.restart(restart, solver)
+        mode = "append"
+    if timestepper == 'auto':
+        timestepper = timestepper_benchmark.select(problem, atmosphere, solver, safety_factor,
+                                                   atmosphere.buoyancy_time*0.25, [('u', 'w')],
+                                                   filename=benchmark_file)
+        if timestepper != initial_timestepper:
+            solver = timestepper_benchmark.rebuild(problem, solver, timestepper)
+    logger.info("timestepping using {}".format(timestepper))
+    cfl_safety_factor = safety_factor*timestepper_benchmark.SAFETY_SCALE[timestepper]
+
+    checkpoint.set_checkpoint(solver, wall_dt=1800, mode=mode)
 
     logger.info("thermal_time = {:g}, top_thermal_time = {:g}".format(atmosphere.thermal_time, atmosphere.top_thermal_time))
     
     max_dt = atmosphere.min_BV_time 
     max_dt = atmosphere.buoyancy_time*0.25
 
-    report_cadence = 1
     output_time_cadence = 0.1*atmosphere.buoyancy_time
     solver.stop_sim_time = np.inf
     solver.stop_iteration= np.inf
@@ -156,101 +162,56 @@ def FC_convection(Rayleigh=1e6, Prandtl=1,
 
     
     cfl_cadence = 1
-    CFL = flow_tools.CFL(solver, initial_dt=max_dt, cadence=cfl_cadence, safety=cfl_safety_factor,
-                         max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1)
-
-    if superstep:
-        CFL_traditional = flow_tools.CFL(solver, initial_dt=max_dt, cadence=cfl_cadence, safety=cfl_safety_factor,
-                                         max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1)
-
+    subdomain_cfl = superstep or cfl_exclude_rz
+    if subdomain_cfl:
+        exclude = []
+        if cfl_exclude_rz:
+            if single_chebyshev:
+                logger.warning("--cfl_exclude_rz needs separate stable and unstable z domains; ignored with --single_chebyshev")
+            else:
+                exclude = [0 if atmosphere.stable_bottom else -1]
+        CFL = cfl.SubdomainCFL(solver, initial_dt=max_dt, cadence=cfl_cadence, safety=cfl_safety_factor,
+                               max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1,
+                               spacing='mean' if superstep else 'grid', exclude=exclude)
+
+        CFL_traditional = cfl.CFL(solver, initial_dt=max_dt, cadence=cfl_cadence, safety=cfl_safety_factor,
+                                  max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1)
         CFL_traditional.add_velocities(('u', 'w'))
-    
-        vel_u = FutureField.parse('u', CFL.solver.evaluator.vars, CFL.solver.domain)
-        delta_x = atmosphere.Lx/nx
-        CFL.add_frequency(vel_u/delta_x)
-        vel_w = FutureField.parse('w', CFL.solver.evaluator.vars, CFL.solver.domain)
-        mean_delta_z_cz = atmosphere.Lz_cz/nz_cz
-        CFL.add_frequency(vel_w/mean_delta_z_cz)
     else:
-        CFL.add_velocities(('u', 'w'))
+        CFL = cfl.CFL(solver, initial_dt=max_dt, cadence=cfl_cadence, safety=cfl_safety_factor,
+                      max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1)
+    CFL.add_velocities(('u', 'w'))
 
 
     
     # Flow properties
-    flow = flow_tools.GlobalFlowProperty(solver, cadence=1)
+    flow = FlowDiagnostics(solver, CFL, cadence=report_cadence)
     flow.add_property("Re_rms", name='Re')
-
-    try:
-        start_time = time.time()
-        while solver.ok:
-
-            dt = CFL.compute_dt()
-            # advance
-            solver.step(dt)
-
-            # update lists
-            if solver.iteration % report_cadence == 0:
-                log_string = 'Iteration: {:5d}, Time: {:8.3e} ({:8.3e}), '.format(solver.iteration, solver.sim_time, solver.sim_time/atmosphere.buoyancy_time)
-                log_string += 'dt: {:8.3e}'.format(dt)
-                if superstep:
-                    dt_traditional = CFL_traditional.compute_dt()
-                    log_string += ' (vs {:8.3e})'.format(dt_traditional)
-                log_string += ', '
-                log_string += 'Re: {:8.3e}/{:8.3e}'.format(flow.grid_average('Re'), flow.max('Re'))
-                logger.info(log_string)
-    except:
-        logger.error('Exception raised, triggering end of main loop.')
-        raise
-    finally:
-        end_time = time.time()
-
-        # Print statistics
-        elapsed_time = end_time - start_time
-        elapsed_sim_time = solver.sim_time
-        N_iterations = solver.iteration 
-        logger.info('main loop time: {:e}'.format(elapsed_time))
-        logger.info('Iterations: {:d}'.format(N_iterations))
-        logger.info('iter/sec: {:g}'.format(N_iterations/(elapsed_time)))
-        logger.info('Average timestep: {:e}'.format(elapsed_sim_time / N_iterations))
-        
-        logger.info('beginning join operation')
-        if do_checkpointing:
-            logger.info(data_dir+'/checkpoint/')
-            post.merge_analysis(data_dir+'/checkpoint/')
-
-        for task in analysis_tasks:
-            logger.info(analysis_tasks[task].base_path)
-            post.merge_analysis(analysis_tasks[task].base_path)
-
-        if (atmosphere.domain.distributor.rank==0):
-
-            logger.info('main loop time: {:e}'.format(elapsed_time))
-            logger.info('Iterations: {:d}'.format(N_iterations))
-            logger.info('iter/sec: {:g}'.format(N_iterations/(elapsed_time)))
-            logger.info('Average timestep: {:e}'.format(elapsed_sim_time / N_iterations))
- 
-            N_TOTAL_CPU = atmosphere.domain.distributor.comm_cart.size
-
-            # Print statistics
-            print('-' * 40)
-            total_time = end_time-initial_time
-            main_loop_time = end_time - start_time
-            startup_time = start_time-initial_time
-            n_steps = solver.iteration-1
-            print('  startup time:', startup_time)
-            print('main loop time:', main_loop_time)
-            print('    total time:', total_time)
-            print('Iterations:', solver.iteration)
-            print('Average timestep:', solver.sim_time / n_steps)
-            print("          N_cores, Nx, Nz, startup     main loop,   main loop/iter, main loop/iter/grid, n_cores*main loop/iter/grid")
-            print('scaling:',
-                  ' {:d} {:d} {:d}'.format(N_TOTAL_CPU,nx,nz),
-                  ' {:8.3g} {:8.3g} {:8.3g} {:8.3g} {:8.3g}'.format(startup_time,
-                                                                    main_loop_time, 
-                                                                    main_loop_time/n_steps, 
-                                                                    main_loop_time/n_steps/(nx*nz), 
-                                                                    N_TOTAL_CPU*main_loop_time/n_steps/(nx*nz)))
-            print('-' * 40)
+    if adaptive_safety:
+        flow.add_property("KE", name='KE')
+    if subdomain_cfl:
+        flow.add_CFL(CFL_traditional, 'traditional')
+
+    def report(controller, dt):
+        log_string = 'Iteration: {:5d}, Time: {:8.3e} ({:8.3e}), '.format(solver.iteration, solver.sim_time, solver.sim_time/atmosphere.buoyancy_time)
+        log_string += 'dt: {:8.3e}'.format(dt)
+        if subdomain_cfl:
+            log_string += ' (vs {:8.3e})'.format(flow.dt('traditional'))
+        log_string += ', '
+        log_string += 'Re: {:8.3e}/{:8.3e}'.format(flow.grid_average('Re'), flow.max('Re'))
+        return log_string
+
+    rollback = None
+    if rollback_cadence > 0 and timestepper.startswith('RK'):
+        rollback = Rollback(solver, flow, cadence=rollback_cadence)
+    safety = None
+    if adaptive_safety:
+        safety = cfl.SafetyController(flow, rollback=rollback)
+
+    controller = RunController(solver, atmosphere, flow, data_dir, checkpoint=checkpoint,
+                               analysis_tasks=analysis_tasks, initial_time=initial_time,
+                               detailed_telemetry=detailed_telemetry, rollback=rollback, safety=safety)
+    controller.run(report=report)
 
 if __name__ == "__main__":
     from docopt import docopt
@@ -295,4 +256,12 @@ if __name__ == "__main__":
                       dense=args['--dense'],
                       nz_dense=int(args['--nz_dense']),
                       rk222=args['--rk222'],
-                      superstep=args['--superstep'])
+                      timestepper=args['--timestepper'],
+                      benchmark_file=args['--benchmark_file'],
+                      safety_factor=float(args['--safety_factor']),
+                      superstep=args['--superstep'],
+                      cfl_exclude_rz=args['--cfl_exclude_rz'],
+                      report_cadence=int(args['--report_cadence']),
+                      detailed_telemetry=args['--detailed_telemetry'],
+                      rollback_cadence=int(args['--rollback_cadence']),
+                      adaptive_safety=args['--adaptive_safety'])
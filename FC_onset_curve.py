@@ -43,13 +43,22 @@ Options:
 
 
     --3D                                If flagged, use 3D eqns and search kx & ky
+                                          (without --Taylor the problem is isotropic,
+                                          and only k = sqrt(kx**2 + ky**2) is searched)
     --2.5D                              If flagged, use 3D eqns with ky = 0
 
     --load                              If flagged, attempt to load data from output file
     --exact                             If flagged, after doing the course search + interpolation,
                                             iteratively solve for the exact critical using
                                             optimization routines
+    --converge                          If flagged, refine the critical point at increasing nz
+                                            until Ra_crit and kx_crit converge
+    --converge_tol=<tol>                Relative tolerance for --converge [default: 1e-3]
+    --drift_tol=<tol>                   Relative eigenvalue drift between resolutions above
+                                            which a mode is spurious [default: 1e-6]
     --out_dir=<out_dir>                 Base output dir [default: ./]
+    --store=<store>                     SQLite file of previous eigenvalue solves to reuse
+                                            and add to (e.g., onset_store.db)
 """
 import logging
 logger = logging.getLogger(__name__)
@@ -200,11 +209,14 @@ solver = OnsetSolver(
             atmo_kwargs=atmo_kwargs,
             eqn_args=eqn_args,
             eqn_kwargs=eqn_kwargs,
-            bc_kwargs=bc_kwargs)
+            bc_kwargs=bc_kwargs,
+            store=args['--store'])
 
 #############################################
 #Crit find!
 out_dir = args['--out_dir']
 load    = args['--load']
 exact   = args['--exact']
-solver.find_crits(out_dir=out_dir, out_file='{:s}'.format(file_name), load=load, exact=exact)
+solver.find_crits(out_dir=out_dir, out_file='{:s}'.format(file_name), load=load, exact=exact,
+                  converge=args['--converge'], converge_tol=float(args['--converge_tol']),
+                  drift_tol=float(args['--drift_tol']))
@@ -40,7 +40,9 @@ Options:
     --restart=<restart_file>             Restart from checkpoint
     --start_new_files                    Start new files while checkpointing
 
-    --rk222                              Use RK222 as timestepper
+    --rk222                              Use RK222 as timestepper (same as --timestepper=RK222)
+    --timestepper=<ts>                   Timestepper (e.g. RK443, RK222, SBDF2, SBDF3, CNAB2), or auto to benchmark [default: RK443]
+    --benchmark_file=<file>              Timestepper benchmark record for --timestepper=auto [default: timestepper_benchmarks.json]
     --safety_factor=<safety_factor>      Determines CFL Danger.  Higher=Faster [default: 0.2]
     --split_diffusivities                If True, split the chi and nu between LHS and RHS to lower bandwidth
     
@@ -51,13 +53,22 @@ Options:
     --no_coeffs                          If flagged, coeffs will not be output
     --no_volumes                         If flagged, volumes will not be output (3D)
     --no_join                            If flagged, skip join operation at end of run.
+    --async_checkpoint                   Write checkpoints on a background thread while timestepping continues
+    --storage=<storage>                  HDF5 storage options by output (JSON file or string), e.g. {"volumes": {"compression": "gzip", "shuffle": true, "single_precision": true}}
+    --crop_coeffs=<modes>                Store only the lowest modes in coeffs output, e.g. 64,96 for x,z (x,y,z in 3D)
 
     --verbose                            Do extra output (Peclet and Nusselt numbers) to screen
+    --report_cadence=<report_cadence>    Iterations between flow property reports [default: 1]
+    --detailed_telemetry                 Also time transforms, transposes and pencil solves in telemetry.h5
+    --rollback_cadence=<n>               Iterations between in-memory snapshots for blow-up recovery (0 to disable) [default: 100]
+    --adaptive_safety                    Adapt the CFL safety factor to the stability of the run
 """
 import logging
 
 import numpy as np
 
+logger = logging.getLogger(__name__.split('.')[-1])
+
 def FC_polytrope(Rayleigh=1e4, Prandtl=1, aspect_ratio=4,
                  Taylor=None, theta=0,
                  nz=128, nx=None, ny=None, threeD=False, mesh=None,
@@ -68,23 +79,35 @@ def FC_polytrope(Rayleigh=1e4, Prandtl=1, aspect_ratio=4,
                  dynamic_diffusivities=False, split_diffusivities=False,
                  restart=None, start_new_files=False,
                  rk222=False, safety_factor=0.2,
+                 timestepper='RK443', benchmark_file='timestepper_benchmarks.json',
                  max_writes=20,
                  data_dir='./', out_cadence=0.1, no_coeffs=False, no_volumes=False, no_join=False,
-                 verbose=False):
+                 verbose=False, report_cadence=1, detailed_telemetry=False, rollback_cadence=100,
+                 adaptive_safety=False, async_checkpoint=False, storage=None, crop_coeffs=None, comm=None):
 
     import dedalus.public as de
-    from dedalus.tools  import post
-    from dedalus.extras import flow_tools
 
     import time
     import os
     import sys
     from stratified_dynamics import polytropes    
     from tools.checkpointing import Checkpoint
+    from tools.diagnostics import FlowDiagnostics
+    from tools.run_controller import RunController, plot_sparsity_patterns
+    from tools.rollback import Rollback
+    from tools.hermitian import HermitianMonitor
+    from tools import timestepper_benchmark
+    from tools import cfl
+    from tools.output import read_storage, read_crop
     
     checkpoint_min   = 30
+    checkpoint_keep = 5
+    checkpoint_milestone_buoyancies = 100
     
     initial_time = time.time()
+    storage = read_storage(storage)
+    if crop_coeffs is not None:
+        storage = dict(storage, coeffs=dict(storage.get('coeffs', {}), crop=read_crop(crop_coeffs, ('x', 'y', 'z') if threeD else ('x', 'z'))))
 
     logger.info("Starting Dedalus script {:s}".format(sys.argv[0]))
 
@@ -96,16 +119,16 @@ def FC_polytrope(Rayleigh=1e4, Prandtl=1, aspect_ratio=4,
     if threeD:
         atmosphere = polytropes.FC_polytrope_3d(nx=nx, ny=ny, nz=nz, mesh=mesh, constant_kappa=const_kappa, constant_mu=const_mu,\
                                         epsilon=epsilon, gamma=gamma, n_rho_cz=n_rho_cz, aspect_ratio=aspect_ratio,\
-                                        fig_dir=data_dir)
+                                        fig_dir=data_dir, comm=comm)
     else:
         if dynamic_diffusivities:
             atmosphere = polytropes.FC_polytrope_2d_kappa_mu(nx=nx, nz=nz, constant_kappa=const_kappa, constant_mu=const_mu,\
                                         epsilon=epsilon, gamma=gamma, n_rho_cz=n_rho_cz, aspect_ratio=aspect_ratio,\
-                                        fig_dir=data_dir)
+                                        fig_dir=data_dir, comm=comm)
         else:
             atmosphere = polytropes.FC_polytrope_2d(nx=nx, nz=nz, constant_kappa=const_kappa, constant_mu=const_mu,\
                                         epsilon=epsilon, gamma=gamma, n_rho_cz=n_rho_cz, aspect_ratio=aspect_ratio,\
-                                        fig_dir=data_dir)
+                                        fig_dir=data_dir, comm=comm)
     if epsilon < 1e-4:
         ncc_cutoff = 1e-14
     elif epsilon > 1e-1:
@@ -132,13 +155,9 @@ def FC_polytrope(Rayleigh=1e4, Prandtl=1, aspect_ratio=4,
             os.mkdir('{:s}/'.format(data_dir))
 
     if rk222:
-        logger.info("timestepping using RK222")
-        ts = de.timesteppers.RK222
-        cfl_safety_factor = safety_factor*2
-    else:
-        logger.info("timestepping using RK443")
-        ts = de.timesteppers.RK443
-        cfl_safety_factor = safety_factor*4
+        timestepper = 'RK222'
+    initial_timestepper = 'RK443' if timestepper == 'auto' else timestepper
+    ts = getattr(de.timesteppers, initial_timestepper)
 
     # Build solver
     solver = problem.build_solver(ts)
@@ -164,7 +183,18 @@ def FC_polytrope(Rayleigh=1e4, Prandtl=1, aspect_ratio=4,
         logger.info("restarting from {}".format(restart))
         dt = checkpoint.restart(restart, solver)
 
-    checkpoint.set_checkpoint(solver, wall_dt=checkpoint_min*60, mode=mode)
+    if timestepper == 'auto':
+        timestepper = timestepper_benchmark.select(problem, atmosphere, solver, safety_factor,
+                                                   out_cadence*atmosphere.buoyancy_time/2, [('u', 'v', 'w') if threeD else ('u', 'w')],
+                                                   filename=benchmark_file)
+        if timestepper != initial_timestepper:
+            solver = timestepper_benchmark.rebuild(problem, solver, timestepper)
+    logger.info("timestepping using {}".format(timestepper))
+    cfl_safety_factor = safety_factor*timestepper_benchmark.SAFETY_SCALE[timestepper]
+
+    checkpoint.set_checkpoint(solver, wall_dt=checkpoint_min*60, mode=mode, keep=checkpoint_keep,
+                              milestone_sim_dt=checkpoint_milestone_buoyancies*atmosphere.buoyancy_time,
+                              asynchronous=async_checkpoint, storage=storage.get('checkpoint'))
     
     if run_time_buoyancies != None:
         solver.stop_sim_time    = solver.sim_time + run_time_buoyancies*atmosphere.buoyancy_time
@@ -173,7 +203,6 @@ def FC_polytrope(Rayleigh=1e4, Prandtl=1, aspect_ratio=4,
     
     solver.stop_iteration   = solver.iteration + run_time_iter
     solver.stop_wall_time   = run_time*3600
-    report_cadence = 1
     output_time_cadence = out_cadence*atmosphere.buoyancy_time
     Hermitian_cadence = 100
     
@@ -181,9 +210,9 @@ def FC_polytrope(Rayleigh=1e4, Prandtl=1, aspect_ratio=4,
     logger.info("output cadence = {:g}".format(output_time_cadence))
    
     if threeD:
-        analysis_tasks = atmosphere.initialize_output(solver, data_dir, sim_dt=output_time_cadence, coeffs_output=not(no_coeffs), mode=mode,max_writes=max_writes, volumes_output=not(no_volumes))
+        analysis_tasks = atmosphere.initialize_output(solver, data_dir, sim_dt=output_time_cadence, coeffs_output=not(no_coeffs), mode=mode,max_writes=max_writes, volumes_output=not(no_volumes), storage=storage)
     else:
-        analysis_tasks = atmosphere.initialize_output(solver, data_dir, sim_dt=output_time_cadence, coeffs_output=not(no_coeffs), mode=mode,max_writes=max_writes)
+        analysis_tasks = atmosphere.initialize_output(solver, data_dir, sim_dt=output_time_cadence, coeffs_output=not(no_coeffs), mode=mode,max_writes=max_writes, storage=storage)
 
     #Set up timestep defaults
     max_dt = output_time_cadence/2
@@ -191,146 +220,54 @@ def FC_polytrope(Rayleigh=1e4, Prandtl=1, aspect_ratio=4,
         
     cfl_cadence = 1
     cfl_threshold = 0.1
-    CFL = flow_tools.CFL(solver, initial_dt=dt, cadence=cfl_cadence, safety=cfl_safety_factor,
-                         max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=cfl_threshold)
+    CFL = cfl.CFL(solver, initial_dt=dt, cadence=cfl_cadence, safety=cfl_safety_factor,
+                  max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=cfl_threshold)
     if threeD:
         CFL.add_velocities(('u', 'v', 'w'))
     else:
         CFL.add_velocities(('u', 'w'))
 
     # Flow properties
-    flow = flow_tools.GlobalFlowProperty(solver, cadence=1)
+    flow = FlowDiagnostics(solver, CFL, cadence=report_cadence)
     flow.add_property("Re_rms", name='Re')
+    if adaptive_safety:
+        flow.add_property("KE", name='KE')
     if verbose:
         flow.add_property("Pe_rms", name='Pe')
         flow.add_property("Nusselt_AB17", name='Nusselt')
     
-    start_iter=solver.iteration
-    start_sim_time = solver.sim_time
-
-    try:
-        start_time = time.time()
-        start_iter = solver.iteration
-        logger.info('starting main loop')
-        good_solution = True
-        first_step = True
-        while solver.ok and good_solution:
-            dt = CFL.compute_dt()
-            # advance
-            solver.step(dt)
-
-            effective_iter = solver.iteration - start_iter
-
-            if threeD and effective_iter % Hermitian_cadence == 0:
-                for field in solver.state.fields:
-                    field.require_grid_space()
-
-            # update lists
-            if effective_iter % report_cadence == 0:
-                Re_avg = flow.grid_average('Re')
-                log_string = 'Iteration: {:5d}, Time: {:8.3e} ({:8.3e}), dt: {:8.3e}, '.format(solver.iteration-start_iter, solver.sim_time, (solver.sim_time-start_sim_time)/atmosphere.buoyancy_time, dt)
-                if verbose:
-                    log_string += '\n\t\tRe: {:8.5e}/{:8.5e}'.format(Re_avg, flow.max('Re'))
-                    log_string += '; Pe: {:8.5e}/{:8.5e}'.format(flow.grid_average('Pe'), flow.max('Pe'))
-                    log_string += '; Nu: {:8.5e}/{:8.5e}'.format(flow.grid_average('Nusselt'), flow.max('Nusselt'))
-                else:
-                    log_string += 'Re: {:8.3e}/{:8.3e}'.format(Re_avg, flow.max('Re'))
-                logger.info(log_string)
-                
-            if not np.isfinite(Re_avg):
-                good_solution = False
-                logger.info("Terminating run.  Trapped on Reynolds = {}".format(Re_avg))
-                    
-            if first_step:
-                if verbose:
-                    import matplotlib
-                    matplotlib.use('Agg')
-                    import matplotlib.pyplot as plt
-                    fig = plt.figure()
-                    ax = fig.add_subplot(1,1,1)
-                    ax.spy(solver.pencils[0].L, markersize=1, markeredgewidth=0.0)
-                    fig.savefig(data_dir+"sparsity_pattern.png", dpi=1200)
-
-                    import scipy.sparse.linalg as sla
-                    LU = sla.splu(solver.pencils[0].LHS.tocsc(), permc_spec='NATURAL')
-                    fig = plt.figure()
-                    ax = fig.add_subplot(1,2,1)
-                    ax.spy(LU.L.A, markersize=1, markeredgewidth=0.0)
-                    ax = fig.add_subplot(1,2,2)
-                    ax.spy(LU.U.A, markersize=1, markeredgewidth=0.0)
-                    fig.savefig(data_dir+"sparsity_pattern_LU.png", dpi=1200)
-
-                    logger.info("{} nonzero entries in LU".format(LU.nnz))
-                    logger.info("{} nonzero entries in LHS".format(solver.pencils[0].LHS.tocsc().nnz))
-                    logger.info("{} fill in factor".format(LU.nnz/solver.pencils[0].LHS.tocsc().nnz))
-                first_step = False
-                start_time = time.time()
-    except:
-        logger.error('Exception raised, triggering end of main loop.')
-    finally:
-        end_time = time.time()
-
-        # Print statistics
-        elapsed_time = end_time - start_time
-        elapsed_sim_time = solver.sim_time
-        N_iterations = solver.iteration-1
-        logger.info('main loop time: {:e}'.format(elapsed_time))
-        logger.info('Iterations: {:d}'.format(N_iterations))
-        logger.info('iter/sec: {:g}'.format(N_iterations/(elapsed_time)))
-        if N_iterations > 0:
-            logger.info('Average timestep: {:e}'.format(elapsed_sim_time / N_iterations))
-        
-        if not no_join:
-            logger.info('beginning join operation')
-            try:
-                final_checkpoint = Checkpoint(data_dir, checkpoint_name='final_checkpoint')
-                final_checkpoint.set_checkpoint(solver, wall_dt=1, mode="append")
-                solver.step(dt) #clean this up in the future...works for now.
-                post.merge_process_files(data_dir+'/final_checkpoint/', cleanup=False)
-            except:
-                print('cannot save final checkpoint')
-                
-            logger.info(data_dir+'/checkpoint/')
-            post.merge_process_files(data_dir+'/checkpoint/', cleanup=False)
-            
-            for task in analysis_tasks.keys():
-                logger.info(analysis_tasks[task].base_path)
-                post.merge_process_files(analysis_tasks[task].base_path, cleanup=False)
-
-        if (atmosphere.domain.distributor.rank==0):
-
-            logger.info('main loop time: {:e}'.format(elapsed_time))
-            if start_iter > 1:
-                logger.info('Iterations (this run): {:d}'.format(N_iterations - start_iter))
-                logger.info('Iterations (total): {:d}'.format(N_iterations - start_iter))
-            logger.info('iter/sec: {:g}'.format(N_iterations/(elapsed_time)))
-            if N_iterations > 0:
-                logger.info('Average timestep: {:e}'.format(elapsed_sim_time / N_iterations))
- 
-            N_TOTAL_CPU = atmosphere.domain.distributor.comm_cart.size
-
-            # Print statistics
-            print('-' * 40)
-            total_time = end_time-initial_time
-            main_loop_time = end_time - start_time
-            startup_time = start_time-initial_time
-            n_steps = solver.iteration-1
-            print('  startup time:', startup_time)
-            print('main loop time:', main_loop_time)
-            print('    total time:', total_time)
-            if n_steps > 0:
-                print('    iterations:', n_steps)
-                print(' loop sec/iter:', main_loop_time/n_steps)
-                print('    average dt:', solver.sim_time/n_steps)
-                print("          N_cores, Nx, Nz, startup     main loop,   main loop/iter, main loop/iter/grid, n_cores*main loop/iter/grid")
-                print('scaling:',
-                    ' {:d} {:d} {:d}'.format(N_TOTAL_CPU,nx,nz),
-                    ' {:8.3g} {:8.3g} {:8.3g} {:8.3g} {:8.3g}'.format(startup_time,
-                                                                    main_loop_time, 
-                                                                    main_loop_time/n_steps, 
-                                                                    main_loop_time/n_steps/(nx*nz), 
-                                                                    N_TOTAL_CPU*main_loop_time/n_steps/(nx*nz)))
-            print('-' * 40)
+    def report(controller, dt):
+        Re_avg = flow.grid_average('Re')
+        log_string = 'Iteration: {:5d}, Time: {:8.3e} ({:8.3e}), dt: {:8.3e}, '.format(controller.effective_iter, solver.sim_time, (solver.sim_time-controller.start_sim_time)/atmosphere.buoyancy_time, dt)
+        if verbose:
+            log_string += '\n\t\tRe: {:8.5e}/{:8.5e}'.format(Re_avg, flow.max('Re'))
+            log_string += '; Pe: {:8.5e}/{:8.5e}'.format(flow.grid_average('Pe'), flow.max('Pe'))
+            log_string += '; Nu: {:8.5e}/{:8.5e}'.format(flow.grid_average('Nusselt'), flow.max('Nusselt'))
+        else:
+            log_string += 'Re: {:8.3e}/{:8.3e}'.format(Re_avg, flow.max('Re'))
+        return log_string
+
+    def first_step(solver):
+        if verbose:
+            plot_sparsity_patterns(solver, data_dir)
+
+    rollback = None
+    if rollback_cadence > 0 and timestepper.startswith('RK'):
+        rollback = Rollback(solver, flow, cadence=rollback_cadence)
+    safety = None
+    if adaptive_safety:
+        safety = cfl.SafetyController(flow, rollback=rollback)
+
+    hermitian = None
+    if threeD:
+        hermitian = HermitianMonitor(solver, cadence=Hermitian_cadence)
+
+    controller = RunController(solver, atmosphere, flow, data_dir, checkpoint=checkpoint,
+                               analysis_tasks=analysis_tasks, initial_time=initial_time,
+                               hermitian=hermitian,
+                               detailed_telemetry=detailed_telemetry, rollback=rollback, safety=safety)
+    controller.run(report=report, first_step=first_step,
+                   final_checkpoint=not(no_join), join=not(no_join))
 
 if __name__ == "__main__":
     from docopt import docopt
@@ -481,6 +418,8 @@ if __name__ == "__main__":
                  restart=(args['--restart']),
                  start_new_files=start_new_files,
                  rk222=rk222,
+                 timestepper=args['--timestepper'],
+                 benchmark_file=args['--benchmark_file'],
                  safety_factor=float(args['--safety_factor']),
                  out_cadence=float(args['--out_cadence']),
                  max_writes=int(float(args['--writes'])),
@@ -489,4 +428,11 @@ if __name__ == "__main__":
                  no_volumes=args['--no_volumes'],
                  no_join=args['--no_join'],
                  split_diffusivities=args['--split_diffusivities'],
-                 verbose=args['--verbose'])
+                 verbose=args['--verbose'],
+                 report_cadence=int(args['--report_cadence']),
+                 detailed_telemetry=args['--detailed_telemetry'],
+                 rollback_cadence=int(args['--rollback_cadence']),
+                 adaptive_safety=args['--adaptive_safety'],
+                 async_checkpoint=args['--async_checkpoint'],
+                 storage=args['--storage'],
+                 crop_coeffs=args['--crop_coeffs'])
@@ -0,0 +1,128 @@
+"""
+Summarize per-iteration performance telemetry written by the FC drivers.
+
+Reports sustained throughput, slow-step outliers and output overhead for each
+run segment in a telemetry file (data_dir/telemetry.h5).
+
+Usage:
+    analyze_telemetry.py <file> [options]
+
+Options:
+    --run=<run>               Run segment to analyze (e.g. run_0); default is all segments
+    --skip=<skip>             Iterations to skip at the start of each segment (startup) [default: 1]
+    --window=<window>         Iterations per throughput window [default: 100]
+    --threshold=<threshold>   Outlier threshold, in robust standard deviations above the median [default: 5]
+    --n_outliers=<n>          Number of slowest steps to list [default: 10]
+    --plot                    Plot wall time per iteration of each segment to png
+"""
+import numpy as np
+import h5py
+
+import logging
+logger = logging.getLogger(__name__.split('.')[-1])
+
+OUTPUT_PHASES = ('evaluator', 'checkpoint')
+
+def robust_outliers(values, threshold):
+    """Boolean mask of values more than threshold robust standard deviations above the median."""
+    median = np.median(values)
+    sigma = 1.4826*np.median(np.abs(values - median))
+    if sigma == 0:
+        return values > median*(1 + 1e-3) + 1e-6
+    return values > median + threshold*sigma
+
+def read_run(run, skip=0):
+    """Telemetry columns of one run segment, as a dictionary of arrays."""
+    data = {name: run[name][skip:] for name in ('iteration', 'sim_time', 'dt', 'wall_time')}
+    data['phases'] = {phase: run['phases'][phase][skip:] for phase in run['phases'].keys()}
+    return data
+
+def analyze(data, window=100, threshold=5, n_outliers=10):
+    """Log throughput, outlier and output overhead statistics of one run segment."""
+    wall = data['wall_time']
+    phases = data['phases']
+    n_iter = len(wall)
+    if n_iter == 0:
+        logger.info("no iterations recorded")
+        return
+    total_wall = np.sum(wall)
+    logger.info("iterations: {:d} ({:d} to {:d})".format(n_iter, data['iteration'][0], data['iteration'][-1]))
+    logger.info("wall time: {:.4g} sec, sim time: {:.4g}, mean dt: {:.4g}".format(
+                total_wall, data['sim_time'][-1]-data['sim_time'][0]+data['dt'][0], np.mean(data['dt'])))
+
+    # sustained throughput
+    logger.info("throughput: {:.4g} iter/sec overall, {:.4g} iter/sec median step".format(
+                n_iter/total_wall, 1/np.median(wall)))
+    n_windows = n_iter // window
+    if n_windows > 1:
+        rates = window/np.sum(wall[:n_windows*window].reshape(n_windows, window), axis=1)
+        logger.info("throughput over {:d}-iteration windows: min {:.4g}, median {:.4g}, max {:.4g} iter/sec".format(
+                    window, rates.min(), np.median(rates), rates.max()))
+
+    # time per phase
+    logger.info("time per phase (max over processes):")
+    for phase, times in phases.items():
+        phase_time = np.sum(times)
+        if phase_time > 0:
+            logger.info("  {:>15s}: {:8.3g} sec/iter ({:5.1f}%), in {:d} iterations".format(
+                        phase, phase_time/n_iter, 100*phase_time/total_wall, np.count_nonzero(times)))
+
+    # slow steps
+    slow = robust_outliers(wall, threshold)
+    excess = np.sum(wall[slow] - np.median(wall))
+    logger.info("slow steps: {:d} ({:.2f}%), costing {:.4g} sec ({:.1f}%) over the median step".format(
+                np.sum(slow), 100*np.sum(slow)/n_iter, excess, 100*excess/total_wall))
+    for i in np.argsort(wall)[::-1][:n_outliers]:
+        if not slow[i]:
+            break
+        step_phases = {phase: times[i] for phase, times in phases.items()}
+        worst = max(step_phases, key=step_phases.get)
+        logger.info("  iteration {:d}: {:.4g} sec ({:.1f}x median), mostly {} ({:.4g} sec)".format(
+                    data['iteration'][i], wall[i], wall[i]/np.median(wall), worst, step_phases[worst]))
+
+    # output overhead
+    output_time = sum(phases[phase] for phase in OUTPUT_PHASES if phase in phases)
+    if np.isscalar(output_time):
+        return
+    output_steps = robust_outliers(output_time, threshold)
+    n_output = np.sum(output_steps)
+    logger.info("output (evaluator + checkpoint): {:.4g} sec ({:.1f}%) in total".format(
+                np.sum(output_time), 100*np.sum(output_time)/total_wall))
+    if n_output > 0 and n_output < n_iter:
+        overhead = np.sum(wall[output_steps]) - n_output*np.median(wall[~output_steps])
+        logger.info("output steps: {:d}, median {:.4g} sec vs {:.4g} sec otherwise; overhead {:.4g} sec ({:.1f}%)".format(
+                    n_output, np.median(wall[output_steps]), np.median(wall[~output_steps]),
+                    overhead, 100*overhead/total_wall))
+
+def plot(data, filename, threshold=5):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    slow = robust_outliers(data['wall_time'], threshold)
+    ax.plot(data['iteration'], data['wall_time'], linewidth=0.5)
+    ax.plot(data['iteration'][slow], data['wall_time'][slow], linestyle='none', marker='.', color='red')
+    ax.set_xlabel('iteration')
+    ax.set_ylabel('wall time per iteration (sec)')
+    ax.set_yscale('log')
+    fig.savefig(filename, dpi=150)
+    logger.info("plot written to {}".format(filename))
+
+if __name__ == "__main__":
+    from docopt import docopt
+    args = docopt(__doc__)
+    logging.basicConfig(level=logging.INFO, format='%(name)s: %(message)s')
+
+    skip = int(args['--skip'])
+    threshold = float(args['--threshold'])
+    with h5py.File(args['<file>'], 'r') as telemetry:
+        runs = [args['--run']] if args['--run'] else sorted(telemetry.keys(), key=lambda name: int(name.split('_')[-1]))
+        for name in runs:
+            run = telemetry[name]
+            logger.info("{} ({:d} processes{})".format(name, run.attrs['processes'],
+                        ', detailed' if run.attrs['detailed'] else ''))
+            data = read_run(run, skip=skip)
+            analyze(data, window=int(args['--window']), threshold=threshold,
+                    n_outliers=int(args['--n_outliers']))
+            if args['--plot']:
+                plot(data, args['<file>'].replace('.h5', '')+'_{}.png'.format(name), threshold=threshold)
@@ -0,0 +1,112 @@
+"""
+Benchmark HDF5 storage options for dedalus output.
+
+Rewrites the tasks of an output file (joined, e.g. volumes/volumes_s1.h5, or a
+process file) with each storage setting of tools.output.StorageFileHandler,
+one write at a time as the file handlers do, and reports the stored size,
+the write and read times and, for single precision storage, the largest
+error relative to the largest value of each task.  Read times are usually
+from the page cache, so they measure decompression rather than disk reads.
+
+Usage:
+    benchmark_storage.py <file> [options]
+
+Options:
+    --tasks=<tasks>            Comma-separated tasks to benchmark (default: all)
+    --writes=<writes>          Number of writes to use (default: all)
+    --repeats=<repeats>        Repetitions of each measurement; the fastest is reported [default: 3]
+    --chunk_bytes=<bytes>      Approximate chunk size of filtered datasets [default: 1048576]
+    --scratch=<dir>            Directory for the test files [default: ./]
+"""
+import time
+import pathlib
+from collections import OrderedDict
+
+import numpy as np
+import h5py
+
+from tools.output import SINGLE_PRECISION, dataset_options
+
+import logging
+logger = logging.getLogger(__name__.split('.')[-1])
+
+SETTINGS = OrderedDict([('uncompressed',  {}),
+                        ('lzf',           {'compression': 'lzf', 'shuffle': True}),
+                        ('gzip1',         {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True}),
+                        ('gzip4',         {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}),
+                        ('single',        {'single_precision': True}),
+                        ('single lzf',    {'single_precision': True, 'compression': 'lzf', 'shuffle': True}),
+                        ('single gzip4',  {'single_precision': True, 'compression': 'gzip', 'compression_opts': 4, 'shuffle': True})])
+
+def read_tasks(path, tasks=None, writes=None):
+    """Task data of an output file, as a dictionary of arrays of shape (writes,) + spatial shape."""
+    with h5py.File(str(path), 'r') as file:
+        if tasks is None:
+            tasks = list(file['tasks'].keys())
+        return OrderedDict((task, file['tasks'][task][:writes]) for task in tasks)
+
+def write_file(path, data, single_precision=False, chunk_bytes=2**20, **options):
+    """Write data one write at a time, as a file handler would; returns the wall time."""
+    start_time = time.time()
+    with h5py.File(str(path), 'w') as file:
+        for task, task_data in data.items():
+            dtype = task_data.dtype
+            if single_precision:
+                dtype = SINGLE_PRECISION.get(dtype, dtype)
+            dset = file.create_dataset(task, shape=task_data.shape, dtype=dtype,
+                                       **dataset_options(task_data.shape, dtype, chunk_bytes=chunk_bytes, **options))
+            for index in range(task_data.shape[0]):
+                dset[index] = task_data[index]
+    return time.time() - start_time
+
+def read_file(path):
+    """Read every task back; returns the data and the wall time."""
+    start_time = time.time()
+    with h5py.File(str(path), 'r') as file:
+        data = OrderedDict((task, file[task][:]) for task in file.keys())
+    return data, time.time() - start_time
+
+def benchmark(data, path, settings=SETTINGS, repeats=3, chunk_bytes=2**20):
+    """Size, write and read time and relative error of data stored with each setting."""
+    results = OrderedDict()
+    for name, options in settings.items():
+        write_time = min(write_file(path, data, chunk_bytes=chunk_bytes, **options) for i in range(repeats))
+        nbytes = path.stat().st_size
+        read_time = np.inf
+        for i in range(repeats):
+            stored, elapsed = read_file(path)
+            read_time = min(read_time, elapsed)
+        error = 0.
+        for task, task_data in data.items():
+            scale = np.max(np.abs(task_data))
+            if scale > 0:
+                error = max(error, np.max(np.abs(stored[task] - task_data))/scale)
+        results[name] = {'bytes': nbytes, 'write_time': write_time, 'read_time': read_time, 'error': error}
+        path.unlink()
+    return results
+
+def log_results(results):
+    reference = results['uncompressed']['bytes'] if 'uncompressed' in results else None
+    logger.info("{:>14s} {:>10s} {:>6s} {:>10s} {:>10s} {:>10s}".format(
+                'setting', 'MB', 'ratio', 'write MB/s', 'read MB/s', 'rel error'))
+    for name, result in results.items():
+        MB = result['bytes']/1e6
+        ratio = reference/result['bytes'] if reference else np.nan
+        data_MB = (reference if reference else result['bytes'])/1e6
+        logger.info("{:>14s} {:10.3f} {:6.2f} {:10.1f} {:10.1f} {:10.2e}".format(
+                    name, MB, ratio, data_MB/max(result['write_time'], 1e-6),
+                    data_MB/max(result['read_time'], 1e-6), result['error']))
+
+if __name__ == "__main__":
+    from docopt import docopt
+    args = docopt(__doc__)
+    logging.basicConfig(level=logging.INFO, format='%(name)s: %(message)s')
+
+    tasks = args['--tasks'].split(',') if args['--tasks'] else None
+    writes = int(args['--writes']) if args['--writes'] else None
+    data = read_tasks(args['<file>'], tasks=tasks, writes=writes)
+    logger.info("{}: tasks {}, {:.3g} MB".format(args['<file>'], ', '.join(data.keys()),
+                sum(task_data.nbytes for task_data in data.values())/1e6))
+    path = pathlib.Path(args['--scratch']).joinpath('benchmark_storage_test.h5')
+    results = benchmark(data, path, repeats=int(args['--repeats']), chunk_bytes=int(args['--chunk_bytes']))
+    log_results(results)
@@ -1,12 +1,16 @@
 '''
 Join distributed dedalus output data.
 
+The sets of all the data types are shared between the MPI processes by
+size, so running under mpirun joins many sets at once.
+
 Usage:
-      join_data.py <case>... [--data_type=<data_type> --cleanup]
+      join_data.py <case>... [--data_type=<data_type> --cleanup --max_MB=<max_MB>]
 
 Options:
       --data_type=<data_type>      Type of data to join; if provided join a single data.
       --cleanup                    Cleanup after join
+      --max_MB=<max_MB>            Largest block of a task each process copies at once, in MB [default: 256]
 
 '''
 
@@ -16,7 +20,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 import dedalus.public
-from dedalus.tools  import post
+from tools import output
 
 from docopt import docopt
 
@@ -35,10 +39,10 @@ else:
     data_types = ['scalar', 'profiles', 'slices', 'coeffs', 'volumes', 'checkpoint']
 
 for data_type in data_types:
-    logger.info("merging {}".format(data_type))
-    try:
-        post.merge_process_files(base_path+data_type, cleanup=cleanup)
-    except:
+    if not os.path.isdir(base_path+data_type):
         logger.info("missing {}".format(data_type))
-        
+
+output.merge_handlers([base_path+data_type for data_type in data_types], cleanup=cleanup,
+                      max_bytes=int(float(args['--max_MB'])*2**20))
+
 logger.info("done join operation for {:s}".format(data_dir))
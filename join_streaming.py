@@ -0,0 +1,55 @@
+'''
+Join distributed dedalus output sets while a run is writing them.
+
+Start alongside the run (as a separate serial process, not under the
+run's mpirun), e.g. in the batch script:
+
+    python3 join_streaming.py <case> --cleanup &
+    mpirun -n 256 python3 FC_poly.py ...
+
+Each set is joined as soon as every process has moved on to the next set.
+When the run shuts down it asks the joiner to stop, and joins the sets that
+are left, skipping those already joined.  Checkpoints are not joined
+unless asked for with --data_type, as the run deletes old checkpoint sets;
+a set deleted while it is being joined is skipped.
+
+Usage:
+      join_streaming.py <case> [--data_type=<data_type> --cleanup --interval=<interval> --max_MB=<max_MB>]
+
+Options:
+      --data_type=<data_type>      Type of data to join; if provided join a single data.
+      --cleanup                    Remove the process files of each set once it is joined
+      --interval=<interval>        Seconds between checks for completed sets [default: 60]
+      --max_MB=<max_MB>            Largest block of a task copied at once, in MB [default: 256]
+
+'''
+
+import os
+import signal
+import logging
+logger = logging.getLogger(__name__)
+
+from tools import output
+
+from docopt import docopt
+
+args = docopt(__doc__)
+
+data_dir = args['<case>']
+base_path = os.path.abspath(data_dir)+'/'
+
+if args['--data_type'] is not None:
+    data_types=[args['--data_type']]
+else:
+    # not checkpoints: the run prunes old checkpoint sets, and restarts read unjoined sets
+    data_types = ['scalar', 'profiles', 'slices', 'coeffs', 'volumes']
+
+def terminate(signum, frame):
+    raise SystemExit("received signal {:d}".format(signum))
+signal.signal(signal.SIGTERM, terminate)
+
+logger.info("streaming join of {} from Dedalus run {:s}".format(', '.join(data_types), data_dir))
+joiner = output.StreamingJoiner(base_path, [base_path+data_type for data_type in data_types],
+                                cleanup=args['--cleanup'], max_bytes=int(float(args['--max_MB'])*2**20))
+joiner.run(interval=float(args['--interval']))
+logger.info("done streaming join for {:s}".format(data_dir))
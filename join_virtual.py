@@ -0,0 +1,41 @@
+'''
+Join dedalus output data without copying it.
+
+Writes <case>/<data_type>_virtual.h5 for each data type, a small file of
+HDF5 virtual datasets spanning all sets of the output (joined or still
+split into process files), which tools.analysis reads like a joined set:
+e.g. analysis.Scalar(['<case>/scalar_virtual.h5']).  The set files must
+stay in place; rerun after more sets are written or joined.
+
+Usage:
+      join_virtual.py <case>... [--data_type=<data_type>]
+
+Options:
+      --data_type=<data_type>      Type of data to join; if provided join a single data.
+
+'''
+
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+from tools import output
+
+from docopt import docopt
+
+args = docopt(__doc__)
+
+if args['--data_type'] is not None:
+    data_types=[args['--data_type']]
+else:
+    data_types = ['scalar', 'profiles', 'slices', 'coeffs', 'volumes', 'checkpoint']
+
+for data_dir in args['<case>']:
+    base_path = os.path.abspath(data_dir)+'/'
+    logger.info("virtual join of data from Dedalus run {:s}".format(data_dir))
+    for data_type in data_types:
+        try:
+            output.virtual_join(base_path+data_type)
+        except FileNotFoundError:
+            logger.info("missing {}".format(data_type))
+    logger.info("done virtual join for {:s}".format(data_dir))
@@ -18,6 +18,9 @@ from scipy import interpolate
 
 
 from tools.eigentools.eigentools import Eigenproblem, CriticalFinder
+from tools.onset_grid import OnsetGrid
+from tools.eigen_store import EigenStore
+from tools.linear_stability import resolved_eigenvalues
 from stratified_dynamics import polytropes, multitropes
 
 
@@ -36,7 +39,7 @@ class OnsetSolver:
 
     def __init__(self, eqn_set=0, atmosphere=0, ra_steps=(1, 1e3, 40, True),
                  kx_steps=(0.01, 1, 40, True), ky_steps=None, threeD=False, atmo_kwargs={}, eqn_args=[],
-                 eqn_kwargs={}, bc_kwargs={}):
+                 eqn_kwargs={}, bc_kwargs={}, store=None):
         """
         Initializes the onset solver by specifying the equation set to be used
         and the type of atmosphere that will be solved on.  Also specifies
@@ -69,6 +72,9 @@ class OnsetSolver:
                            set_equations
             bc_kwargs    - A list of keyword arguments to be passed to 
                            set_BC
+            store        - Path to an SQLite result store (see
+                           tools.eigen_store).  If given, previously solved
+                           points are reused and new solves are added to it.
         """
         self._eqn_set    = eqn_set
         self._atmosphere = atmosphere
@@ -81,10 +87,12 @@ class OnsetSolver:
         self._eqn_args    = eqn_args
         self._eqn_kwargs  = eqn_kwargs
         self._bc_kwargs   = bc_kwargs
+        self._store       = store
         self.cf = CriticalFinder(self.solve_problem, CW)
 
     def find_crits(self, tol=1e-3, pts_per_curve=1000, 
-                   out_dir='./', out_file=None, load=False, exact=False):
+                   out_dir='./', out_file=None, load=False, exact=False,
+                   converge=False, converge_tol=1e-3, drift_tol=1e-6):
         """
         Steps through all tasks and solves eigenvalue problems for
         the specified parameters.  If no tasks are specified, only
@@ -98,6 +106,14 @@ class OnsetSolver:
             pts_per_curve   - # of points to use on interpolated critical curve
             out_dir         - Output directory of information files
             out_file        - Name of information file.  If None, auto generate.
+            load            - If True, resume from the grid file, solving only
+                              the points that are missing from it.
+            converge        - If True, refine the critical point at increasing
+                              resolution until it converges (see converge_crit)
+            converge_tol    - Relative tolerance for the resolution convergence
+            drift_tol       - Eigenvalue drift allowed between resolutions,
+                              relative to the eigenvalue separation, before a
+                              mode is considered spurious (see checked_growth)
         """
         self._data = dict()
 
@@ -110,8 +126,19 @@ class OnsetSolver:
         # If no tasks specified, set the atmospheric defaults,
         # find the crits, and store the curves
         self.atmo_kwargs = self._atmo_kwargs
+        if self.isotropic:
+            # Non-rotating problem only depends on k = sqrt(kx**2 + ky**2);
+            # search (Ra, k) and map back onto (kx, ky) afterwards.
+            kx_steps, ky_steps = self._kx_steps, self._ky_steps
+            k_steps = (np.sqrt(kx_steps[0]**2 + ky_steps[0]**2),
+                       np.sqrt(kx_steps[1]**2 + ky_steps[1]**2),
+                       kx_steps[2], kx_steps[3] or ky_steps[3])
+            logger.info('Isotropic 3D problem; searching (Ra, k) with k from {:.5g} to {:.5g}'.format(k_steps[0], k_steps[1]))
+            search_steps = (self._ra_steps, k_steps)
+        else:
+            search_steps = (self._ra_steps, self._kx_steps, self._ky_steps)
         mins, maxs, ns, logs = [],[],[],[]
-        for l in (self._ra_steps, self._kx_steps, self._ky_steps):
+        for l in search_steps:
             if type(l) == type(None):
                 continue
             mins.append(l[0])
@@ -120,17 +147,15 @@ class OnsetSolver:
             logs.append(l[3])
         mins, maxs = np.array(mins), np.array(maxs)
         ns, logs   = np.array(ns, dtype=np.int64), np.array(logs)
+        store = None
+        if self._store is not None and CW.rank == 0:
+            store = EigenStore(self._store, self.store_config())
+        grid = OnsetGrid(self.solve_problem, CW, mins, maxs, ns, logs=logs, store=store)
+        grid_file = '{:s}/{:s}.h5'.format(out_dir, out_file)
         if load:
-            try:
-                self.cf.load_grid('{:s}/{:s}.h5'.format(out_dir, out_file), logs=logs)
-            except:
-                self.cf.grid_generator(mins, maxs, ns, logs=logs)
-                if self.cf.comm.rank == 0:
-                    self.cf.save_grid('{:s}/{:s}'.format(out_dir, out_file))
-        else:
-            self.cf.grid_generator(mins, maxs, ns, logs=logs)
-            if self.cf.comm.rank == 0:
-                self.cf.save_grid('{:s}/{:s}'.format(out_dir, out_file))
+            grid.load(grid_file)
+        grid.solve(grid_file)
+        grid.attach(self.cf)
         self.cf.root_finder()
         if self.cf.comm.rank == 0:
             self.cf.plot_crit(title= '{:s}/{:s}'.format(out_dir, out_file), xlabel='kx', ylabel='Ra', transpose=True)
@@ -140,7 +165,13 @@ class OnsetSolver:
         else:
             crits = self.cf.crit_finder()
 
-        if len(crits) == 2:
+        if len(crits) == 2 and self.isotropic:
+            ra_crit, k_crit = crits
+            kx_crit, ky_crit = k_crit, 0
+            if self.cf.rank == 0:
+                logger.info('Critical value found at ra: {:.5g}, kx: {:.5g}, ky: {:.5g}, ktot = {:.5g}'.format(ra_crit, kx_crit, ky_crit, k_crit)) 
+                logger.info('(isotropic: any kx, ky with kx**2 + ky**2 = ktot**2 is equivalent)')
+        elif len(crits) == 2:
             ra_crit, kx_crit = crits
             if self.cf.rank == 0:
                 logger.info('Critical value found at ra: {:.5g}, kx: {:.5g}'.format(ra_crit, kx_crit)) 
@@ -149,11 +180,209 @@ class OnsetSolver:
             k_tot = np.sqrt(kx_crit**2 + ky_crit**2)
             if self.cf.rank == 0:
                 logger.info('Critical value found at ra: {:.5g}, kx: {:.5g}, ky: {:.5g}, ktot = {:.5g}'.format(ra_crit, kx_crit, ky_crit, k_tot)) 
+        if converge:
+            result = None
+            if self.cf.comm.rank == 0:
+                result = self.converge_crit(ra_crit, kx_crit, ky=ky_crit if len(crits) == 3 else 0,
+                                            tol=converge_tol, drift_tol=drift_tol, store=self._store)
+            ra_crit, kx_crit, nz_crit, converged = self.cf.comm.bcast(result, root=0)
+            if self.cf.rank == 0:
+                logger.info('{} critical value at ra: {:.8g}, kx: {:.8g} (resolution nz = {})'.format(
+                            'Converged' if converged else 'Unconverged', ra_crit, kx_crit, nz_crit))
         if self.cf.comm.rank == 0:
             self.cf.save_grid('{:s}/{:s}'.format(out_dir, out_file))
             self.cf.plot_crit(title= '{:s}/{:s}'.format(out_dir, out_file), xlabel='kx', ylabel='Ra', transpose=True)
-       
-    def solve_problem(self, ra, kx, ky=0):
+            if self.isotropic:
+                self.save_isotropic_grid('{:s}/{:s}_kxky'.format(out_dir, out_file))
+
+    def store_config(self, nz=None):
+        """
+        The problem configuration used to key results in the EigenStore.
+        Wavenumbers are stored in units of 2*pi/Lz, as passed to solve_problem.
+
+        Keyword Arguments:
+            nz  - Vertical resolution, if different from that in atmo_kwargs.
+        """
+        atmo_kwargs = dict(self.atmo_kwargs)
+        if nz is not None:
+            atmo_kwargs['nz'] = nz
+        eqn_kwargs = {k: v for k, v in self._eqn_kwargs.items() if k != 'ky'}
+        return {'eqn_set':     self._eqn_set,
+                'atmosphere':  self._atmosphere,
+                'threeD':      self.threeD,
+                'atmo_kwargs': atmo_kwargs,
+                'eqn_args':    list(self._eqn_args),
+                'eqn_kwargs':  eqn_kwargs,
+                'bc_kwargs':   self._bc_kwargs}
+
+    @property
+    def isotropic(self):
+        """
+        True if the problem is a non-rotating 3D search over kx and ky, in which
+        case the growth rate depends only on k = sqrt(kx**2 + ky**2).
+        """
+        return self.threeD and self._ky_steps is not None and \
+               self._eqn_kwargs.get('Taylor', None) is None
+
+    def save_isotropic_grid(self, filen):
+        """
+        Map a (Ra, k) grid from an isotropic search back onto the full
+        (Ra, kx, ky) grid requested, by interpolating growth rates in k, and
+        save it in the CriticalFinder.save_grid format.
+
+        Arguments:
+            filen   - File stem; the grid is saved to filen.h5
+        """
+        ra_grid, k_grid = self.cf.xyz_grids
+        ras, ks = ra_grid[:,0], k_grid[0,:]
+        kx_steps, ky_steps = self._kx_steps, self._ky_steps
+        axes = []
+        for l in (kx_steps, ky_steps):
+            if l[3]:
+                axes.append(np.logspace(np.log10(l[0]), np.log10(l[1]), int(l[2])))
+            else:
+                axes.append(np.linspace(l[0], l[1], int(l[2])))
+        xyz_grids = np.meshgrid(ras, *axes, indexing='ij')
+        k_tot = np.sqrt(xyz_grids[1][0]**2 + xyz_grids[2][0]**2)
+        k_log = self.cf.logs[1]
+        if k_log:
+            ks, k_tot = np.log10(ks), np.log10(k_tot)
+        grid = np.zeros(xyz_grids[0].shape, dtype=np.complex128)
+        for i in range(len(ras)):
+            grid[i] = np.interp(k_tot, ks, self.cf.grid[i].real, left=np.nan, right=np.nan) + \
+                   1j*np.interp(k_tot, ks, self.cf.grid[i].imag, left=np.nan, right=np.nan)
+        with h5py.File(filen+'.h5', 'w') as outfile:
+            outfile.create_dataset('grid', data=grid)
+            for i, g in enumerate(xyz_grids):
+                outfile.create_dataset('xyz_{}'.format(i), data=g)
+
+    @staticmethod
+    def _scale_nz(nz, factor):
+        """ Scale a (possibly compound, list-valued) z resolution by factor. """
+        if isinstance(nz, (list, tuple)):
+            return [int(np.ceil(n*factor)) for n in nz]
+        return int(np.ceil(nz*factor))
+
+    def checked_growth(self, ra, kx, ky=0, nz=None, nz_check=None, drift_tol=1e-6, store=None):
+        """
+        Growth rate of the fastest-growing mode that is resolved, i.e. whose
+        eigenvalue at nz is reproduced at the higher resolution nz_check.
+        Eigenvalues at nz whose nearest eigenvalue at nz_check differs by more
+        than drift_tol times their separation from the other eigenvalues at nz
+        (Boyd's nearest drift, see tools.linear_stability.eigenvalue_drift)
+        are discarded as spurious.  The separation, unlike the eigenvalue
+        itself, does not vanish at onset.
+
+        Arguments:
+            ra, kx, ky  - As in solve_problem
+            nz          - Base vertical resolution
+            nz_check    - Higher vertical resolution to compare against
+            drift_tol   - Maximum eigenvalue drift between resolutions, relative to the eigenvalue separation
+            store       - An EigenStore for this (nz, nz_check, drift_tol)
+        """
+        if store is not None:
+            value = store.get(ra, kx, ky)
+            if value is not None:
+                return value
+        evals = []
+        for n in (nz, nz_check):
+            self.solve_problem(ra, kx, ky=ky, nz=n)
+            ev = np.array(self.eigprob.solver.eigenvalues)
+            evals.append(ev[np.isfinite(ev)])
+        lo, hi = evals
+        value = np.nan
+        good = resolved_eigenvalues(lo, hi, drift_tol=drift_tol)
+        logger.debug('{}/{} eigenvalues resolved at ra {:.8g} / kx {:.8g} / ky {:.8g} / nz {}'.format(
+                     len(good), len(lo), ra, kx, ky, nz))
+        if len(good) > 0:
+            value = good[np.argmax(good.real)]
+        if store is not None:
+            store.put((ra, kx, ky), value)
+        return value
+
+    def _ra_crit(self, growth, ra_guess, kx, ky, max_expand=20):
+        """ Root of growth(ra, kx, ky) in Ra, bracketed outward from ra_guess. """
+        def f(ra):
+            g = growth(ra, kx, ky).real
+            return -1 if np.isnan(g) else g
+        lo, hi = ra_guess/1.5, ra_guess*1.5
+        f_lo, f_hi = f(lo), f(hi)
+        for i in range(max_expand):
+            if f_lo < 0 and f_hi > 0:
+                return opt.brentq(f, lo, hi, rtol=1e-10)
+            if f_lo >= 0:
+                hi, f_hi = lo, f_lo
+                lo = lo/2
+                f_lo = f(lo)
+            else:
+                lo, f_lo = hi, f_hi
+                hi = hi*2
+                f_hi = f(hi)
+        return np.nan
+
+    def converge_crit(self, ra_guess, kx_guess, ky=0, nz=None, tol=1e-3, drift_tol=1e-6,
+                      factor=1.5, max_levels=4, store=None):
+        """
+        Refine the critical point at successively higher resolutions until it
+        converges.  At each level nz, Ra_crit is found with a root finder and
+        minimized over kx (ky is held fixed), using only eigenvalues that are
+        reproduced at nz*factor.  Resolution is only increased while the
+        critical values change by more than tol between levels.
+
+        Arguments:
+            ra_guess, kx_guess  - Starting guesses (e.g., from the grid search)
+            ky                  - Fixed second wavenumber (3D only)
+            nz                  - Starting resolution.  If None, use atmo_kwargs['nz']
+            tol                 - Relative tolerance on Ra_crit and kx_crit
+            drift_tol           - Eigenvalue drift tolerance, see checked_growth
+            factor              - Resolution multiplier between levels
+            max_levels          - Maximum number of resolutions to try
+            store               - Path to an EigenStore database, or None
+
+        Returns:
+            ra_crit, kx_crit, nz_converged, converged
+                where nz_converged is the cheapest resolution whose critical
+                values agree with the next resolution to within tol.
+        """
+        if nz is None:
+            nz = self.atmo_kwargs['nz']
+        kx_min = self._kx_steps[0]
+        kx_max = np.sqrt(self._kx_steps[1]**2 + (self._ky_steps[1]**2 if self.isotropic else 0))
+
+        previous = None
+        for level in range(max_levels):
+            nz_check = self._scale_nz(nz, factor)
+            level_store = None
+            if store is not None:
+                config = self.store_config(nz=nz)
+                config['nz_check'], config['drift_tol'] = nz_check, drift_tol
+                # solves filtered by the drift relative to |eigenvalue| are not reused
+                config['drift'] = 'nearest'
+                level_store = EigenStore(store, config)
+            growth = lambda ra, kx, ky: self.checked_growth(ra, kx, ky, nz=nz, nz_check=nz_check,
+                                                            drift_tol=drift_tol, store=level_store)
+            guess = ra_guess if previous is None else previous[1]
+            ra_of_k = lambda kx: self._ra_crit(growth, guess, kx, ky)
+            k_guess = kx_guess if previous is None else previous[2]
+            bounds = (max(kx_min, k_guess/1.5), min(kx_max, k_guess*1.5))
+            result = opt.minimize_scalar(ra_of_k, bounds=bounds, method='bounded',
+                                         options={'xatol':tol*k_guess/10})
+            ra_crit, kx_crit = result.fun, result.x
+            logger.info('nz {} (checked against nz {}): ra_crit {:.8g}, kx_crit {:.8g}'.format(
+                        nz, nz_check, ra_crit, kx_crit))
+            if previous is not None:
+                dra = np.abs(ra_crit - previous[1])/np.abs(ra_crit)
+                dkx = np.abs(kx_crit - previous[2])/np.abs(kx_crit)
+                if dra < tol and dkx < tol:
+                    logger.info('converged: nz {} agrees with nz {} to within {:.2g} in Ra and {:.2g} in kx'.format(
+                                previous[0], nz, dra, dkx))
+                    return ra_crit, kx_crit, previous[0], True
+            previous = (nz, ra_crit, kx_crit)
+            nz = nz_check
+        logger.info('critical values not converged to {:.2g} by nz {}'.format(tol, previous[0]))
+        return previous[1], previous[2], previous[0], False
+
+    def solve_problem(self, ra, kx, ky=0, nz=None):
         """
         Given a horizontal wavenumber and Rayleigh number, create the specified
         atmosphere, solve an eigenvalue problem, and return information about 
@@ -163,23 +392,30 @@ class OnsetSolver:
             kx  - The horizontal wavenumber, in units of 2*pi/Lz, where Lz is the
                   depth of the atmosphere.
             ra  - The Rayleigh number to be used in solving the atmosphere.
+            ky  - The second horizontal wavenumber (3D only), in the same units
+                  as kx.  In isotropic searches kx is the total wavenumber and
+                  ky = 0.
+            nz  - The vertical resolution, if different from that in atmo_kwargs.
         """
+        atmo_kwargs = dict(self.atmo_kwargs)
+        if nz is not None:
+            atmo_kwargs['nz'] = nz
 
         if self._eqn_set == 0:
             if self._atmosphere == 0:
                 if self.threeD:
                     self.atmosphere = polytropes.FC_polytrope_3d(
                                        dimensions=1, comm=MPI.COMM_SELF, 
-                                       grid_dtype=np.complex128, **self.atmo_kwargs)
+                                       grid_dtype=np.complex128, **atmo_kwargs)
                     self._eqn_kwargs['ky'] = ky*2*np.pi/self.atmosphere.Lz
                 else:
                     self.atmosphere = polytropes.FC_polytrope_2d(
                                        dimensions=1, comm=MPI.COMM_SELF, 
-                                       grid_dtype=np.complex128, **self.atmo_kwargs)
+                                       grid_dtype=np.complex128, **atmo_kwargs)
             elif self._atmosphere == 1:
                 self.atmosphere = multitropes.FC_multitrope(
                                    dimensions=1, comm=MPI.COMM_SELF, 
-                                   grid_dtype=np.complex128, **self.atmo_kwargs)
+                                   grid_dtype=np.complex128, **atmo_kwargs)
         kx_real = kx*2*np.pi/self.atmosphere.Lz
 
         #Set the eigenvalue problem using the atmosphere
@@ -192,10 +428,9 @@ class OnsetSolver:
         self.eigprob = Eigenproblem(problem)
         max_val, gr_ind, freq = self.eigprob.growth_rate({})
         #Initialize atmosphere
-        if self.cf.rank == 0:
-            logger.info('Solving for onset with ra {:.8g} / kx {:.8g} / ky {:.8g} on proc 0'.\
-                    format(ra, kx, ky))
-            logger.info('Maximum eigenvalue found at those values: {:.8g}'.format(max_val))
+        logger.debug('Solving for onset with ra {:.8g} / kx {:.8g} / ky {:.8g} on proc {}'.\
+                format(ra, kx, ky, self.cf.rank))
+        logger.debug('Maximum eigenvalue found at those values: {:.8g}'.format(max_val))
         
 
         if not np.isnan(max_val):
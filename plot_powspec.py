@@ -34,7 +34,7 @@ def main(files, fields, output_path='./', output_name='powspec',
     rank = comm_world.rank
     size = comm_world.size
     
-    data = analysis.Coeff(files, power=True)
+    data = analysis.Coeff(files, power=True, pad=False)
     kz = data.kz/np.max(data.kz)
     kx = data.kx/np.max(np.abs(data.kx))
     logger.info("min max kx {} {}; shape: {}".format(min(kx), max(kx), kx.shape))
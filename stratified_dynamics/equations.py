@@ -4,6 +4,15 @@ import scipy.special as scp
 
 from collections import OrderedDict
 
+import os
+
+try:
+    from tools import output
+except:
+    from sys import path
+    path.insert(0, './tools')
+    from ..tools import output
+
 import logging
 logger = logging.getLogger(__name__.split('.')[-1])
 
@@ -16,6 +25,22 @@ class Equations():
         self.problem_type = ''
         pass
 
+    def add_file_handler(self, solver, base_path, storage=None, **kwargs):
+        """
+        Add an output file handler to the solver.
+
+        storage is a dictionary of HDF5 storage options (see
+        tools.output.StorageFileHandler) keyed by handler name (e.g.
+        'volumes' or 'coeffs'); handlers without an entry are stored as
+        usual.
+        """
+        options = {} if storage is None else storage.get(os.path.basename(os.path.normpath(base_path)))
+        if not options:
+            return solver.evaluator.add_file_handler(base_path, **kwargs)
+        handler = output.add_file_handler(solver, base_path, **options, **kwargs)
+        logger.info("{} output: {}".format(os.path.basename(os.path.normpath(base_path)), output.storage_summary(handler)))
+        return handler
+
     def _set_domain(self, nx=256, Lx=4,
                           ny=256, Ly=4,
                           nz=128, Lz=1,
@@ -468,7 +493,7 @@ class FC_equations(Equations):
 
         self.analysis_tasks = analysis_tasks = OrderedDict()
 
-        analysis_profile = solver.evaluator.add_file_handler(data_dir+"profiles", max_writes=max_writes, parallel=False,
+        analysis_profile = self.add_file_handler(solver, data_dir+"profiles", max_writes=max_writes, parallel=False,
                                                              mode=mode, **kwargs)
         analysis_profile.add_task("plane_avg(T1)", name="T1")
         analysis_profile.add_task("plane_avg(T_full)", name="T_full")
@@ -520,7 +545,7 @@ class FC_equations(Equations):
 
         analysis_tasks['profile'] = analysis_profile
 
-        analysis_scalar = solver.evaluator.add_file_handler(data_dir+"scalar", max_writes=max_writes, parallel=False,
+        analysis_scalar = self.add_file_handler(solver, data_dir+"scalar", max_writes=max_writes, parallel=False,
                                                             mode=mode, **kwargs)
         analysis_scalar.add_task("vol_avg(KE)", name="KE")
         analysis_scalar.add_task("vol_avg(PE)", name="PE")
@@ -547,7 +572,7 @@ class FC_equations(Equations):
         analysis_tasks['scalar'] = analysis_scalar
 
         if coeffs_output:
-            analysis_coeff = solver.evaluator.add_file_handler(data_dir+"coeffs", max_writes=max_writes, parallel=False,
+            analysis_coeff = self.add_file_handler(solver, data_dir+"coeffs", max_writes=max_writes, parallel=False,
                                                                mode=mode, **kwargs)
             analysis_coeff.add_task("s_fluc", name="s", layout='c')
             analysis_coeff.add_task("s_fluc - plane_avg(s_fluc)", name="s'", layout='c')
@@ -631,7 +656,7 @@ class FC_equations_2d(FC_equations):
 
         analysis_tasks = super().initialize_output(solver, data_dir, coeffs_output=coeffs_output, max_writes=max_writes, mode=mode, **kwargs)
         
-        analysis_slice = solver.evaluator.add_file_handler(data_dir+"slices", max_writes=max_writes, parallel=False,
+        analysis_slice = self.add_file_handler(solver, data_dir+"slices", max_writes=max_writes, parallel=False,
                                                             mode=mode, **kwargs)
         analysis_slice.add_task("s_fluc", name="s")
         analysis_slice.add_task("s_fluc - plane_avg(s_fluc)", name="s'")
@@ -817,7 +842,7 @@ class FC_equations_3d(FC_equations):
 
         analysis_tasks = super().initialize_output(solver, data_dir, coeffs_output=coeffs_output, max_writes=max_writes, mode=mode, **kwargs)
         
-        analysis_slice = solver.evaluator.add_file_handler(data_dir+"slices", max_writes=max_writes, parallel=False,
+        analysis_slice = self.add_file_handler(solver, data_dir+"slices", max_writes=max_writes, parallel=False,
                                                            mode=mode, **kwargs)
         analysis_slice.add_task("interp(s_fluc,                     y={})".format(self.Ly/2), name="s")
         analysis_slice.add_task("interp(s_fluc - plane_avg(s_fluc), y={})".format(self.Ly/2), name="s'")
@@ -834,7 +859,7 @@ class FC_equations_3d(FC_equations):
         analysis_tasks['slice'] = analysis_slice
 
         if volumes_output:
-            analysis_volume = solver.evaluator.add_file_handler(data_dir+"volumes", max_writes=max_writes, parallel=False, 
+            analysis_volume = self.add_file_handler(solver, data_dir+"volumes", max_writes=max_writes, parallel=False, 
                                                                 mode=mode, **kwargs)
             analysis_volume.add_task("enstrophy", name="enstrophy")
             analysis_volume.add_task("s_fluc+s_mean", name="s_tot")
@@ -1545,7 +1570,7 @@ class AN_equations(Equations):
         analysis_tasks = OrderedDict()
         self.analysis_tasks = analysis_tasks
         
-        analysis_slice = solver.evaluator.add_file_handler(data_dir+"slices", max_writes=max_writes, parallel=False, **kwargs)
+        analysis_slice = self.add_file_handler(solver, data_dir+"slices", max_writes=max_writes, parallel=False, **kwargs)
         analysis_slice.add_task("s", name="s")
         analysis_slice.add_task("s - plane_avg(s)", name="s'")
         analysis_slice.add_task("u", name="u")
@@ -1554,7 +1579,7 @@ class AN_equations(Equations):
         analysis_slice.add_task("vorticity", name="vorticity")
         analysis_tasks['slice'] = analysis_slice
         
-        analysis_profile = solver.evaluator.add_file_handler(data_dir+"profiles", max_writes=max_writes, parallel=False, **kwargs)
+        analysis_profile = self.add_file_handler(solver, data_dir+"profiles", max_writes=max_writes, parallel=False, **kwargs)
         analysis_profile.add_task("plane_avg(KE)", name="KE")
         analysis_profile.add_task("plane_avg(PE)", name="PE")
         analysis_profile.add_task("plane_avg(IE)", name="IE")
@@ -1588,7 +1613,7 @@ class AN_equations(Equations):
         
         analysis_tasks['profile'] = analysis_profile
 
-        analysis_scalar = solver.evaluator.add_file_handler(data_dir+"scalar", max_writes=max_writes, parallel=False, **kwargs)
+        analysis_scalar = self.add_file_handler(solver, data_dir+"scalar", max_writes=max_writes, parallel=False, **kwargs)
         analysis_scalar.add_task("vol_avg(KE)", name="KE")
         analysis_scalar.add_task("vol_avg(PE)", name="PE")
         analysis_scalar.add_task("vol_avg(IE)", name="IE")
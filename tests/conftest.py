@@ -0,0 +1,62 @@
+import os
+import sys
+
+import h5py
+import numpy as np
+import pytest
+
+# the drivers and tools are run from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class OutputSets:
+    """
+    Writes the per-process files of file handler sets as dedalus does, for a
+    distributed task 'u' of shape (6, 4), split along its first axis, and a
+    task 'u_mean' constant along it.  The data of each write is a function of
+    its write number, so joined data can be checked against global_data.
+    """
+    shapes = {'u': (6, 4), 'u_mean': (1, 4)}
+
+    def __init__(self, base_path, writes=3):
+        self.base_path = base_path
+        self.writes = writes
+
+    def global_data(self, name, set_num):
+        write_numbers = (set_num - 1)*self.writes + np.arange(self.writes)
+        shape = self.shapes[name]
+        return write_numbers[:, None, None] + np.arange(np.prod(shape)).reshape(shape)/100
+
+    def write(self, set_num, splits=(0, 2, 6)):
+        """Process files of set set_num, the first axis of u split at splits."""
+        self.base_path.mkdir(exist_ok=True)
+        stem = '{}_s{:d}'.format(self.base_path.name, set_num)
+        set_path = self.base_path/stem
+        set_path.mkdir()
+        for p, (x_start, x_end) in enumerate(zip(splits[:-1], splits[1:])):
+            with h5py.File(str(set_path/'{}_p{:d}.h5'.format(stem, p)), 'w') as file:
+                file.attrs['set_number'] = set_num
+                file.attrs['handler_name'] = self.base_path.name
+                file.attrs['writes'] = self.writes
+                scales = file.create_group('scales')
+                write_numbers = (set_num - 1)*self.writes + np.arange(self.writes)
+                scales.create_dataset('write_number', data=write_numbers + 1)
+                scales.create_dataset('sim_time', data=0.1*write_numbers)
+                scales.create_dataset('iteration', data=10*write_numbers)
+                tasks = file.create_group('tasks')
+                blocks = {'u':      ((x_start, 0), (x_end - x_start, 4)),
+                          'u_mean': ((0, 0), (1, 4))}
+                for task_number, (name, (start, count)) in enumerate(blocks.items()):
+                    block = tuple(slice(s, s + c) for s, c in zip(start, count))
+                    dset = tasks.create_dataset(name, data=self.global_data(name, set_num)[(slice(None),) + block])
+                    dset.attrs['task_number'] = task_number
+                    dset.attrs['constant'] = np.array([name == 'u_mean', False])
+                    dset.attrs['grid_space'] = np.array([True, True])
+                    dset.attrs['scales'] = np.array([1., 1.])
+                    dset.attrs['start'] = np.array(start)
+                    dset.attrs['count'] = np.array(count)
+                    dset.attrs['global_shape'] = np.array(self.shapes[name])
+        return set_path
+
+@pytest.fixture
+def output_sets(tmp_path):
+    return OutputSets(tmp_path/'slices')
@@ -0,0 +1,85 @@
+"""
+Reading unjoined output sets with ProcessCheckpoint, on process files written
+here the way dedalus writes them: each task dataset holds the process's block
+of the global data, described by its start, count and global_shape attrs.
+"""
+import h5py
+import numpy as np
+import pytest
+from mpi4py import MPI
+
+from tools.checkpointing import ProcessCheckpoint, JoinedCheckpoint, checkpoint_source
+
+N_WRITES = 2
+# global data of each task, without the write axis
+SHAPES = {'u': (8, 6), 'ln_rho0': (1, 6)}
+
+def global_data(name):
+    shape = (N_WRITES,) + SHAPES[name]
+    return np.arange(np.prod(shape), dtype=np.float64).reshape(shape)
+
+def write_set(tmp_path, x_splits=(0, 3, 3, 8)):
+    """Process files of set checkpoint_s1, distributed in x as x_splits
+    (process 1 holds nothing); ln_rho0 is constant in x, so every process
+    holds all of it."""
+    set_path = tmp_path/'checkpoint_s1'
+    set_path.mkdir()
+    for p, (x_start, x_end) in enumerate(zip(x_splits[:-1], x_splits[1:])):
+        with h5py.File(str(set_path/'checkpoint_s1_p{:d}.h5'.format(p)), 'w') as file:
+            tasks = file.create_group('tasks')
+            file.create_group('scales')
+            blocks = {'u':      ((x_start, 0), (x_end - x_start, 6)),
+                      'ln_rho0': ((0, 0), (1, 6))}
+            # h5py lists tasks by name, so ln_rho0 is the first task of each file
+            for name in ['u', 'ln_rho0']:
+                start, count = blocks[name]
+                block = tuple(slice(s, s + c) for s, c in zip(start, count))
+                dset = tasks.create_dataset(name, data=global_data(name)[(slice(None),) + block])
+                dset.attrs['start'] = np.array(start)
+                dset.attrs['count'] = np.array(count)
+                dset.attrs['global_shape'] = np.array(SHAPES[name])
+    return set_path
+
+@pytest.fixture
+def source(tmp_path):
+    with ProcessCheckpoint(write_set(tmp_path), MPI.COMM_WORLD) as source:
+        yield source
+
+def test_shapes_per_task(source):
+    assert source.shape('u') == SHAPES['u']
+    assert source.shape('ln_rho0') == SHAPES['ln_rho0']
+
+@pytest.mark.parametrize('name, slices', [
+    ('u', (slice(0, 8), slice(0, 6))),
+    ('u', (slice(2, 5), slice(1, 4))),   # overlaps processes 0 and 2
+    ('u', (slice(4, 6), slice(0, 6))),   # within process 2
+    ('ln_rho0', (slice(0, 1), slice(2, 6))),
+])
+def test_read_slices(source, name, slices):
+    for index in range(N_WRITES):
+        expected = global_data(name)[(index,) + slices]
+        assert np.array_equal(source.read_slices(name, index, slices), expected)
+
+def test_read_indices(source):
+    # indices along the leading axes; the last axis is read whole
+    indices = [np.array([1, 2, 3, 7])]
+    expected = global_data('u')[1][indices[0]]
+    assert np.array_equal(source.read('u', 1, indices), expected)
+
+def test_checkpoint_source_of_process_file(tmp_path):
+    set_path = write_set(tmp_path)
+    with checkpoint_source(set_path/'checkpoint_s1_p0.h5', MPI.COMM_WORLD) as source:
+        assert isinstance(source, ProcessCheckpoint)
+        assert len(source.process_paths) == 3
+
+def test_read_no_local_indices(source, tmp_path):
+    # a process whose part of the new layout is empty gets an empty array, as from a joined file
+    indices = [np.array([], dtype=int)]
+    with h5py.File(str(tmp_path/'joined.h5'), 'w') as file:
+        file.create_dataset('tasks/u', data=global_data('u'))
+    with JoinedCheckpoint(tmp_path/'joined.h5') as joined:
+        expected = joined.read('u', 1, indices)
+    data = source.read('u', 1, indices)
+    assert isinstance(data, np.ndarray)
+    assert data.shape == expected.shape == (0, 6)
+    assert data.dtype == expected.dtype
@@ -0,0 +1,73 @@
+"""
+Cropping coefficient output to its lowest modes, and padding it back for
+analysis, with stand-ins for the dedalus bases.
+"""
+import h5py
+import numpy as np
+import pytest
+
+pytest.importorskip('dedalus')
+from tools.output import crop_indices, runs
+from tools.analysis import crop_kept, uncrop
+
+class Basis:
+    def __init__(self, coeff_size, element_label='k', grid_dtype=np.float64):
+        self.coeff_size = coeff_size
+        self.element_label = element_label
+        self.grid_dtype = grid_dtype
+
+class Compound:
+    element_label = 'T'
+    def __init__(self, *subbases):
+        self.subbases = subbases
+
+def test_real_fourier():
+    assert list(crop_indices(Basis(16), 16, 5)) == [0, 1, 2, 3, 4]
+
+def test_complex_fourier():
+    indices = crop_indices(Basis(12, grid_dtype=np.complex128), 12, 3)
+    assert list(indices) == [0, 1, 2, 10, 11]
+    assert runs(indices) == [(0, 3), (10, 2)]
+
+def test_chebyshev():
+    assert list(crop_indices(Basis(32, element_label='T'), 32, 8)) == list(range(8))
+
+def test_compound():
+    basis = Compound(Basis(8, element_label='T'), Basis(4, element_label='T'), Basis(16, element_label='T'))
+    indices = crop_indices(basis, 28, 6)
+    assert list(indices) == list(range(6)) + [8, 9, 10, 11] + list(range(12, 18))
+    assert runs(indices) == [(0, 6), (8, 10)]
+
+def test_modes_beyond_size():
+    assert list(crop_indices(Basis(4), 4, 10)) == [0, 1, 2, 3]
+
+def test_uncrop(tmp_path):
+    x_basis = Basis(12, grid_dtype=np.complex128)
+    z_basis = Compound(Basis(8, element_label='T'), Basis(8, element_label='T'))
+    full_shape = (12, 16)
+    kept = [crop_indices(x_basis, 12, 4), crop_indices(z_basis, 16, 5)]
+    rng = np.random.default_rng(42)
+    full = rng.standard_normal((3,) + full_shape)
+    mask = np.zeros(full_shape, dtype=bool)
+    mask[np.ix_(*kept)] = True
+    full[:, ~mask] = 0
+
+    with h5py.File(str(tmp_path/'coeffs_s1.h5'), 'w') as file:
+        dset = file.create_dataset('T', data=full[np.ix_(np.arange(3), *kept)])
+        dset.attrs['crop_full_shape'] = full_shape
+        for axis, axis_kept in enumerate(kept):
+            dset.attrs['crop_kept_{:d}'.format(axis)] = axis_kept
+        file.create_dataset('uncropped', data=full)
+    with h5py.File(str(tmp_path/'coeffs_s1.h5'), 'r') as file:
+        dset_kept, dset_full_shape = crop_kept(file['T'])
+        assert dset_full_shape == full_shape
+        assert np.array_equal(uncrop(file['T'][:], dset_kept, dset_full_shape), full)
+        assert crop_kept(file['uncropped']) == (None, None)
+
+def test_uncrop_partial_axes():
+    # only the last axis cropped
+    data = np.ones((2, 4, 3))
+    full = uncrop(data, [None, np.array([0, 1, 5])], (4, 8))
+    assert full.shape == (2, 4, 8)
+    assert np.all(full[..., [0, 1, 5]] == 1)
+    assert np.all(full[..., [2, 3, 4, 6, 7]] == 0)
@@ -0,0 +1,57 @@
+"""
+EigenStore round trips, and reuse of stored points by OnsetGrid.
+"""
+import numpy as np
+from mpi4py import MPI
+
+from tools.eigen_store import EigenStore
+from tools.onset_grid import OnsetGrid
+
+CONFIG = {'atmosphere': 'FC_polytrope', 'nz': 32, 'n_rho': np.float64(3.0)}
+
+def test_round_trip(tmp_path):
+    store = EigenStore(tmp_path/'eigen.db', CONFIG)
+    assert store.get(1e4, 0.5) is None
+    store.put((1e4, 0.5), 1.5 - 2j)
+    store.put((1e4, 0.5, 0.25), -3 + 0j)
+    assert store.get(1e4, 0.5) == 1.5 - 2j
+    assert store.get(1e4, 0.5, 0.25) == -3
+    assert len(store) == 2
+    assert (store.hits, store.misses) == (2, 1)
+
+def test_nan_round_trip(tmp_path):
+    store = EigenStore(tmp_path/'eigen.db', CONFIG)
+    store.put((1e4, 0.5), complex(np.nan, np.nan))
+    value = store.get(1e4, 0.5)
+    assert value is not None and np.isnan(value.real) and np.isnan(value.imag)
+
+def test_precision(tmp_path):
+    store = EigenStore(tmp_path/'eigen.db', CONFIG, precision=6)
+    store.put((1e4, 0.5), 1 + 0j)
+    assert store.get(1e4*(1 + 1e-9), 0.5) == 1
+    assert store.get(1e4*(1 + 1e-4), 0.5) is None
+
+def test_config_isolation(tmp_path):
+    filename = tmp_path/'eigen.db'
+    EigenStore(filename, CONFIG).put((1e4, 0.5), 1 + 0j)
+    assert EigenStore(filename, CONFIG).get(1e4, 0.5) == 1
+    other = EigenStore(filename, dict(CONFIG, nz=64))
+    assert other.get(1e4, 0.5) is None
+    assert len(other) == 0
+
+def test_onset_grid_reuses_store(tmp_path):
+    store = EigenStore(tmp_path/'eigen.db', CONFIG)
+    calls = []
+    def func(ra, kx):
+        calls.append((ra, kx))
+        return complex(ra - kx**2, kx)
+    def grid():
+        return OnsetGrid(func, MPI.COMM_WORLD, (1, 0.5), (10, 2), (3, 4), store=store)
+    first = grid()
+    first.solve(str(tmp_path/'first.h5'))
+    assert len(calls) == 12 and len(store) == 12
+    second = grid()
+    second.solve(str(tmp_path/'second.h5'))
+    assert len(calls) == 12
+    assert np.all(second.done)
+    assert np.allclose(second.grid, first.grid)
@@ -0,0 +1,42 @@
+"""
+Sharing the processes of an ensemble between its runs.
+"""
+import itertools
+
+import numpy as np
+import pytest
+
+from FC_ensemble import balance
+
+def test_proportional_to_cost():
+    assert list(balance([4, 2, 2], [16, 16, 16], 16)) == [8, 4, 4]
+
+def test_minimizes_largest_load():
+    costs = np.array([3, 1, 7, 2])
+    sizes = balance(costs, [64]*4, 17)
+    assert np.sum(sizes) == 17
+    best = min(np.max(costs/np.array(split))
+               for split in itertools.product(range(1, 15), repeat=4) if sum(split) == 17)
+    assert np.max(costs/sizes) == pytest.approx(best)
+
+def test_minimum_one_process():
+    assert list(balance([1000, 1e-3, 1e-3], [64]*3, 5)) == [3, 1, 1]
+
+def test_caps():
+    sizes = balance([100, 1], [4, 8], 10)
+    assert list(sizes) == [4, 6]
+
+def test_leftover_processes_unassigned():
+    assert list(balance([1, 1], [2, 3], 10)) == [2, 3]
+
+def test_fixed():
+    sizes = balance([1, 100, 1], [5, 16, 16], 12, fixed=np.array([True, False, False]))
+    assert sizes[0] == 5
+    assert np.sum(sizes) == 12
+    assert sizes[1] > sizes[2]
+
+def test_too_few_processes():
+    with pytest.raises(ValueError):
+        balance([1, 1, 1], [4, 4, 4], 2)
+    with pytest.raises(ValueError):
+        balance([1, 1], [6, 4], 6, fixed=np.array([True, False]))
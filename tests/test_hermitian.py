@@ -0,0 +1,160 @@
+"""
+Measuring the Hermitian drift of the kx=0 modes, with stand-ins for the
+dedalus state fields and their (possibly ky-distributed) coefficient layouts.
+"""
+import numpy as np
+import pytest
+from mpi4py import MPI
+
+from tools.hermitian import HermitianMonitor
+
+class Layout:
+    def __init__(self, start, global_shape, grid_space=False):
+        self._start = np.array(start)
+        self._global_shape = tuple(global_shape)
+        self.grid_space = [grid_space]*len(global_shape)
+
+    def start(self, scales):
+        return self._start
+
+    def global_shape(self, scales):
+        return self._global_shape
+
+class Field:
+    """Local block of global coefficient data, starting at start."""
+    def __init__(self, data, start=None, grid_space=False):
+        global_shape = data.shape
+        if start is None:
+            start = (0,)*data.ndim
+        self.data = data[tuple(slice(s, None) for s in start)]
+        self.layout = Layout(start, global_shape, grid_space=grid_space)
+        self.scales = 1
+        self.domain = Domain(data.ndim)
+        self.projected = False
+
+    def slab(self, ky_start, ky_stop):
+        """This field's block holding ky_start <= ky < ky_stop (and all kx, z)."""
+        field = Field(self.data, start=(0, ky_start, 0))
+        field.data = self.data[:, ky_start:ky_stop]
+        return field
+
+    def require_grid_space(self):
+        self.projected = True
+
+class Domain:
+    def __init__(self, dim):
+        self.dim = dim
+        self.dist = Dist()
+
+class Dist:
+    comm_cart = MPI.COMM_WORLD
+
+class State:
+    def __init__(self, fields):
+        self.fields = fields
+
+class Solver:
+    def __init__(self, fields):
+        self.state = State(fields)
+        self.domain = fields[0].domain
+        self.iteration = 0
+
+def hermitian_3d(n_kx=3, n_ky=8, n_z=5, seed=1):
+    """Coefficients of real grid data: the kx=0 plane has c(-ky) = conj(c(ky))."""
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal((n_kx, n_ky, n_z)) + 1j*rng.standard_normal((n_kx, n_ky, n_z))
+    plane = data[0]
+    for ky in range(n_ky):
+        plane[(-ky) % n_ky] = np.conj(plane[ky])
+    plane[0] = plane[0].real
+    plane[n_ky//2] = plane[n_ky//2].real
+    return data
+
+def hermitian_2d(n_kx=3, n_z=5, seed=1):
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal((n_kx, n_z)) + 1j*rng.standard_normal((n_kx, n_z))
+    data[0] = data[0].real
+    return data
+
+def monitor(*fields, threshold=1e-10):
+    return HermitianMonitor(Solver(list(fields)), threshold=threshold)
+
+@pytest.mark.parametrize('data', [hermitian_3d(), hermitian_2d()])
+def test_hermitian_field(data):
+    hermitian = monitor(Field(data))
+    assert hermitian.drift() == pytest.approx(0, abs=1e-15)
+    assert not hermitian.check()
+
+def test_drift_3d():
+    data = hermitian_3d()
+    # an anti-Hermitian perturbation of the ky = 3, -3 pair
+    perturbation = 1e-6*(1 + 2j)*np.ones(5)
+    data[0, 3] += perturbation
+    data[0, -3] -= np.conj(perturbation)
+    total = np.sum(np.abs(data[0])**2)
+    # each mode of the pair has anti-Hermitian part perturbation
+    expected = np.sqrt(2*np.sum(np.abs(perturbation)**2)/total)
+    hermitian = monitor(Field(data))
+    assert hermitian.drift() == pytest.approx(expected)
+    assert hermitian.check()
+    assert hermitian.max_drift == pytest.approx(expected)
+    assert not monitor(Field(data), threshold=2*expected).check()
+
+def test_drift_2d():
+    # the drift is relative to the kx=0 modes of all the state fields
+    data, other = hermitian_2d(), hermitian_2d(seed=2)
+    data[0, 2] += 1e-5j
+    total = np.sum(np.abs(data[0])**2) + np.sum(np.abs(other[0])**2)
+    hermitian = monitor(Field(data), Field(other))
+    assert hermitian.drift() == pytest.approx(np.sqrt(1e-10/total))
+    assert hermitian.check()
+
+def test_project():
+    data = hermitian_2d()
+    data[0, 0] += 1j
+    field = Field(data)
+    hermitian = monitor(field)
+    if hermitian.check():
+        hermitian.project()
+    assert field.projected and hermitian.projections == 1
+
+def test_skips_grid_space_and_other_kx():
+    data = hermitian_3d()
+    data[0, 1] += 1j
+    hermitian = monitor(Field(data))
+    assert hermitian._local_sums(Field(data, grid_space=True)) == (0., 0.)
+    # a process without the kx=0 modes
+    assert hermitian._local_sums(Field(data, start=(1, 0, 0))) == (0., 0.)
+
+def brute_force_sums(data, ky_start, ky_stop):
+    """Sums over the ky of a slab whose partner -ky is in the slab too."""
+    n_ky = data.shape[1]
+    anti_hermitian, total = 0., 0.
+    for ky in range(ky_start, ky_stop):
+        partner = (-ky) % n_ky
+        if ky_start <= partner < ky_stop:
+            anti_hermitian += np.sum(np.abs(0.5*(data[0, ky] - np.conj(data[0, partner])))**2)
+            total += np.sum(np.abs(data[0, ky])**2)
+    return anti_hermitian, total
+
+@pytest.mark.parametrize('ky_start, ky_stop', [(0, 4), (4, 8), (2, 6), (0, 8), (3, 5)])
+def test_distributed_ky(ky_start, ky_stop):
+    data = hermitian_3d()
+    data[0, 1] += 1e-3j        # partner 7
+    data[0, 4] += 1e-3j        # the Nyquist mode, its own partner
+    data[0, 5] += 1e-3         # partner 3
+    field = Field(data).slab(ky_start, ky_stop)
+    hermitian = monitor(field)
+    assert np.allclose(hermitian._local_sums(field), brute_force_sums(data, ky_start, ky_stop))
+
+def test_distributed_ky_off_process_partners():
+    data = hermitian_3d()
+    # the ky = 1, 7 pair is split between the two slabs, and not measured
+    data[0, 1] += 1e-3j
+    slabs = [Field(data).slab(0, 4), Field(data).slab(4, 8)]
+    hermitian = monitor(*slabs)
+    assert [hermitian._local_sums(slab)[0] for slab in slabs] == pytest.approx([0, 0], abs=1e-20)
+    # ky = 4 is its own partner (the slabs are views of data)
+    data[0, 4] += 1e-3j
+    assert hermitian._local_sums(slabs[1])[0] == pytest.approx(5*1e-6)
+    assert hermitian.check()
@@ -0,0 +1,93 @@
+"""
+Finding the sets a running file handler has closed, and joining them.
+"""
+import os
+import time
+import shutil
+
+import h5py
+import numpy as np
+import pytest
+
+pytest.importorskip('dedalus')
+from tools import output
+
+def names(set_paths):
+    return [set_path.name for set_path in set_paths]
+
+def test_closed_sets(output_sets):
+    assert output.closed_sets(output_sets.base_path) == []
+    output_sets.write(1)
+    # the only set may still be written by any process
+    assert output.closed_sets(output_sets.base_path) == []
+    output_sets.write(2, splits=(0, 2))
+    # one process has moved on to set 2; the other may still write set 1
+    assert output.closed_sets(output_sets.base_path) == []
+    shutil.rmtree(str(output_sets.base_path/'slices_s2'))
+    output_sets.write(2)
+    assert names(output.closed_sets(output_sets.base_path)) == ['slices_s1']
+    output_sets.write(3)
+    assert names(output.closed_sets(output_sets.base_path)) == ['slices_s1', 'slices_s2']
+
+def test_join_closed_set(output_sets):
+    set_path = output_sets.write(1)
+    assert not output.is_joined(set_path)
+    output.merge_process_files_single_set(set_path)
+    assert output.is_joined(set_path)
+    with h5py.File(str(output.joined_path(set_path)), 'r') as file:
+        for name in output_sets.shapes:
+            assert np.array_equal(file['tasks'][name][:], output_sets.global_data(name, 1))
+        assert file.attrs['joined_processes'] == 2
+
+def test_is_joined_after_later_write(output_sets):
+    set_path = output_sets.write(1)
+    output.merge_process_files_single_set(set_path)
+    # a process file written after the join
+    later = time.time() + 10
+    os.utime(str(output.process_files(set_path)[0]), (later, later))
+    assert not output.is_joined(set_path)
+
+def test_is_joined_incomplete(output_sets):
+    set_path = output_sets.write(1)
+    output.merge_process_files_single_set(set_path)
+    # a join interrupted before it was marked complete
+    with h5py.File(str(output.joined_path(set_path)), 'r+') as file:
+        del file.attrs['joined_processes']
+    assert not output.is_joined(set_path)
+
+def test_streaming_joiner_poll(output_sets, tmp_path):
+    output_sets.write(1)
+    output_sets.write(2)
+    joiner = output.StreamingJoiner(tmp_path, [output_sets.base_path])
+    assert joiner.poll() == 1
+    assert output.is_joined(output_sets.base_path/'slices_s1')
+    # already joined
+    assert joiner.poll() == 0
+    output_sets.write(3)
+    assert joiner.poll() == 1
+    assert joiner.sets == 2
+
+def test_streaming_joiner_set_removed(output_sets, tmp_path, monkeypatch):
+    for set_num in (1, 2, 3):
+        output_sets.write(set_num)
+    merge_data = output.merge_data
+    def pruned_merge_data(joint_file, proc_path, **kw):
+        # the run deletes set 1 (as Checkpoint.prune does) while it is being joined
+        if proc_path.parent.name == 'slices_s1':
+            shutil.rmtree(str(proc_path.parent))
+        return merge_data(joint_file, proc_path, **kw)
+    monkeypatch.setattr(output, 'merge_data', pruned_merge_data)
+    joiner = output.StreamingJoiner(tmp_path, [output_sets.base_path])
+    assert joiner.poll() == 1
+    assert not output.joined_path(output_sets.base_path/'slices_s1').exists()
+    assert output.is_joined(output_sets.base_path/'slices_s2')
+
+def test_streaming_joiner_join_error(output_sets, tmp_path, monkeypatch):
+    output_sets.write(1)
+    output_sets.write(2)
+    def failing_merge_data(joint_file, proc_path, **kw):
+        raise OSError("disk full")
+    monkeypatch.setattr(output, 'merge_data', failing_merge_data)
+    # errors on sets that are still there are not hidden
+    with pytest.raises(OSError):
+        output.StreamingJoiner(tmp_path, [output_sets.base_path]).poll()
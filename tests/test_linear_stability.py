@@ -0,0 +1,131 @@
+"""
+Eigenvalue drift filter, on a Chebyshev collocation problem with a known
+onset: u'' + ra*u = lambda*u with u(0) = u(pi) = 0, whose resolved
+eigenvalues are lambda_n = ra - n**2, so the first mode grows for ra > 1.
+Also the kx splitting of the eigenproblem matrices and the critical
+Rayleigh number interpolation.
+"""
+import numpy as np
+import pytest
+import scipy.linalg
+import scipy.sparse
+from mpi4py import MPI
+from scipy import optimize
+
+pytest.importorskip('scipy.linalg')
+from tools.linear_stability import eigenvalue_drift, resolved_eigenvalues, kx_matrices, growth_rate, critical_rayleigh
+
+def chebyshev_eigenvalues(ra, n):
+    """Eigenvalues on n+1 Gauss-Lobatto points, boundary rows removed."""
+    x = np.cos(np.pi*np.arange(n+1)/n)
+    c = np.hstack([2, np.ones(n-1), 2])*(-1)**np.arange(n+1)
+    dx = x[:,None] - x[None,:]
+    D = np.outer(c, 1/c)/(dx + np.eye(n+1))
+    D -= np.diag(D.sum(axis=1))
+    # map [-1, 1] to [0, pi]
+    D2 = (D @ D)[1:-1, 1:-1]*(2/np.pi)**2
+    return np.linalg.eigvals(D2 + ra*np.eye(n-1))
+
+def growth(ra, drift_tol=1e-6):
+    good = resolved_eigenvalues(chebyshev_eigenvalues(ra, 24), chebyshev_eigenvalues(ra, 36), drift_tol=drift_tol)
+    return np.max(good.real) if len(good) else np.nan
+
+def test_resolves_low_modes_only():
+    lo, hi = chebyshev_eigenvalues(5., 24), chebyshev_eigenvalues(5., 36)
+    good = np.sort(resolved_eigenvalues(lo, hi).real)[::-1]
+    assert len(good) < len(lo)
+    assert np.allclose(good[:4], 5 - np.arange(1, 5)**2)
+
+@pytest.mark.parametrize('ra', [1 - 1e-9, 1., 1 + 1e-9, 1.5])
+def test_keeps_mode_at_onset(ra):
+    # the critical eigenvalue is ~0 here, so a drift relative to it would discard it
+    unfiltered = np.max(chebyshev_eigenvalues(ra, 24).real)
+    assert growth(ra) == pytest.approx(unfiltered, abs=1e-9)
+
+def test_onset_root():
+    ra_crit = optimize.brentq(growth, 0.5, 2, rtol=1e-12)
+    assert ra_crit == pytest.approx(1, rel=1e-9)
+
+def test_single_eigenvalue():
+    assert eigenvalue_drift([2.], [2. + 1e-9])[0] == pytest.approx(5e-10)
+    assert len(resolved_eigenvalues([], [1.])) == 0
+
+class Pencil:
+    def __init__(self, M, L):
+        self.M, self.L = M, L
+
+    def build_matrices(self, problem, names):
+        self.M_exp, self.L_exp = scipy.sparse.csr_matrix(self.M), scipy.sparse.csr_matrix(self.L)
+
+class Atmosphere:
+    """Stand-in atmosphere whose eigenproblem matrices are quadratic in kx."""
+    def __init__(self, n=6, seed=3):
+        rng = np.random.default_rng(seed)
+        self.M = rng.standard_normal((n, n))
+        self.A, self.B, self.C = (rng.standard_normal((n, n)) for i in range(3))
+
+    def L(self, ra, kx):
+        return ra*self.A + kx*self.B + kx**2*self.C
+
+    def set_eigenvalue_problem(self, ra, Prandtl, kx=0):
+        self.ra, self.kx = ra, kx
+
+    def set_BC(self, **kwargs):
+        pass
+
+    def get_problem(self):
+        return self
+
+    def build_solver(self):
+        self.pencils = [Pencil(self.M, self.L(self.ra, self.kx))]
+        self.problem = self
+        return self
+
+def test_kx_matrices_split():
+    atmosphere = Atmosphere()
+    M, L0, L1, L2 = kx_matrices(atmosphere, 2., 1)
+    assert np.allclose(M, atmosphere.M)
+    for kx in (0.3, 1.7, -2.5):
+        assert np.allclose(L0 + kx*L1 + kx**2*L2, atmosphere.L(2., kx))
+        evals = scipy.linalg.eigvals(atmosphere.L(2., kx), b=-atmosphere.M)
+        assert growth_rate(M, L0, L1, L2, kx) == pytest.approx(evals[np.argmax(evals.real)])
+
+def test_kx_matrices_polytrope():
+    pytest.importorskip('dedalus.public')
+    from stratified_dynamics import polytropes
+    atmosphere = polytropes.FC_polytrope_2d(dimensions=1, comm=MPI.COMM_SELF, grid_dtype=np.complex128,
+                                            nz=16, n_rho_cz=1, epsilon=0.5)
+    bc_kwargs = {'fixed_temperature': True, 'stress_free': True}
+    M, L0, L1, L2 = kx_matrices(atmosphere, 1e3, 1, bc_kwargs=bc_kwargs)
+    for kx in (0.3, 1.7, -2.5):
+        atmosphere.set_eigenvalue_problem(1e3, 1, kx=kx)
+        atmosphere.set_BC(**bc_kwargs)
+        solver = atmosphere.get_problem().build_solver()
+        pencil = solver.pencils[0]
+        pencil.build_matrices(solver.problem, ['M', 'L'])
+        assert np.allclose(pencil.M_exp.toarray(), M)
+        assert np.allclose(pencil.L_exp.toarray(), L0 + kx*L1 + kx**2*L2)
+
+def test_critical_rayleigh():
+    ra = np.logspace(1, 5, 17)
+    ra_crit = np.array([1e3, 3.7e2, 2e4])
+    # growth linear in log Ra, so the interpolation is exact
+    growth = np.log10(ra)[:,None] - np.log10(ra_crit)[None,:]
+    assert np.allclose(critical_rayleigh(ra, growth), ra_crit)
+
+def test_critical_rayleigh_no_onset():
+    ra = np.logspace(1, 5, 17)
+    growth = np.stack([-np.ones(17),                    # stable throughout
+                       np.ones(17),                     # unstable throughout: no sign change
+                       np.log10(ra) - 3,                # onset on a grid point
+                       np.where(ra < 1e4, -1., 1.)],    # onset between points
+                      axis=1)
+    ra_crit = critical_rayleigh(ra, growth)
+    assert np.isnan(ra_crit[0]) and np.isnan(ra_crit[1])
+    assert ra_crit[2] == pytest.approx(1e3)
+    assert 10**3.75 < ra_crit[3] < 1e4
+
+def test_critical_rayleigh_first_crossing():
+    ra = np.logspace(1, 5, 5)
+    growth = np.array([-1., 1., -1., 1., 1.])[:,None]
+    assert critical_rayleigh(ra, growth)[0] == pytest.approx(10**1.5)
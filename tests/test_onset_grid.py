@@ -0,0 +1,76 @@
+"""
+Resuming OnsetGrid solves from partial grid files, serially.
+"""
+import h5py
+import numpy as np
+import pytest
+from mpi4py import MPI
+
+from tools.onset_grid import OnsetGrid
+
+def growth(ra, kx):
+    return complex(ra - kx**2, kx)
+
+class Interrupted(Exception):
+    pass
+
+def interrupted_after(n_points):
+    """growth, stopping the run (as if at walltime) after n_points solves."""
+    calls = []
+    def func(*values):
+        if len(calls) == n_points:
+            raise Interrupted
+        calls.append(values)
+        return growth(*values)
+    return func, calls
+
+def new_grid(func, dims=(3, 4), maxs=(10, 2)):
+    return OnsetGrid(func, MPI.COMM_WORLD, (1, 0.5), maxs, dims, logs=(True, False))
+
+def expected(grid):
+    return np.vectorize(growth)(*grid.xyz_grids)
+
+def test_resume_partial_grid(tmp_path):
+    filename = str(tmp_path/'grid.h5')
+    func, calls = interrupted_after(5)
+    with pytest.raises(Interrupted):
+        new_grid(func).solve(filename)
+
+    func, calls = interrupted_after(None)
+    grid = new_grid(func)
+    assert grid.load(filename)
+    assert np.sum(grid.done) == 5
+    assert np.allclose(grid.grid[grid.done], expected(grid)[grid.done])
+
+    grid.solve(filename)
+    assert len(calls) == 12 - 5
+    assert np.all(grid.done)
+    assert np.allclose(grid.grid, expected(grid))
+    with h5py.File(filename, 'r') as infile:
+        assert np.all(infile['done'][:])
+        assert np.allclose(infile['grid'][:], expected(grid))
+
+def test_load_grid_without_done(tmp_path):
+    # grids saved before the done mask existed were only saved when complete
+    filename = str(tmp_path/'grid.h5')
+    grid = new_grid(growth)
+    with h5py.File(filename, 'w') as outfile:
+        outfile.create_dataset('grid', data=expected(grid))
+        for i, xyz_grid in enumerate(grid.xyz_grids):
+            outfile.create_dataset('xyz_{}'.format(i), data=xyz_grid)
+    assert grid.load(filename)
+    assert np.all(grid.done)
+    assert np.allclose(grid.grid, expected(grid))
+
+@pytest.mark.parametrize('dims, maxs', [((3, 5), (10, 2)), ((3, 4), (20, 2))])
+def test_load_mismatched_grid(tmp_path, dims, maxs):
+    filename = str(tmp_path/'grid.h5')
+    new_grid(growth).solve(filename)
+    grid = new_grid(growth, dims=dims, maxs=maxs)
+    assert not grid.load(filename)
+    assert not np.any(grid.done)
+
+def test_load_missing_file(tmp_path):
+    grid = new_grid(growth)
+    assert not grid.load(str(tmp_path/'missing.h5'))
+    assert not np.any(grid.done)
@@ -0,0 +1,88 @@
+"""
+Resampling checkpointed coefficients onto new Fourier and Chebyshev bases,
+with stand-ins for the dedalus bases.
+"""
+import numpy as np
+import pytest
+from numpy.polynomial import chebyshev
+
+from tools.checkpointing import fourier_index_map, chebyshev_projection
+
+class Fourier:
+    def __init__(self, coeff_size, grid_dtype):
+        self.coeff_size = coeff_size
+        self.grid_dtype = grid_dtype
+
+class Chebyshev:
+    def __init__(self, size, interval):
+        self.base_grid_size = size
+        self.interval = interval
+
+    def grid(self, scale):
+        """Gauss points, as dedalus' Chebyshev grid."""
+        n = int(scale*self.base_grid_size)
+        native = -np.cos(np.pi*(np.arange(n) + 0.5)/n)
+        z_bottom, z_top = self.interval
+        return z_bottom + (native + 1)*(z_top - z_bottom)/2
+
+class Compound:
+    def __init__(self, *subbases):
+        self.subbases = subbases
+
+def layout(*subbases):
+    return {'intervals': np.array([subbasis.interval for subbasis in subbases], dtype=np.float64),
+            'sizes':     np.array([subbasis.base_grid_size for subbasis in subbases], dtype=int)}
+
+def coefficients(f, *subbases):
+    """Chebyshev coefficients of f on each subbasis, stacked."""
+    coeffs = []
+    for subbasis in subbases:
+        z = subbasis.grid(1)
+        z_bottom, z_top = subbasis.interval
+        native = (2*z - (z_top + z_bottom))/(z_top - z_bottom)
+        coeffs.append(np.linalg.solve(chebyshev.chebvander(native, z.size-1), f(z)))
+    return np.concatenate(coeffs)
+
+def f(z):
+    return z**3 - 2*z + 1
+
+@pytest.mark.parametrize('old, new', [
+    ((Chebyshev(8, (0, 3)),), (Chebyshev(16, (0, 3)),)),
+    ((Chebyshev(8, (0, 1)), Chebyshev(12, (1, 3))), (Chebyshev(16, (0, 3)),)),
+    ((Chebyshev(16, (0, 3)),), (Chebyshev(8, (0, 2)), Chebyshev(8, (2, 3)))),
+    ((Chebyshev(8, (0, 1)), Chebyshev(8, (1, 3))), (Chebyshev(6, (0, 0.5)), Chebyshev(10, (0.5, 3)))),
+])
+def test_chebyshev_projection(old, new):
+    basis = Compound(*new) if len(new) > 1 else new[0]
+    projection = chebyshev_projection(layout(*old), basis)
+    assert projection.shape == (sum(b.base_grid_size for b in new), sum(b.base_grid_size for b in old))
+    assert np.allclose(projection @ coefficients(f, *old), coefficients(f, *new))
+
+def test_chebyshev_projection_identity():
+    basis = Chebyshev(12, (0, 3))
+    assert np.allclose(chebyshev_projection(layout(basis), basis), np.eye(12))
+
+def test_real_fourier_map():
+    basis = Fourier(8, np.float64)
+    assert list(fourier_index_map(basis, 5, np.arange(8))) == [0, 1, 2, 3, 4, -1, -1, -1]
+    # truncation
+    assert list(fourier_index_map(Fourier(3, np.float64), 5, np.arange(3))) == [0, 1, 2]
+
+def wavenumbers(size):
+    return np.fft.fftfreq(size, 1/size).astype(int)
+
+@pytest.mark.parametrize('old_size, new_size', [(8, 12), (12, 8), (7, 7)])
+def test_complex_fourier_map(old_size, new_size):
+    basis = Fourier(new_size, np.complex128)
+    index_map = fourier_index_map(basis, old_size, np.arange(new_size))
+    old_k, new_k = wavenumbers(old_size), wavenumbers(new_size)
+    # modes up to the largest old wavenumber short of its Nyquist mode are carried over
+    kept = np.abs(new_k) <= (old_size-1)//2
+    assert np.all(index_map[~kept] == -1)
+    assert np.array_equal(old_k[index_map[kept]], new_k[kept])
+
+def test_fourier_map_local_indices():
+    # each process maps only its local part of the new coefficients
+    basis = Fourier(12, np.complex128)
+    full = fourier_index_map(basis, 8, np.arange(12))
+    assert np.array_equal(fourier_index_map(basis, 8, np.arange(6, 12)), full[6:])
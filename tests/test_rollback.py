@@ -0,0 +1,163 @@
+"""
+Rollback recovery, with a stand-in solver whose handlers are evaluated on
+the dedalus schedule (every iter iterations, after each step).
+"""
+import types
+
+import numpy as np
+from mpi4py import MPI
+
+from tools.diagnostics import FlowDiagnostics
+from tools.rollback import Rollback
+
+class Field:
+    def __init__(self, data):
+        self.data = np.array(data, dtype=np.float64)
+
+    def __getitem__(self, layout):
+        return self.data
+
+    def __setitem__(self, layout, data):
+        self.data = np.array(data, dtype=np.float64)
+
+class Handler:
+    def __init__(self, solver, iter):
+        self.solver = solver
+        self.iter = iter
+        self.last_iter_div = -1
+        self.tasks = {}
+        self.fields = {}
+
+    def add_task(self, task, layout='g', name=None):
+        self.tasks[name] = task
+
+    def __getitem__(self, name):
+        return self.fields[name]
+
+    def evaluate(self):
+        for name, task in self.tasks.items():
+            self.fields[name] = Field(task(self.solver))
+
+class Evaluator:
+    def __init__(self, solver):
+        self.solver = solver
+        self.handlers = []
+
+    def add_dictionary_handler(self, iter):
+        handler = Handler(self.solver, iter)
+        self.handlers.append(handler)
+        return handler
+
+    def evaluate_scheduled(self):
+        for handler in self.handlers:
+            iter_div = self.solver.iteration // handler.iter
+            if iter_div > handler.last_iter_div:
+                handler.last_iter_div = iter_div
+                handler.evaluate()
+
+class Solver:
+    """Exponentially growing u, with an optional NaN injected on one iteration."""
+    def __init__(self, blow_up=None):
+        self.state = types.SimpleNamespace(fields=[Field(np.linspace(1, 2, 16))])
+        self.domain = types.SimpleNamespace(dist=types.SimpleNamespace(comm_cart=MPI.COMM_WORLD))
+        self.timestepper = types.SimpleNamespace(stages=3)
+        self.evaluator = Evaluator(self)
+        self.iteration = self.initial_iteration = 0
+        self.sim_time = 0.
+        self.blow_up = blow_up
+
+    @property
+    def u(self):
+        return self.state.fields[0]['c']
+
+    def step(self, dt):
+        u = self.u*(1 + 0.01*dt)
+        if self.iteration == self.blow_up:
+            u[3] = np.nan
+            self.blow_up = None
+        self.state.fields[0]['c'] = u
+        self.sim_time += dt
+        self.iteration += 1
+        self.evaluator.evaluate_scheduled()
+
+    def evaluate_handlers_now(self, dt, handlers=None):
+        for handler in handlers:
+            handler.evaluate()
+
+class CFL:
+    """tools.cfl.CFL timestep logic, on the frequency |u|."""
+    def __init__(self, solver, initial_dt=0.1, cadence=1, safety=0.5, max_dt=1., min_dt=1e-8):
+        self.solver = solver
+        self.cadence = cadence
+        self.stored_dt = initial_dt
+        self.safety = safety
+        self.max_dt = max_dt
+        self.min_dt = min_dt
+        self.frequencies = solver.evaluator.add_dictionary_handler(iter=cadence)
+        self.frequencies.add_task(lambda solver: np.abs(solver.u), name='f')
+
+    def fresh(self):
+        iteration = self.solver.iteration
+        return (iteration-1) % self.cadence == 0 and (iteration-1) > self.solver.initial_iteration
+
+    def local_max_frequency(self):
+        local_max = np.max(self.frequencies['f']['g'])
+        return local_max if np.isfinite(local_max) else np.inf
+
+    def compute_dt(self, max_global_freq=None):
+        if not self.fresh():
+            return self.stored_dt
+        if not np.isfinite(max_global_freq):
+            return np.nan
+        self.stored_dt = min(self.safety/max_global_freq, self.max_dt)
+        return self.stored_dt
+
+def run(solver, flow, rollback, iterations):
+    """The RunController.step loop; returns False if the run had to stop."""
+    solver.evaluator.evaluate_scheduled()
+    rollback.snapshot()
+    while solver.iteration < iterations:
+        dt = flow.compute_dt()
+        if not np.isfinite(dt):
+            if not rollback.recover('timestep = {}'.format(dt)):
+                return False
+            continue
+        solver.step(dt)
+        if flow.reported:
+            reason = rollback.check_flow()
+            if reason is not None and not rollback.recover(reason):
+                return False
+        reason = rollback.after_step()
+        if reason is not None and not rollback.recover(reason):
+            return False
+    return True
+
+def build(blow_up):
+    solver = Solver(blow_up=blow_up)
+    flow = FlowDiagnostics(solver, CFL(solver), cadence=1)
+    flow.add_property(lambda solver: solver.u, name='Re')
+    rollback = Rollback(solver, flow, cadence=10, spike_property=None)
+    return solver, flow, rollback
+
+def test_recovers_from_nan():
+    solver, flow, rollback = build(blow_up=25)
+    assert run(solver, flow, rollback, 60)
+    assert rollback.recoveries == 1
+    assert np.all(np.isfinite(solver.u))
+    assert np.isfinite(flow.max('Re'))
+
+def test_restore_reevaluates_flow():
+    solver, flow, rollback = build(blow_up=25)
+    solver.evaluator.evaluate_scheduled()
+    while solver.iteration <= 25:
+        solver.step(flow.compute_dt())
+        rollback.after_step()
+    assert not np.isfinite(flow.compute_dt())
+    assert rollback.recover('timestep = nan')
+    assert solver.iteration == 20
+    assert np.isfinite(flow.compute_dt())
+
+def test_clean_run_takes_no_recoveries():
+    solver, flow, rollback = build(blow_up=None)
+    assert run(solver, flow, rollback, 60)
+    assert rollback.recoveries == 0
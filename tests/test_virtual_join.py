@@ -0,0 +1,55 @@
+"""
+Virtual joins of file handler output, over joined and unjoined sets.
+"""
+import shutil
+
+import h5py
+import numpy as np
+import pytest
+
+pytest.importorskip('dedalus')
+from tools import output
+
+def check_virtual_file(virtual_path, output_sets, n_sets):
+    with h5py.File(str(virtual_path), 'r') as file:
+        assert file.attrs['sets'] == n_sets
+        assert file.attrs['writes'] == n_sets*output_sets.writes
+        for name in output_sets.shapes:
+            expected = np.concatenate([output_sets.global_data(name, set_num) for set_num in range(1, n_sets+1)])
+            assert np.array_equal(file['tasks'][name][:], expected)
+            assert list(file['tasks'][name].attrs['constant']) == [name == 'u_mean', False]
+            assert 'start' not in file['tasks'][name].attrs
+        write_numbers = np.arange(n_sets*output_sets.writes)
+        assert np.allclose(file['scales']['sim_time'][:], 0.1*write_numbers)
+        assert np.array_equal(file['scales']['write_number'][:], write_numbers + 1)
+
+def test_mixed_sets(output_sets):
+    for set_num in (1, 2, 3):
+        output_sets.write(set_num)
+    output.merge_process_files_single_set(output_sets.base_path/'slices_s1', cleanup=True)
+    output.merge_process_files_single_set(output_sets.base_path/'slices_s2')
+    virtual_path = output.virtual_join(output_sets.base_path)
+    assert virtual_path == output_sets.base_path.parent/'slices_virtual.h5'
+    check_virtual_file(virtual_path, output_sets, 3)
+
+def test_uses_joined_file_when_complete(output_sets):
+    set_path = output_sets.write(1)
+    output.merge_process_files_single_set(set_path)
+    virtual_path = output.virtual_join(output_sets.base_path)
+    # the process files are not needed once the set is joined
+    shutil.rmtree(str(set_path))
+    check_virtual_file(virtual_path, output_sets, 1)
+
+def test_moved_data_dir(output_sets, tmp_path):
+    output_sets.write(1)
+    output_sets.write(2, splits=(0, 1, 3, 6))
+    output.virtual_join(output_sets.base_path)
+    moved = tmp_path/'moved'
+    moved.mkdir()
+    shutil.move(str(output_sets.base_path), str(moved))
+    shutil.move(str(tmp_path/'slices_virtual.h5'), str(moved))
+    check_virtual_file(moved/'slices_virtual.h5', output_sets, 2)
+
+def test_no_sets(output_sets):
+    with pytest.raises(FileNotFoundError):
+        output.virtual_join(output_sets.base_path)
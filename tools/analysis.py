@@ -1,12 +1,18 @@
 import numpy as np
 import h5py
 import re
+import os
 
 import logging
 logger = logging.getLogger(__name__.split('.')[-1])
 
 from collections import OrderedDict
 
+def set_number(filename):
+    """Set number of an output file; 0 for a virtual join of all sets (tools.output.virtual_join)."""
+    match = re.search(r'_s(\d+)', os.path.basename(filename))
+    return int(match.group(1)) if match else 0
+
 class DedalusData():
     def __init__(self,  files, *args,
                  keys=None, verbose=False, **kwargs):
@@ -14,7 +20,7 @@ class DedalusData():
         self.verbose = verbose
 
 
-        files.sort(key=lambda x: int(re.search(r'_s(\d+)',x).group(1)))
+        files.sort(key=set_number)
         self.files = files
         logger.debug("opening: {}".format(self.files))
         
@@ -168,10 +174,39 @@ class Slice(DedalusData):
         for key in self.keys:
             logger.debug("{} shape {}".format(key, self.data[key].shape))
 
+def crop_kept(dset):
+    """
+    Kept mode indices along each spatial axis of a cropped coefficient
+    dataset (see tools.output.StorageFileHandler), None for uncropped axes,
+    and the full spatial shape; (None, None) if the dataset is not cropped.
+    """
+    if 'crop_full_shape' not in dset.attrs:
+        return None, None
+    full_shape = tuple(dset.attrs['crop_full_shape'])
+    kept = [dset.attrs.get('crop_kept_{:d}'.format(axis)) for axis in range(len(full_shape))]
+    return kept, full_shape
+
+def uncrop(data, kept, full_shape):
+    """Data of shape (writes,) + cropped shape, zero-padded to (writes,) + full_shape."""
+    indices = [np.arange(n) if axis_kept is None else axis_kept
+               for n, axis_kept in zip(full_shape, kept)]
+    full = np.zeros((data.shape[0],) + full_shape, dtype=data.dtype)
+    full[np.ix_(np.arange(data.shape[0]), *indices)] = data
+    return full
+
 class Coeff(DedalusData):
-    def __init__(self, files, *args, keys=None, **kwargs):
+    """
+    Coefficient output and its power spectra.
+
+    Cropped outputs, holding only the lowest modes, are zero-padded back to
+    the full spectra if pad is True; otherwise only the stored modes are
+    kept, and kx and kz are reduced to match.
+    """
+    def __init__(self, files, *args, keys=None, pad=True, **kwargs):
         super(Coeff, self).__init__(files, *args,
                                      keys=keys, **kwargs)
+        self.pad = pad
+        self.kept = None
         self.read_data()
         self.compute_power_spectrum()
         
@@ -185,11 +220,18 @@ class Coeff(DedalusData):
             f = h5py.File(filename, 'r')
             # clumsy
             for key in self.keys:
+                kept, full_shape = crop_kept(f['tasks'][key])
+                data = f['tasks'][key][:]
+                if kept is not None:
+                    if self.pad:
+                        data = uncrop(data, kept, full_shape)
+                    else:
+                        self.kept = kept
                 if N == 1:
-                    self.data[key] = f['tasks'][key][:]
+                    self.data[key] = data
                     logger.debug("{} shape {}".format(key, self.data[key].shape))
                 else:
-                    self.data[key] = np.append(self.data[key], f['tasks'][key][:], axis=0)
+                    self.data[key] = np.append(self.data[key], data, axis=0)
 
             N += 1
             self.kx = f['scales']['kx'][:]
@@ -211,6 +253,12 @@ class Coeff(DedalusData):
             self.times = np.append(self.times, f['scales']['sim_time'][:])
             self.writes = np.append(self.writes, f['scales']['write_number'][:])
             f.close()
+
+        if self.kept is not None:
+            if self.kept[0] is not None:
+                self.kx = self.kx[self.kept[0]]
+            if self.kept[-1] is not None:
+                self.kz = self.kz[self.kept[-1]]
             
         for key in self.keys:
             logger.debug("{} shape {}".format(key, self.data[key].shape))
@@ -220,6 +268,26 @@ class Coeff(DedalusData):
         for key in self.keys:
             self.power_spectrum[key] = np.real(self.data[key]*np.conj(self.data[key]))
 
+    def crop_modes(self, threshold=1e-32):
+        """
+        Number of kx and Tz modes needed to keep every mode with power above
+        threshold times the peak power of its task, over all writes; a
+        suggestion for the crop option of the coeffs output.  For compound
+        z bases the Tz count runs over the whole expansion, so it is an
+        upper bound on what each subbasis needs.
+        """
+        modes_x, modes_z = 1, 1
+        for key in self.keys:
+            power = self.power_spectrum[key]
+            above = power > threshold*np.max(power)
+            x_above = np.flatnonzero(np.any(above, axis=(0, 2)))
+            z_above = np.flatnonzero(np.any(above, axis=(0, 1)))
+            if len(x_above) > 0:
+                modes_x = max(modes_x, x_above[-1] + 1)
+            if len(z_above) > 0:
+                modes_z = max(modes_z, z_above[-1] + 1)
+        return modes_x, modes_z
+
 class APJSingleColumnFigure():
     def __init__(self, aspect_ratio=None, lineplot=True, fontsize=8):
         import scipy.constants as scpconst
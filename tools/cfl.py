@@ -0,0 +1,281 @@
+import numpy as np
+from mpi4py import MPI
+from dedalus.extras import flow_tools
+from dedalus.core.field import Array
+
+from tools.diagnostics import spectral_tail
+
+import logging
+logger = logging.getLogger(__name__.split('.')[-1])
+
+class CFL(flow_tools.CFL):
+    """CFL-limited timestep whose global reduction can be done externally.
+
+    Behaves like dedalus.extras.flow_tools.CFL, but splits compute_dt into a
+    local part (local_max_frequency) and the global max, so that the global
+    max can be folded into another reduction (see tools.diagnostics).  A
+    non-finite frequency anywhere gives a non-finite timestep, rather than
+    silently keeping the previous one, so callers can trap blow-ups from dt.
+    """
+    def fresh(self):
+        """True if the frequencies were evaluated on the previous step."""
+        iteration = self.solver.iteration
+        return (iteration-1) % self.cadence == 0 and (iteration-1) > self.solver.initial_iteration
+
+    def local_max_frequency(self):
+        """Maximum summed frequency over the local grid (inf if not finite)."""
+        local_freqs = sum(np.abs(field['g']) for field in self.frequencies.fields.values())
+        if np.size(local_freqs) == 0:
+            return 0.
+        local_max = np.max(local_freqs)
+        if not np.isfinite(local_max):
+            return np.inf
+        return local_max
+
+    def compute_dt(self, max_global_freq=None):
+        """Compute CFL-limited timestep.
+
+        Parameters
+        ----------
+        max_global_freq : float, optional
+            Global maximum of local_max_frequency across processes, if already
+            reduced by the caller.  If None, it is reduced here when needed.
+        """
+        if not self.fresh():
+            return self.stored_dt
+        if max_global_freq is None:
+            max_global_freq = self.reducer.reduce_scalar(self.local_max_frequency(), MPI.MAX)
+        if not np.isfinite(max_global_freq):
+            return np.nan
+        if max_global_freq == 0.:
+            dt = np.inf
+        else:
+            dt = 1 / max_global_freq
+        # Apply restrictions
+        dt *= self.safety
+        dt = min(dt, self.max_dt, self.max_change*self.stored_dt)
+        dt = max(dt, self.min_dt, self.min_change*self.stored_dt)
+        if abs(dt - self.stored_dt) > self.threshold * self.stored_dt:
+            self.stored_dt = dt
+        return self.stored_dt
+
+
+class SubdomainCFL(CFL):
+    """CFL-limited timestep with vertical grid spacing local to each subdomain.
+
+    With a compound z basis (e.g. the multitropes), the global grid spacing
+    includes the Chebyshev points clustered at every subdomain interface, so
+    the vertical velocity at an interface sets the timestep of the whole run.
+    Here the vertical spacing of each subdomain is either its mean spacing
+    (the subdomain depth over its dealiased grid size; spacing='mean') or its
+    own Chebyshev grid spacing (spacing='grid').  Vertical velocities in the
+    subdomains listed in `exclude` (e.g. a stably stratified region, where w
+    is small and waves rather than advection limit stability) are masked out
+    of the timestep by an infinite spacing there; non-finite velocities still
+    give a non-finite timestep.  Horizontal spacings are as in CFL.
+
+    With a single z basis and spacing='grid', this is the same as CFL.
+    """
+    def __init__(self, solver, initial_dt, spacing='mean', exclude=(), **kwargs):
+        """
+        Parameters
+        ----------
+        solver : dedalus solver
+            Initial value solver being timestepped.
+        initial_dt : float
+            Initial timestep.
+        spacing : {'mean', 'grid'}, optional
+            Vertical spacing used within each subdomain (default: 'mean').
+        exclude : sequence of int, optional
+            Indices of z subdomains whose vertical velocity is ignored (default: none).
+        **kwargs
+            Passed to CFL.
+        """
+        super().__init__(solver, initial_dt, **kwargs)
+        if spacing not in ('mean', 'grid'):
+            raise ValueError("spacing must be 'mean' or 'grid', not {}".format(spacing))
+        domain = solver.domain
+        axis = domain.dim - 1
+        basis = domain.bases[axis]
+        subbases = getattr(basis, 'subbases', (basis,))
+        exclude = [i % len(subbases) for i in exclude]
+        scale = domain.dealias[axis]
+
+        spacings = []
+        for i, subbasis in enumerate(subbases):
+            grid_spacing = subbasis.grid_spacing(scale)
+            if i in exclude:
+                dz = np.full_like(grid_spacing, np.inf)
+            elif spacing == 'mean':
+                z_bottom, z_top = subbasis.interval
+                dz = np.full_like(grid_spacing, (z_top - z_bottom)/subbasis.grid_size(scale))
+            else:
+                dz = grid_spacing
+            logger.debug('z subdomain {:d} [{:g}, {:g}]: min grid spacing {:.3e}, CFL spacing {:.3e}'.format(
+                         i, subbasis.interval[0], subbasis.interval[1], np.min(grid_spacing), np.min(dz)))
+            spacings.append(dz)
+        spacing_z = np.concatenate(spacings)
+        slices = domain.dist.grid_layout.slices(domain.dealias)
+        dz_array = Array(domain)
+        dz_array.from_local_vector(spacing_z[slices[axis]], axis)
+        self.grid_spacings[axis] = dz_array
+
+        logger.info('subdomain CFL: min vertical spacing {:.3e} (vs {:.3e} global grid), {} spacing{}'.format(
+                    np.min(spacing_z), np.min(basis.grid_spacing(scale)), spacing,
+                    ', excluding w in subdomains {}'.format(exclude) if exclude else ''))
+
+
+class SafetyController:
+    """Adaptive CFL safety factor.
+
+    Every `cadence` iterations the safety factor of the run's CFLs is raised by
+    `increase`, up to max_safety, as long as the last window of iterations
+    looked stable.  Stability indicators are checked over each window:
+
+    * dt oscillation: the CFL timestep reversing direction on most of its
+      changes, with a relative amplitude above oscillation_tolerance;
+    * spectral tail: growth of the energy fraction in the highest z modes
+      (see tools.diagnostics.spectral_tail) by more than tail_growth;
+    * energy drift: relative change of the grid average of energy_property
+      by more than drift_tolerance (the safety is held, not reduced, since
+      this is also what a transient looks like);
+    * rollbacks (tools.rollback.Rollback), after which the safety at the
+      blow-up, times backoff, becomes a ceiling.
+
+    Trouble multiplies the safety by `backoff`.  The average dt achieved is
+    compared to an estimate of the fixed-safety baseline, dt*safety0/safety
+    (capped at max_dt), which holds while the timestep is CFL limited.
+    """
+    def __init__(self, flow, cadence=100, increase=1.05, backoff=0.7, max_safety=None,
+                 energy_property='KE', drift_tolerance=0.5, oscillation_tolerance=0.05,
+                 tail_fraction=0.1, tail_growth=10, rollback=None):
+        """
+        Parameters
+        ----------
+        flow : tools.diagnostics.FlowDiagnostics
+            Flow properties and CFL of the run.
+        cadence : int, optional
+            Iterations between safety adjustments (default: 100).
+        increase, backoff : float, optional
+            Factors applied to the safety when stable (default: 1.05) or in
+            trouble (default: 0.7).
+        max_safety : float, optional
+            Largest safety factor allowed (default: 4 times the initial safety).
+        energy_property : str, optional
+            Flow property monitored for energy drift (default: 'KE'); skipped
+            if it is not a property of flow.
+        drift_tolerance : float, optional
+            Relative change of energy_property over a window that holds the
+            safety (default: 0.5).
+        oscillation_tolerance : float, optional
+            Relative dt oscillation amplitude counted as trouble (default: 0.05).
+        tail_fraction : float, optional
+            Fraction of the highest z modes counted as the spectral tail (default: 0.1).
+        tail_growth : float, optional
+            Growth of the tail energy fraction over a window counted as trouble (default: 10).
+        rollback : tools.rollback.Rollback, optional
+            Rollback of the run, if any.
+        """
+        self.flow = flow
+        self.solver = flow.solver
+        self.cadence = cadence
+        self.increase = increase
+        self.backoff = backoff
+        self.safety0 = flow.CFL.safety
+        if max_safety is None:
+            max_safety = 4*self.safety0
+        self.ceiling = max_safety
+        self.energy_property = energy_property
+        self.drift_tolerance = drift_tolerance
+        self.oscillation_tolerance = oscillation_tolerance
+        self.tail_fraction = tail_fraction
+        self.tail_growth = tail_growth
+        self.rollback = rollback
+
+        self.dt_sum = 0.
+        self.baseline_dt_sum = 0.
+        self.adjustments = 0
+        self.backoffs = 0
+        self._recoveries = 0 if rollback is None else rollback.recoveries
+        self._new_window()
+
+    @property
+    def CFLs(self):
+        return [self.flow.CFL] + [CFL for name, CFL in self.flow.report_CFLs]
+
+    @property
+    def safety(self):
+        return self.flow.CFL.safety
+
+    def _new_window(self, tail=None):
+        self._n = 0
+        self._dts = []
+        self._energy = []
+        self._tail = tail
+
+    def _set_safety(self, safety):
+        for CFL in self.CFLs:
+            CFL.safety *= safety/self.safety
+
+    def report(self):
+        """Record flow properties on report iterations."""
+        if self.energy_property in self.flow.names:
+            self._energy.append(self.flow.grid_average(self.energy_property))
+
+    def after_step(self, dt):
+        """Record the timestep just taken and adjust the safety factor at the end of a window."""
+        max_dt = self.flow.CFL.max_dt
+        self.dt_sum += dt
+        self.baseline_dt_sum += min(dt*self.safety0/self.safety, max_dt)
+        self._dts.append(dt)
+        self._n += 1
+        if self._n >= self.cadence:
+            self.adjust()
+
+    def _trouble(self, tail):
+        """Reason the last window looks unstable, or None."""
+        if self.rollback is not None and self.rollback.recoveries > self._recoveries:
+            self._recoveries = self.rollback.recoveries
+            # rollback has already reduced the safety
+            self.ceiling = min(self.ceiling, self.safety/self.rollback.safety_reduction*self.backoff)
+            return 'rollback'
+        if self._tail is not None and self._tail > 0 and tail > self.tail_growth*self._tail:
+            return 'spectral tail grown {:.3g} times'.format(tail/self._tail)
+        changes = np.diff(self._dts)
+        changes = changes[changes != 0]
+        if len(changes) > 2:
+            reversals = np.sum(np.sign(changes[1:]) != np.sign(changes[:-1]))
+            amplitude = np.mean(np.abs(changes))/np.mean(self._dts)
+            if reversals > len(changes)/2 and amplitude > self.oscillation_tolerance:
+                return 'dt oscillating ({:d} reversals, amplitude {:.3g})'.format(reversals, amplitude)
+        return None
+
+    def adjust(self):
+        """Raise or back off the safety factor based on the last window."""
+        tail = spectral_tail(self.solver, self.tail_fraction)
+        reason = self._trouble(tail)
+        old_safety = self.safety
+        if reason is not None:
+            if reason != 'rollback':
+                self._set_safety(self.safety*self.backoff)
+                self.ceiling = min(self.ceiling, old_safety/self.increase)
+            self.backoffs += 1
+            logger.info('CFL safety {:.3g} -> {:.3g}: {}'.format(old_safety, self.safety, reason))
+        else:
+            hold = False
+            if len(self._energy) > 1:
+                energy = np.array(self._energy)
+                drift = np.abs(energy[-1] - energy[0])/max(np.max(np.abs(energy)), np.finfo(float).tiny)
+                hold = not np.isfinite(drift) or drift > self.drift_tolerance
+            if not hold and self.safety < self.ceiling:
+                self._set_safety(min(self.safety*self.increase, self.ceiling))
+                self.adjustments += 1
+        self._new_window(tail=tail)
+
+    def log_summary(self):
+        """Log the average dt achieved relative to the fixed-safety baseline."""
+        if self.baseline_dt_sum == 0:
+            return
+        logger.info('adaptive CFL safety: final {:.3g} (initial {:.3g}), {:d} increases, {:d} backoffs'.format(
+                    self.safety, self.safety0, self.adjustments, self.backoffs))
+        logger.info('average dt {:.3g} times the fixed-safety estimate'.format(self.dt_sum/self.baseline_dt_sum))
@@ -1,8 +1,14 @@
 import pathlib 
 import h5py
 import numpy as np
+from mpi4py import MPI
 import logging
 import re
+import json
+import time
+import shutil
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 logger = logging.getLogger(__name__.split('.')[-1])
 
 class Checkpoint:
@@ -35,13 +41,19 @@ class Checkpoint:
         self.set_re = re.compile("[\w]*_s([0-9]+)")
 
     def set_checkpoint(self, solver, wall_dt=np.inf, sim_dt=np.inf, iter=np.inf,
-                                     parallel=False, mode="append"):
+                                     parallel='auto', mode="append", keep=None, milestone_sim_dt=None,
+                                     asynchronous=False, slab_bytes=2**23, storage=None):
         """
 
         Parameters
         ----------
-        parallel : logical, optional
-            If True, utilize parallel hdf5 output.  If False, do per-core output.  Default is False. 
+        parallel : logical or 'auto', optional
+            If True, utilize parallel hdf5 output, one file per checkpoint.  If
+            False, do per-core output.  If 'auto', use parallel output when
+            running on more than one core and collective writes work in the
+            checkpoint directory.  If parallel output is requested but h5py
+            is not built with MPI, or the file system does not support it,
+            falls back to per-core output.  Default is 'auto'.
         wall_dt : float, optional
             Wall time cadence for evaluating tasks (default: infinite)
         sim_dt : float, optional
@@ -52,33 +64,631 @@ class Checkpoint:
             If "overwrite", checkpoints will always write checkpoint file 1.  If
             "append," new checkpoints will be created but old checkpoints will
             not be erased
+        keep : int, optional
+            Number of most recent checkpoints kept; older ones are deleted
+            after each write, except milestones (default: None, keep all).
+        milestone_sim_dt : float, optional
+            Simulation time between milestones: the first checkpoint after
+            each multiple of milestone_sim_dt is never deleted (default:
+            None, only checkpoints tagged with tag_milestone).
+        asynchronous : logical, optional
+            If True, each checkpoint only copies the state into preallocated
+            buffers in the main loop, and a background thread writes them
+            while timestepping continues.  A checkpoint due before the last
+            one is written waits for it.  Asynchronous checkpoints are
+            always written to per-process files, since parallel hdf5 writes
+            are collective MPI calls.  Call wait() before reading the last
+            checkpoint (default: False).
+        slab_bytes : int, optional
+            Approximate size of each write of the background thread.  h5py
+            holds the GIL during a write, so smaller writes let the main
+            loop run in between (default: 8 MB).
+        storage : dict, optional
+            Lossless HDF5 storage options (compression, compression_opts,
+            shuffle, chunk_bytes) of tools.output.StorageFileHandler.
+            Compressed checkpoints are written to per-process files
+            (default: None, uncompressed).
         """
+        comm = solver.domain.dist.comm_cart
+        self.comm = comm
+        self.keep = keep
+        self.milestone_sim_dt = milestone_sim_dt
+        if milestone_sim_dt is not None:
+            self._last_milestone = int(solver.sim_time // milestone_sim_dt)
+        self.writes = []
 
-        self.checkpoint = solver.evaluator.add_file_handler(self.checkpoint_dir,
-                                                            wall_dt=wall_dt,
-                                                            sim_dt=sim_dt,
-                                                            iter=iter,max_writes=1,
-                                                            parallel=parallel,
-                                                            mode=mode)
+        storage = dict(storage or {})
+        if storage.get('single_precision'):
+            raise ValueError("checkpoints are restarted from, so are always stored in full precision")
+        if (storage.get('compression') is not None or storage.get('shuffle')) and parallel:
+            if parallel is True:
+                logger.warning("compressed checkpoints are written to per-process files")
+            parallel = False
+        if asynchronous and parallel:
+            if parallel is True:
+                logger.warning("asynchronous checkpoints are written to per-process files")
+            parallel = False
+        if parallel:
+            available = comm.size > 1 and parallel_hdf5_available(comm, self.checkpoint_dir)
+            if parallel is True and not available:
+                logger.warning("parallel HDF5 output not available; checkpointing to per-process files")
+            parallel = available
+        logger.info("checkpointing to {}".format("one parallel HDF5 file per checkpoint" if parallel else "per-process files"))
+
+        if storage:
+            from tools.output import add_file_handler, storage_summary
+            self.checkpoint = add_file_handler(solver, self.checkpoint_dir,
+                                               wall_dt=wall_dt,
+                                               sim_dt=sim_dt,
+                                               iter=iter,max_writes=1,
+                                               parallel=parallel,
+                                               mode=mode, **storage)
+            logger.info("checkpoint storage: {}".format(storage_summary(self.checkpoint)))
+        else:
+            self.checkpoint = solver.evaluator.add_file_handler(self.checkpoint_dir,
+                                                                wall_dt=wall_dt,
+                                                                sim_dt=sim_dt,
+                                                                iter=iter,max_writes=1,
+                                                                parallel=parallel,
+                                                                mode=mode)
         self.checkpoint.add_system(solver.state, layout = self.layout)
 
+        # record the basis layouts with the dedalus scales, for restarts onto other resolutions
+        setup_file = self.checkpoint.setup_file
+        def setup_file_with_bases(file):
+            setup_file(file)
+            write_basis_layouts(file, solver.domain)
+        self.checkpoint.setup_file = setup_file_with_bases
+
+        self.milestones = {}
+        self.milestone_path = self.checkpoint_dir.joinpath('milestones.json')
+        if comm.rank == 0 and mode == "append" and self.milestone_path.exists():
+            with open(str(self.milestone_path)) as infile:
+                self.milestones = {int(set_num): tag for set_num, tag in json.load(infile).items()}
+
+        self.asynchronous = asynchronous
+        self.slab_bytes = slab_bytes
+        self._pending = None
+        if asynchronous:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+            self._buffers = {}
+            self.checkpoint.process = self._process_async
+        else:
+            # time each write, for the bandwidth, and tag milestones and delete old checkpoints after it
+            process = self.checkpoint.process
+            def process_with_retention(**kw):
+                start_time = time.time()
+                process(**kw)
+                self._after_write(kw['sim_time'], time.time() - start_time)
+            self.checkpoint.process = process_with_retention
+
+    def _process_async(self, world_time, wall_time, sim_time, timestep, iteration, **kw):
+        """Copy the state to the write buffers and start writing them in the background.
+
+        Follows FileHandler.process, with the task data writes moved to the
+        background thread.  Creating the set and its file is collective, and
+        stays in the main loop with the small scale writes.
+        """
+        self.wait()
+        start_time = time.time()
+        handler = self.checkpoint
+        file = handler.get_file()
+        handler.total_write_num += 1
+        handler.file_write_num += 1
+        file.attrs['writes'] = handler.file_write_num
+        index = handler.file_write_num - 1
+        scales = {'sim_time': sim_time, 'world_time': world_time, 'wall_time': wall_time,
+                  'timestep': timestep, 'iteration': iteration, 'write_number': handler.total_write_num}
+        for name, value in scales.items():
+            dset = file['scales'][name]
+            dset.resize(index+1, axis=0)
+            dset[index] = value
+
+        writes = []
+        for task in handler.tasks:
+            out = task['out']
+            out.set_scales(task['scales'], keep_data=True)
+            out.require_layout(task['layout'])
+            buffer = self._buffers.get(task['name'])
+            if buffer is None or buffer.shape != out.data.shape:
+                buffer = self._buffers[task['name']] = np.empty_like(out.data)
+            np.copyto(buffer, out.data)
+            dset = file['tasks'][task['name']]
+            dset.resize(index+1, axis=0)
+            for memory_space, file_space in slab_spaces(handler, out, task['scales'], index, self.slab_bytes, chunks=dset.chunks):
+                writes.append((dset, memory_space, file_space, buffer))
+        blocked = time.time() - start_time
+        self._pending = (self._executor.submit(write_slabs, file, writes), sim_time, blocked)
+
+    def wait(self):
+        """Wait for an asynchronous checkpoint write in progress, on all processes, and finish it."""
+        if self._pending is None:
+            return
+        future, sim_time, blocked = self._pending
+        self._pending = None
+        start_time = time.time()
+        try:
+            write_time = future.result()
+            failed = False
+        except Exception:
+            logger.error("checkpoint {:d} write failed:\n{}".format(self.checkpoint.set_num, traceback.format_exc()))
+            write_time = 0.
+            failed = True
+        if self.comm.allreduce(failed, op=MPI.LOR):
+            logger.error("checkpoint {:d} is incomplete".format(self.checkpoint.set_num))
+            return
+        waited = time.time() - start_time
+        if waited > 0.01:
+            logger.debug("waited {:.2f} sec for checkpoint {:d} to be written".format(waited, self.checkpoint.set_num))
+        self._after_write(sim_time, blocked + write_time, blocked=blocked)
+
+    def _after_write(self, sim_time, elapsed, blocked=None):
+        handler = self.checkpoint
+        nbytes = sum(task['out'].data.nbytes for task in handler.tasks)
+        nbytes = self.comm.allreduce(nbytes, op=MPI.SUM)
+        elapsed = self.comm.allreduce(elapsed, op=MPI.MAX)
+        self.writes.append((nbytes, elapsed))
+        message = "checkpoint {:d}: {:.3g} MB in {:.2f} sec ({:.3g} MB/sec)".format(
+                  handler.set_num, nbytes/1e6, elapsed, nbytes/1e6/max(elapsed, 1e-6))
+        if blocked is not None:
+            blocked = self.comm.allreduce(blocked, op=MPI.MAX)
+            message += ", {:.2f} sec in the main loop".format(blocked)
+        logger.info(message)
+
+        if self.milestone_sim_dt is not None:
+            milestone = int(sim_time // self.milestone_sim_dt)
+            if milestone > self._last_milestone:
+                self._last_milestone = milestone
+                self.tag_milestone('t={:g}'.format(sim_time))
+        if self.keep is not None and self.comm.rank == 0:
+            self.prune()
+
+    def tag_milestone(self, tag='milestone'):
+        """Keep the last checkpoint written, whatever the retention."""
+        if not self.writes:
+            return
+        set_num = self.checkpoint.set_num
+        logger.info("checkpoint {:d} is milestone {}".format(set_num, tag))
+        if self.comm.rank == 0:
+            self.milestones[set_num] = tag
+            with open(str(self.milestone_path), 'w') as outfile:
+                json.dump(self.milestones, outfile, indent=1)
+
+    def prune(self):
+        """Delete all but the last keep checkpoints and the milestones (joined, parallel and per-process sets)."""
+        set_re = re.compile("{}_s([0-9]+)$".format(self.name))
+        sets = {}
+        for path in self.checkpoint_dir.glob("{}_s*".format(self.name)):
+            match = set_re.match(path.stem)
+            if match:
+                sets.setdefault(int(match.group(1)), []).append(path)
+        for set_num in sorted(sets)[:-self.keep]:
+            if set_num in self.milestones:
+                continue
+            for path in sets[set_num]:
+                logger.debug("deleting old checkpoint {}".format(path))
+                if path.is_dir():
+                    shutil.rmtree(str(path))
+                else:
+                    path.unlink()
+
+    def log_summary(self):
+        if not self.writes:
+            return
+        nbytes, elapsed = np.sum(self.writes, axis=0)
+        logger.info("checkpoints: {:d} writes, {:.3g} MB in {:.2f} sec ({:.3g} MB/sec)".format(
+                    len(self.writes), nbytes/1e6, elapsed, nbytes/1e6/max(elapsed, 1e-6)))
+
     def restart(self, checkpoint_file, solver, cp_record=-1):
         """Restart from checkpoint save file.  
 
-        This file must, at present, be a single unified HDF5 file
-        (e.g., if parallel=False on write-out, the data must be joined
-        before restart).
+        checkpoint_file may be a joined HDF5 file (e.g. checkpoint_s3.h5),
+        or the per-process files of a set written with parallel=False and
+        not joined: the set directory (checkpoint_s3/), one of its process
+        files, or the joined file name if only the set directory exists.
+        Unjoined sets are read directly, each process reading its local part
+        of the state from whichever process files hold it, for any number of
+        processes on write-out.
 
+        If the checkpoint was written at a different resolution or z basis
+        layout (e.g. single Chebyshev, two-domain or dense compound), the
+        state is resampled onto the solver's bases: Fourier modes are padded
+        or truncated, and the Chebyshev expansions in z are re-projected onto
+        the new z basis.  Each process reads and resamples only its local
+        part of the coefficient data.
         """ 
         logger.info(checkpoint_file)
         f = pathlib.Path(checkpoint_file)
+        if not f.exists() and f.with_suffix('.hdf5').exists():
+            # written with parallel output
+            f = f.with_suffix('.hdf5')
+            checkpoint_file = str(f)
         stem = f.stem
         
-        try:
-            set_num = int(self.set_re.match(stem).group(1))
-        except:
+        if self.set_re.match(stem) is None:
             raise FileNotFoundError("Output filename not as expected.")
-            
-        write, dt = solver.load_state(checkpoint_file, cp_record)
+
+        set_path = process_set_path(f)
+        if set_path is not None:
+            logger.info("reading unjoined checkpoint set {}".format(set_path))
+            with ProcessCheckpoint(set_path, solver.domain.dist.comm_cart) as source:
+                write, dt = load_resampled_state(source, solver, cp_record)
+            return dt
+
+        with JoinedCheckpoint(f) as source:
+            same_bases = matching_bases(source, solver)
+        if same_bases:
+            write, dt = solver.load_state(checkpoint_file, cp_record)
+        else:
+            with JoinedCheckpoint(f) as source:
+                write, dt = load_resampled_state(source, solver, cp_record)
 
         return dt
+
+
+def slab_spaces(handler, field, scales, index, slab_bytes, chunks=None):
+    """HDF5 memory and file spaces writing the local data of field to write index
+    of a FileHandler dataset, in slabs of about slab_bytes along the first axis
+    (whole chunks of a chunked dataset, so compressed chunks are written once)."""
+    layout = field.layout
+    constant = np.array(field.meta[:]['constant'])
+    gnc_shape, gnc_start, write_shape, write_start, write_count = handler.get_write_stats(layout, scales, constant, index)
+    local_shape = tuple(layout.local_shape(scales))
+    row_bytes = max(1, np.prod(write_count[1:], dtype=int)*field.data.itemsize)
+    rows = max(1, int(slab_bytes // row_bytes))
+    if chunks is not None and len(chunks) > 1:
+        rows = max(1, rows // chunks[1])*chunks[1]
+    spaces = []
+    for row in range(0, write_count[0], rows):
+        count = np.array(write_count)
+        count[0] = min(rows, write_count[0] - row)
+        memory_start = np.zeros_like(count)
+        memory_start[0] = row
+        memory_space = h5py.h5s.create_simple(local_shape)
+        memory_space.select_hyperslab(tuple(memory_start), tuple(count))
+        file_start = np.array(write_start)
+        file_start[0] += row
+        file_space = h5py.h5s.create_simple((index+1,) + tuple(write_shape))
+        file_space.select_hyperslab((index,) + tuple(file_start), (1,) + tuple(count))
+        spaces.append((memory_space, file_space))
+    return spaces
+
+def write_slabs(file, writes):
+    """Write (dataset, memory space, file space, data) slabs and close file; returns the time taken."""
+    start_time = time.time()
+    for dset, memory_space, file_space, data in writes:
+        dset.id.write(memory_space, file_space, data)
+    file.close()
+    return time.time() - start_time
+
+def parallel_hdf5_available(comm, directory):
+    """True if collective HDF5 writes to a file in directory work on all processes of comm."""
+    if not h5py.get_config().mpi:
+        return False
+    directory = pathlib.Path(directory)
+    if comm.rank == 0:
+        directory.mkdir(parents=True, exist_ok=True)
+    comm.Barrier()
+    path = directory.joinpath('parallel_hdf5_test.h5')
+    try:
+        with h5py.File(str(path), 'w', driver='mpio', comm=comm) as file:
+            dset = file.create_dataset('rank', shape=(comm.size,), dtype=np.int64)
+            with dset.collective:
+                dset[comm.rank:comm.rank+1] = comm.rank
+        available = True
+    except Exception:
+        available = False
+    available = comm.allreduce(available, op=MPI.LAND)
+    if comm.rank == 0 and path.exists():
+        path.unlink()
+    return available
+
+def process_set_path(path):
+    """Directory of the unjoined set path refers to, or None if path is a joined file."""
+    path = pathlib.Path(path)
+    if path.is_dir():
+        return path
+    if re.match(r".*_p[0-9]+$", path.stem):
+        return path.parent
+    if not path.exists() and path.with_suffix('').is_dir():
+        return path.with_suffix('')
+    return None
+
+def checkpoint_source(path, comm):
+    """
+    JoinedCheckpoint or ProcessCheckpoint reading output file path: a joined
+    or parallel file, or an unjoined set (see Checkpoint.restart).
+    """
+    path = pathlib.Path(path)
+    if not path.exists() and path.with_suffix('.hdf5').exists():
+        path = path.with_suffix('.hdf5')
+    set_path = process_set_path(path)
+    if set_path is not None:
+        return ProcessCheckpoint(set_path, comm)
+    return JoinedCheckpoint(path)
+
+class JoinedCheckpoint:
+    """Checkpoint state in a single (joined or parallel-written) HDF5 file."""
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.file = h5py.File(str(self.path), mode='r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def shape(self, name):
+        """Global shape of task name, without the write axis."""
+        return tuple(self.file['tasks'][name].shape[1:])
+
+    def read(self, name, index, indices):
+        return read_block(self.file['tasks'][name], index, indices)
+
+    def read_slices(self, name, index, slices):
+        """Read the block slices (e.g. the local part of a layout) of write index of task name."""
+        return self.file['tasks'][name][(index,) + tuple(slices)]
+
+class ProcessCheckpoint:
+    """Checkpoint state in the unjoined per-process files of a set, read as if joined.
+
+    Rank 0 reads the block of the global data held by each process file for
+    each task (tasks may differ in layout and constant axes) and broadcasts
+    the table; each process then opens only the files holding parts of the
+    data it reads.
+    """
+    def __init__(self, set_path, comm):
+        self.path = pathlib.Path(set_path)
+        process_paths = None
+        blocks = None
+        if comm.rank == 0:
+            process_paths = sorted(self.path.glob("{}_p*.h5".format(self.path.stem)),
+                                   key=lambda path: int(path.stem.split('_p')[-1]))
+            blocks = {}
+            for path in process_paths:
+                with h5py.File(str(path), mode='r') as file:
+                    for name, dset in file['tasks'].items():
+                        blocks.setdefault(name, []).append((np.array(dset.attrs['start']), np.array(dset.attrs['count']),
+                                                            tuple(dset.attrs['global_shape'])))
+        self.process_paths, self.blocks = comm.bcast((process_paths, blocks), root=0)
+        if not self.process_paths:
+            raise FileNotFoundError("no process files in {}".format(self.path))
+        self._files = {}
+        # scales and basis layouts are global, so any process file has them
+        self.file = self._open(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for file in self._files.values():
+            file.close()
+        self._files = {}
+
+    def _open(self, i):
+        if i not in self._files:
+            self._files[i] = h5py.File(str(self.process_paths[i]), mode='r')
+        return self._files[i]
+
+    def shape(self, name):
+        """Global shape of task name, without the write axis."""
+        return self.blocks[name][0][2]
+
+    def read(self, name, index, indices):
+        """Read like read_block from the joined data, assembled from the process files."""
+        shape = self.shape(name)
+        data = np.zeros(tuple(len(axis_indices) for axis_indices in indices) + (shape[-1],),
+                        dtype=self.file['tasks'][name].dtype)
+        for i, (start, count, global_shape) in enumerate(self.blocks[name]):
+            if np.any(count[-1:] != shape[-1:]):
+                raise ValueError("process files distributed in the last axis are not supported")
+            in_block = [(axis_indices >= start[axis]) & (axis_indices < start[axis] + count[axis])
+                        for axis, axis_indices in enumerate(indices)]
+            if not all(np.any(mask) for mask in in_block):
+                continue
+            local_indices = [axis_indices[mask] - start[axis]
+                             for axis, (axis_indices, mask) in enumerate(zip(indices, in_block))]
+            block = read_block(self._open(i)['tasks'][name], index, local_indices)
+            data[np.ix_(*in_block, np.ones(shape[-1], dtype=bool))] = block
+        return data
+
+    def read_slices(self, name, index, slices):
+        """Read like JoinedCheckpoint.read_slices, from the process files overlapping the block."""
+        lower = np.array([axis_slice.start for axis_slice in slices])
+        upper = np.array([axis_slice.stop for axis_slice in slices])
+        data = np.zeros(tuple(upper - lower), dtype=self.file['tasks'][name].dtype)
+        for i, (start, count, global_shape) in enumerate(self.blocks[name]):
+            overlap_lower = np.maximum(lower, start)
+            overlap_upper = np.minimum(upper, start + count)
+            if np.any(overlap_upper <= overlap_lower):
+                continue
+            block = self._open(i)['tasks'][name][(index,) + tuple(slice(l, u) for l, u in zip(overlap_lower - start, overlap_upper - start))]
+            data[tuple(slice(l, u) for l, u in zip(overlap_lower - lower, overlap_upper - lower))] = block
+        return data
+
+
+def basis_layout(basis):
+    """Type, subdomain intervals and base grid sizes of a dedalus basis."""
+    subbases = getattr(basis, 'subbases', (basis,))
+    return {'type':      type(basis).__name__,
+            'intervals': np.array([subbasis.interval for subbasis in subbases], dtype=np.float64),
+            'sizes':     np.array([subbasis.base_grid_size for subbasis in subbases], dtype=int)}
+
+def write_basis_layouts(file, domain):
+    """Record the layout of each basis as attributes of its group in the file's scales."""
+    for basis in domain.bases:
+        group = file['scales'].require_group(basis.name)
+        for key, value in basis_layout(basis).items():
+            group.attrs[key] = value
+
+def read_basis_layout(file, name):
+    """Basis layout recorded by write_basis_layouts, or None for older checkpoints."""
+    group = file['scales'].get(name)
+    if group is None or 'type' not in group.attrs:
+        return None
+    return {'type':      group.attrs['type'],
+            'intervals': np.array(group.attrs['intervals']),
+            'sizes':     np.array(group.attrs['sizes'])}
+
+def matching_bases(source, solver):
+    """True if the checkpointed state in source is on the solver's bases, so it can be loaded directly."""
+    domain = solver.domain
+    for field in solver.state.fields:
+        if source.shape(field.name) != tuple(domain.global_coeff_shape):
+            return False
+    for basis in domain.bases:
+        old = read_basis_layout(source.file, basis.name)
+        new = basis_layout(basis)
+        if old is not None and (len(old['sizes']) != len(new['sizes']) or
+                                np.any(old['sizes'] != new['sizes']) or
+                                not np.allclose(old['intervals'], new['intervals'])):
+            return False
+    return True
+
+def fourier_index_map(basis, old_size, new_indices):
+    """
+    Indices into old Fourier coefficients of the new coefficients new_indices,
+    or -1 for modes that are not in the old coefficients (padding).
+    """
+    new_indices = np.asarray(new_indices)
+    if basis.grid_dtype == np.float64:
+        # real transform: wavenumbers 0..kmax in order
+        return np.where(new_indices < old_size, new_indices, -1)
+    # complex transform: wavenumbers 0..kmax, -kmax..-1
+    new_size = basis.coeff_size
+    wavenumbers = np.where(new_indices <= (new_size-1)//2, new_indices, new_indices - new_size)
+    old_kmax = (old_size-1)//2
+    return np.where(np.abs(wavenumbers) <= old_kmax, wavenumbers % old_size, -1)
+
+def chebyshev_projection(old_layout, basis):
+    """
+    Matrix taking Chebyshev coefficients on the old z layout (possibly
+    compound) to coefficients on basis (possibly compound), by interpolating
+    the old expansions onto the Gauss points of each new subdomain.
+    """
+    from numpy.polynomial import chebyshev
+    old_intervals, old_sizes = old_layout['intervals'], old_layout['sizes']
+    old_offsets = np.concatenate([[0], np.cumsum(old_sizes)])
+    subbases = getattr(basis, 'subbases', (basis,))
+    blocks = []
+    for subbasis in subbases:
+        z = subbasis.grid(1)
+        evaluate = np.zeros((z.size, old_offsets[-1]))
+        # old subdomain of each point; points on an interface go to the upper one
+        which = np.clip(np.searchsorted(old_intervals[:,0], z, side='right') - 1, 0, len(old_sizes)-1)
+        for i, (z_bottom, z_top) in enumerate(old_intervals):
+            points = (which == i)
+            native = (2*z[points] - (z_top + z_bottom))/(z_top - z_bottom)
+            evaluate[points, old_offsets[i]:old_offsets[i+1]] = chebyshev.chebvander(native, old_sizes[i]-1)
+        z_bottom, z_top = subbasis.interval
+        native = (2*z - (z_top + z_bottom))/(z_top - z_bottom)
+        blocks.append(np.linalg.solve(chebyshev.chebvander(native, z.size-1), evaluate))
+    return np.concatenate(blocks, axis=0)
+
+def read_block(dset, index, indices):
+    """
+    Read write index of dset at the given (increasing) indices along each
+    leading axis, and all of the last axis, reading only the bounding block
+    of the indices from the file.
+    """
+    if any(len(axis_indices) == 0 for axis_indices in indices):
+        return np.zeros(tuple(len(axis_indices) for axis_indices in indices) + dset.shape[-1:], dtype=dset.dtype)
+    selection = [index]
+    takes = []
+    n_lists = sum(not np.all(np.diff(axis_indices) == 1) for axis_indices in indices)
+    for axis_indices in indices:
+        contiguous = np.all(np.diff(axis_indices) == 1)
+        if contiguous or n_lists > 1:
+            selection.append(slice(axis_indices[0], axis_indices[-1]+1))
+            takes.append(None if contiguous else axis_indices - axis_indices[0])
+        else:
+            # h5py reads a list of indices along one axis directly
+            selection.append(list(axis_indices))
+            takes.append(None)
+    selection.append(slice(None))
+    data = dset[tuple(selection)]
+    for axis, take in enumerate(takes):
+        if take is not None:
+            data = np.take(data, take, axis=axis)
+    return data
+
+def load_resampled_state(source, solver, index=-1):
+    """
+    Load the solver state from a checkpoint source (JoinedCheckpoint or
+    ProcessCheckpoint), possibly at a different resolution or z basis layout,
+    like solver.load_state.
+
+    Each process reads the old coefficients its local part of the new
+    coefficients depend on, pads or truncates them in the Fourier
+    directions and re-projects them in z.  The z direction is local in
+    coefficient space, so no communication is needed.
+
+    Returns
+    -------
+    write : int
+        Global write number of loaded write
+    dt : float
+        Timestep at loaded write
+    """
+    domain = solver.domain
+    layout = domain.dist.coeff_layout
+    z_basis = domain.bases[-1]
+    logger.info("Loading and resampling solver state from: {}".format(source.path))
+    file = source.file
+    write = file['scales']['write_number'][index]
+    try:
+        dt = file['scales']['timestep'][index]
+    except KeyError:
+        dt = None
+    solver.iteration = solver.initial_iteration = file['scales']['iteration'][index]
+    solver.sim_time = solver.initial_sim_time = file['scales']['sim_time'][index]
+    logger.info("Loading iteration: {}".format(solver.iteration))
+    logger.info("Loading write: {}".format(write))
+    logger.info("Loading sim time: {}".format(solver.sim_time))
+    logger.info("Loading timestep: {}".format(dt))
+
+    old_shape = source.shape(solver.state.fields[0].name)
+    old_z_layout = read_basis_layout(file, z_basis.name)
+    if old_z_layout is None:
+        if len(getattr(z_basis, 'subbases', (z_basis,))) > 1:
+            raise ValueError("checkpoint has no record of its z basis layout; cannot resample onto a compound basis")
+        old_z_layout = {'intervals': np.array([z_basis.interval]), 'sizes': np.array([old_shape[-1]])}
+    new_z_layout = basis_layout(z_basis)
+    if not np.allclose(old_z_layout['intervals'][[0,-1],[0,1]], new_z_layout['intervals'][[0,-1],[0,1]]):
+        logger.warning("checkpoint z interval {} differs from the domain's {}".format(
+                       old_z_layout['intervals'][[0,-1],[0,1]], new_z_layout['intervals'][[0,-1],[0,1]]))
+    logger.info("resampling from coefficient shape {} (z domains {}) to {} (z domains {})".format(
+                tuple(old_shape), list(old_z_layout['sizes']),
+                tuple(domain.global_coeff_shape), list(new_z_layout['sizes'])))
+    if (np.array_equal(old_z_layout['sizes'], new_z_layout['sizes']) and
+        np.allclose(old_z_layout['intervals'], new_z_layout['intervals'])):
+        projection = None
+    else:
+        projection = chebyshev_projection(old_z_layout, z_basis)
+
+    start = layout.start(scales=1)
+    local_shape = layout.local_shape(scales=1)
+    # old indices of the local new coefficients along each Fourier axis
+    index_maps = [fourier_index_map(basis, old_shape[axis], start[axis] + np.arange(local_shape[axis]))
+                  for axis, basis in enumerate(domain.bases[:-1])]
+    valid = [index_map >= 0 for index_map in index_maps]
+    for field in solver.state.fields:
+        if np.any(file['tasks'][field.name].attrs['grid_space']):
+            raise ValueError("can only resample checkpoints written in coefficient space")
+        local_data = np.zeros(tuple(local_shape[:-1]) + (old_shape[-1],), dtype=field['c'].dtype)
+        if all(np.any(v) for v in valid):
+            old_indices = [index_map[v] for index_map, v in zip(index_maps, valid)]
+            local_data[np.ix_(*valid, np.ones(old_shape[-1], dtype=bool))] = source.read(field.name, index, old_indices)
+        if projection is None:
+            field['c'] = local_data
+        else:
+            field['c'] = local_data @ projection.T
+
+    return write, dt
@@ -0,0 +1,131 @@
+import numpy as np
+from mpi4py import MPI
+
+import logging
+logger = logging.getLogger(__name__.split('.')[-1])
+
+def spectral_tail(solver, fraction=0.1):
+    """Global fraction of the state's coefficient energy in the highest `fraction` of z modes.
+
+    z is the last axis, which is local in coefficient space, so this costs a
+    single allreduce.
+    """
+    energy = np.zeros(2, dtype=np.float64)
+    for field in solver.state.fields:
+        power = np.abs(field['c'])**2
+        if power.size == 0:
+            continue
+        n_tail = max(1, int(np.ceil(fraction*power.shape[-1])))
+        energy[0] += np.sum(power[..., -n_tail:])
+        energy[1] += np.sum(power)
+    solver.domain.dist.comm_cart.Allreduce(MPI.IN_PLACE, energy, op=MPI.SUM)
+    if energy[1] == 0:
+        return 0.
+    return energy[0]/energy[1]
+
+class FlowDiagnostics:
+    """Global flow properties and CFL timestep from a single reduction.
+
+    A replacement for dedalus.extras.flow_tools.GlobalFlowProperty used
+    alongside tools.cfl.CFL.  Properties are evaluated every `cadence`
+    iterations, and on those iterations their grid averages and maxima are
+    packed together with the CFL frequency into one allreduce (summing the
+    averages and taking the max of everything else).  On other iterations only
+    the CFL frequency is reduced.  Non-finite values propagate through the
+    reduction, so a blow-up shows up in the next timestep on every process.
+    """
+    def __init__(self, solver, CFL, cadence=1):
+        """
+        Parameters
+        ----------
+        solver : dedalus solver
+            Initial value solver being timestepped.
+        CFL : tools.cfl.CFL
+            Primary CFL, used to compute the timestep every iteration.
+        cadence : int, optional
+            Iteration cadence for evaluating and reporting properties (default: 1)
+        """
+        self.solver = solver
+        self.CFL = CFL
+        self.cadence = cadence
+        self.comm = solver.domain.dist.comm_cart
+        self.properties = solver.evaluator.add_dictionary_handler(iter=cadence)
+        self.names = []
+        self.report_CFLs = []
+        self._averages = dict()
+        self._maxes = dict()
+        self._dts = dict()
+        self.reported = False
+        self._op = None
+        self._n_sum = 0
+
+    def add_property(self, property, name):
+        """Add a property on the grid, reported as an average and max."""
+        self.properties.add_task(property, layout='g', name=name)
+        self.names.append(name)
+
+    def add_CFL(self, CFL, name):
+        """Add a secondary CFL, whose timestep is only computed on report iterations."""
+        self.report_CFLs.append((name, CFL))
+
+    def fresh(self):
+        """True if the properties were evaluated on the previous step."""
+        iteration = self.solver.iteration
+        if iteration - 1 < self.solver.initial_iteration:
+            return False
+        return (iteration-1) % self.cadence == 0 or (iteration-1) == self.solver.initial_iteration
+
+    def _reduce_op(self, n_sum):
+        """MPI op that sums the first n_sum entries and maxes the rest."""
+        if self._op is None or self._n_sum != n_sum:
+            if self._op is not None:
+                self._op.Free()
+            def sum_max(inbuf, outbuf, datatype):
+                a = np.frombuffer(inbuf, dtype=np.float64)
+                b = np.frombuffer(outbuf, dtype=np.float64)
+                b[:n_sum] += a[:n_sum]
+                np.maximum(a[n_sum:], b[n_sum:], out=b[n_sum:])
+            self._op = MPI.Op.Create(sum_max, commute=True)
+            self._n_sum = n_sum
+        return self._op
+
+    def compute_dt(self):
+        """Reduce the CFL frequency (and properties, if fresh) and return the timestep.
+
+        Properties are only available through grid_average, max and dt when
+        reported is True after this call.
+        """
+        self.reported = self.fresh()
+        if not self.reported:
+            return self.CFL.compute_dt()
+
+        sums, maxes = [], []
+        for name in self.names:
+            gdata = self.properties[name]['g']
+            sums += [np.sum(gdata), gdata.size]
+            maxes.append(np.max(gdata) if gdata.size else -np.inf)
+        CFLs = [self.CFL] + [CFL for name, CFL in self.report_CFLs]
+        maxes += [CFL.local_max_frequency() for CFL in CFLs]
+        n_sum = len(sums)
+        buffer = np.array(sums + maxes, dtype=np.float64)
+        self.comm.Allreduce(MPI.IN_PLACE, buffer, op=self._reduce_op(n_sum))
+
+        for i, name in enumerate(self.names):
+            self._averages[name] = buffer[2*i] / buffer[2*i+1]
+            self._maxes[name] = buffer[n_sum+i]
+        freqs = buffer[n_sum+len(self.names):]
+        for (name, CFL), freq in zip(self.report_CFLs, freqs[1:]):
+            self._dts[name] = CFL.compute_dt(max_global_freq=freq)
+        return self.CFL.compute_dt(max_global_freq=freqs[0])
+
+    def grid_average(self, name):
+        """Global mean of a property on the grid, from the last report."""
+        return self._averages[name]
+
+    def max(self, name):
+        """Global max of a property on the grid, from the last report."""
+        return self._maxes[name]
+
+    def dt(self, name):
+        """Timestep from a secondary CFL, from the last report."""
+        return self._dts[name]
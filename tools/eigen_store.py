@@ -0,0 +1,72 @@
+import json
+import sqlite3
+import numpy as np
+import logging
+logger = logging.getLogger(__name__.split('.')[-1])
+
+class EigenStore:
+    """Persistent, keyed store of eigenvalue solves.
+
+    Growth rates are stored in an SQLite database keyed on a problem
+    configuration (atmosphere, equations, boundary conditions and resolution)
+    together with the (Ra, kx, ky) point that was solved, so that overlapping
+    onset sweeps, refinements and resolution studies can reuse earlier work.
+
+    The database should only be accessed from one process of a run (e.g. the
+    OnsetGrid master); separate runs may share a database file.
+    """
+    def __init__(self, filename, config, precision=12):
+        """
+        Parameters
+        ----------
+        filename : str
+            SQLite database file; created if it does not exist.
+        config : dict
+            Problem configuration.  Must be JSON serializable (numpy scalars and
+            other objects are stored by their string representation).
+        precision : int, optional
+            Significant digits used when matching parameter values.
+        """
+        self.filename = str(filename)
+        self.precision = precision
+        self.config = json.dumps(config, sort_keys=True, default=str)
+        self.hits = 0
+        self.misses = 0
+        with self._connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS solves (
+                              config TEXT, ra TEXT, kx TEXT, ky TEXT,
+                              growth REAL, freq REAL,
+                              PRIMARY KEY (config, ra, kx, ky))""")
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=60)
+
+    def _key(self, ra, kx, ky):
+        fmt = '{{:.{:d}g}}'.format(self.precision)
+        return (self.config, fmt.format(float(ra)), fmt.format(float(kx)), fmt.format(float(ky)))
+
+    def get(self, ra, kx, ky=0):
+        """Stored complex growth rate at (ra, kx, ky), or None if never solved."""
+        with self._connect() as db:
+            row = db.execute("SELECT growth, freq FROM solves WHERE config=? AND ra=? AND kx=? AND ky=?",
+                             self._key(ra, kx, ky)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        growth, freq = (np.nan if v is None else v for v in row)
+        return np.complex128(growth + 1j*freq)
+
+    def put(self, params, value):
+        """Store the complex growth rate at params = (ra, kx[, ky])."""
+        ra, kx, ky = (tuple(params) + (0,))[:3]
+        value = np.complex128(value)
+        growth = None if np.isnan(value.real) else float(value.real)
+        freq   = None if np.isnan(value.imag) else float(value.imag)
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO solves VALUES (?, ?, ?, ?, ?, ?)",
+                       self._key(ra, kx, ky) + (growth, freq))
+
+    def __len__(self):
+        with self._connect() as db:
+            return db.execute("SELECT COUNT(*) FROM solves WHERE config=?", (self.config,)).fetchone()[0]
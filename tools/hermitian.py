@@ -0,0 +1,100 @@
+import numpy as np
+from mpi4py import MPI
+
+import logging
+logger = logging.getLogger(__name__.split('.')[-1])
+
+class HermitianMonitor:
+    """Hermitian symmetry enforcement of the state, only when it has drifted.
+
+    With real grid data, the kx=0 coefficients of every state field should be
+    Hermitian in the transverse wavenumbers, c(0,-ky,z) = conj(c(0,ky,z)) (in
+    2D, c(0,z) real).  Timestepping in coefficient space lets the
+    anti-Hermitian part, the imaginary part of the kx=0 modes in grid space,
+    drift away from zero.  Transforming the state to grid space projects it
+    out, but costs a full set of backward transforms.
+
+    Every `cadence` iterations the drift is measured from the kx=0
+    coefficients, as the norm of their anti-Hermitian part relative to their
+    norm (over all state fields, with a single reduction of two scalars), and
+    the projection is done only if it exceeds `threshold`.  When ky is
+    distributed (a 2D process mesh), only the ky pairs whose partner is on the
+    same process are measured.
+    """
+    def __init__(self, solver, cadence=100, threshold=1e-10):
+        """
+        Parameters
+        ----------
+        solver : dedalus solver
+            Initial value solver being timestepped.
+        cadence : int, optional
+            Iterations between drift measurements (default: 100).
+        threshold : float, optional
+            Relative anti-Hermitian drift of the kx=0 modes above which the
+            state is projected (default: 1e-10).
+        """
+        self.solver = solver
+        self.cadence = cadence
+        self.threshold = threshold
+        self.comm = solver.domain.dist.comm_cart
+        self.checks = 0
+        self.projections = 0
+        self.max_drift = 0.
+        self._sums = np.zeros(2, dtype=np.float64)
+
+    def due(self):
+        """True if the drift should be measured after this iteration."""
+        return self.solver.iteration % self.cadence == 0
+
+    def _local_sums(self, field):
+        """Local squared norms of the anti-Hermitian part and of the kx=0 coefficients of field."""
+        layout = field.layout
+        if any(layout.grid_space):
+            # already (partly) in grid space, so real
+            return 0., 0.
+        scales = field.scales
+        start = layout.start(scales)
+        if start[0] != 0:
+            return 0., 0.
+        plane = field.data[0]
+        if field.domain.dim > 2:
+            # pair each local ky with -ky, where that is local too
+            n_ky = layout.global_shape(scales)[1]
+            ky = start[1] + np.arange(plane.shape[0])
+            partner = (-ky) % n_ky - start[1]
+            local = (partner >= 0) & (partner < plane.shape[0])
+            plane, mirror = plane[local], plane[partner[local]]
+        else:
+            mirror = plane
+        anti_hermitian = 0.5*(plane - np.conj(mirror))
+        return np.sum(np.abs(anti_hermitian)**2), np.sum(np.abs(plane)**2)
+
+    def drift(self):
+        """Global relative anti-Hermitian drift of the kx=0 modes of the state."""
+        self._sums[:] = 0.
+        for field in self.solver.state.fields:
+            self._sums += self._local_sums(field)
+        self.comm.Allreduce(MPI.IN_PLACE, self._sums, op=MPI.SUM)
+        anti_hermitian, total = self._sums
+        if total == 0:
+            return 0.
+        return np.sqrt(anti_hermitian/total)
+
+    def check(self):
+        """Measure the drift; returns True if the state should be projected."""
+        drift = self.drift()
+        self.checks += 1
+        self.max_drift = max(self.max_drift, drift)
+        return not drift <= self.threshold
+
+    def project(self):
+        """Enforce Hermitian symmetry by transforming the state to grid space."""
+        for field in self.solver.state.fields:
+            field.require_grid_space()
+        self.projections += 1
+
+    def log_summary(self):
+        if self.checks == 0:
+            return
+        logger.info('Hermitian symmetry: {:d} projections in {:d} checks (threshold {:.1e}, max drift {:.3e})'.format(
+                    self.projections, self.checks, self.threshold, self.max_drift))
@@ -0,0 +1,219 @@
+"""
+Batched linear stability of a single polytrope over many horizontal wavenumbers.
+
+Builds the 1D (z-only) FC eigenvalue problem with FC_polytrope_2d, splits its
+matrices into their kx dependence,
+
+    L(kx) = L0 + kx*L1 + kx**2*L2,      M independent of kx,
+
+and then solves the dense generalized eigenproblem for every kx in a thread
+pool, without eigentools or MPI.  Dedalus only has to assemble three problems
+per Rayleigh number, however many wavenumbers are requested.
+
+Usage:
+    python3 -m tools.linear_stability [options]
+
+Options:
+    --rayleigh_start=<Ra>       Rayleigh number start [default: 10]
+    --rayleigh_stop=<Ra>        Rayleigh number stop [default: 1e4]
+    --rayleigh_steps=<steps>    Number of Rayleigh numbers (log spaced) [default: 20]
+    --kx_start=<kx>             kx to start at, in units of 2*pi/Lz [default: 0.1]
+    --kx_stop=<kx>              kx to stop at [default: 2]
+    --kx_steps=<steps>          Number of kx (linearly spaced) [default: 100]
+
+    --nz=<nz>                   z (chebyshev) resolution [default: 32]
+    --n_rho=<n_rho>             nrho of polytrope [default: 3]
+    --epsilon=<epsilon>         epsilon of polytrope [default: 0.5]
+    --gamma=<gamma>             Gamma of polytrope [default: 5/3]
+    --Prandtl=<Pr>              Prandtl number [default: 1]
+    --bcs=<bcs>                 Boundary conditions ('fixed', 'mixed', or 'flux') [default: fixed]
+
+    --threads=<threads>         Number of solver threads (default: all cores)
+    --out=<out>                 Output file stem [default: linear_stability]
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.linalg
+from mpi4py import MPI
+
+import logging
+logger = logging.getLogger(__name__.split('.')[-1])
+
+
+def kx_matrices(atmosphere, ra, *eqn_args, bc_kwargs={}, **eqn_kwargs):
+    """
+    Assemble the dense matrices of the 1D eigenvalue problem for atmosphere at
+    Rayleigh number ra, split into their kx dependence.
+
+    Returns M, L0, L1, L2 such that the eigenproblem at physical wavenumber kx
+    is (L0 + kx*L1 + kx**2*L2) X = -omega M X.
+    """
+    L = {}
+    for kx in (0, 1, -1):
+        atmosphere.set_eigenvalue_problem(ra, *eqn_args, kx=kx, **eqn_kwargs)
+        atmosphere.set_BC(**bc_kwargs)
+        solver = atmosphere.get_problem().build_solver()
+        pencil = solver.pencils[0]
+        pencil.build_matrices(solver.problem, ['M', 'L'])
+        L[kx] = pencil.L_exp.toarray()
+        if kx == 0:
+            M = pencil.M_exp.toarray()
+    L0 = L[0]
+    L1 = (L[1] - L[-1])/2
+    L2 = (L[1] + L[-1])/2 - L0
+    return M, L0, L1, L2
+
+
+def growth_rate(M, L0, L1, L2, kx):
+    """
+    Complex eigenvalue with the largest real part (growth + 1j*frequency) at
+    physical wavenumber kx, or nan if there are no finite eigenvalues.
+    """
+    evals = scipy.linalg.eigvals(L0 + kx*L1 + kx**2*L2, b=-M,
+                                 overwrite_a=True, check_finite=False)
+    evals = evals[np.isfinite(evals)]
+    if len(evals) == 0:
+        return np.nan
+    return evals[np.argmax(evals.real)]
+
+
+def eigenvalue_drift(lo, hi):
+    """
+    Boyd's nearest drift of the eigenvalues lo of a problem, against the
+    eigenvalues hi of the same problem at a higher resolution: the distance
+    from each eigenvalue of lo to the nearest of hi, relative to its
+    intermodal separation (the distance to the nearest other eigenvalue of
+    lo).  Unlike a drift relative to the eigenvalue itself, this stays small
+    for a resolved mode with zero growth, as at onset.
+    """
+    lo, hi = np.asarray(lo), np.asarray(hi)
+    nearest = np.abs(lo[:,None] - hi[None,:]).min(axis=1)
+    if len(lo) > 1:
+        separation = np.abs(lo[:,None] - lo[None,:])
+        np.fill_diagonal(separation, np.inf)
+        separation = separation.min(axis=1)
+    else:
+        separation = np.abs(lo)
+    return nearest/np.maximum(separation, np.finfo(np.float64).tiny)
+
+
+def resolved_eigenvalues(lo, hi, drift_tol=1e-6):
+    """Eigenvalues of lo reproduced in hi, with eigenvalue_drift below drift_tol."""
+    lo, hi = np.asarray(lo), np.asarray(hi)
+    if len(lo) == 0 or len(hi) == 0:
+        return lo[:0]
+    return lo[eigenvalue_drift(lo, hi) < drift_tol]
+
+
+def critical_rayleigh(ra, growth):
+    """
+    Onset Rayleigh number at each kx, from the first sign change of the growth
+    rate along Ra (interpolated in log Ra).  nan where there is no onset in range.
+
+    Arguments:
+        ra      - Rayleigh numbers, shape (n_ra,)
+        growth  - Growth rates, shape (n_ra, n_kx)
+    """
+    log_ra = np.log10(ra)
+    ra_crit = np.full(growth.shape[1], np.nan)
+    for j in range(growth.shape[1]):
+        g = growth[:,j]
+        crossings = np.flatnonzero((g[:-1] < 0) & (g[1:] >= 0))
+        if len(crossings) > 0:
+            i = crossings[0]
+            ra_crit[j] = 10**(log_ra[i] - g[i]*(log_ra[i+1] - log_ra[i])/(g[i+1] - g[i]))
+    return ra_crit
+
+
+def growth_surface(ra, kx, Prandtl=1, atmo_kwargs={}, bc_kwargs={}, threads=None):
+    """
+    Linear growth rates of an FC polytrope over a grid of Rayleigh numbers and
+    horizontal wavenumbers, on a single process.
+
+    Arguments:
+        ra          - Rayleigh numbers to solve at
+        kx          - Horizontal wavenumbers, in units of 2*pi/Lz (as in OnsetSolver)
+        Prandtl     - Prandtl number
+        atmo_kwargs - Keyword arguments for FC_polytrope_2d (nz, n_rho_cz, epsilon, ...)
+        bc_kwargs   - Keyword arguments for set_BC
+        threads     - Number of solver threads.  If None, use all cores.
+
+    Returns:
+        A dictionary of arrays:
+            ra, kx      - The input grids
+            growth      - Growth rate, shape (n_ra, n_kx)
+            freq        - Frequency of the fastest growing mode, shape (n_ra, n_kx)
+            ra_crit     - Onset Rayleigh number at each kx (nan if not in range)
+    """
+    from stratified_dynamics import polytropes
+
+    ra, kx = np.atleast_1d(ra).astype(np.float64), np.atleast_1d(kx).astype(np.float64)
+    if threads is None:
+        threads = os.cpu_count()
+    atmosphere = polytropes.FC_polytrope_2d(dimensions=1, comm=MPI.COMM_SELF,
+                                            grid_dtype=np.complex128, **atmo_kwargs)
+    kx_real = kx*2*np.pi/atmosphere.Lz
+
+    eigenvalues = np.zeros((len(ra), len(kx)), dtype=np.complex128)
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for i, ra_i in enumerate(ra):
+            M, L0, L1, L2 = kx_matrices(atmosphere, ra_i, Prandtl, bc_kwargs=bc_kwargs)
+            eigenvalues[i] = list(pool.map(lambda k: growth_rate(M, L0, L1, L2, k), kx_real))
+            logger.info('Ra = {:.4g} done ({}/{}, {:.2f} sec elapsed)'.format(
+                        ra_i, i+1, len(ra), time.time()-start_time))
+
+    growth = eigenvalues.real
+    return {'ra':      ra,
+            'kx':      kx,
+            'growth':  growth,
+            'freq':    eigenvalues.imag,
+            'ra_crit': critical_rayleigh(ra, growth)}
+
+
+if __name__ == "__main__":
+    import h5py
+    from docopt import docopt
+    from fractions import Fraction
+    args = docopt(__doc__)
+
+    ra = np.logspace(np.log10(float(args['--rayleigh_start'])),
+                     np.log10(float(args['--rayleigh_stop'])), int(args['--rayleigh_steps']))
+    kx = np.linspace(float(args['--kx_start']), float(args['--kx_stop']), int(args['--kx_steps']))
+    atmo_kwargs = {'nz':        int(args['--nz']),
+                   'n_rho_cz':  float(args['--n_rho']),
+                   'epsilon':   float(args['--epsilon']),
+                   'gamma':     float(Fraction(args['--gamma']))}
+    bcs = args['--bcs']
+    bc_kwargs = {'fixed_temperature':      bcs == 'fixed',
+                 'mixed_flux_temperature': bcs == 'mixed',
+                 'fixed_flux':             bcs == 'flux',
+                 'stress_free':            True}
+    threads = args['--threads']
+    if threads is not None:
+        threads = int(threads)
+
+    start_time = time.time()
+    surface = growth_surface(ra, kx, Prandtl=float(args['--Prandtl']), atmo_kwargs=atmo_kwargs,
+                             bc_kwargs=bc_kwargs, threads=threads)
+    logger.info('solved {} eigenproblems in {:.2f} sec'.format(len(ra)*len(kx), time.time()-start_time))
+
+    with h5py.File(args['--out']+'.h5', 'w') as outfile:
+        for key, data in surface.items():
+            outfile.create_dataset(key, data=data)
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    ax.plot(surface['kx'], surface['ra_crit'])
+    ax.set_xlabel('kx')
+    ax.set_ylabel('Ra_crit')
+    ax.set_yscale('log')
+    fig.savefig(args['--out']+'.png', dpi=150)
+    if np.any(np.isfinite(surface['ra_crit'])):
+        j = np.nanargmin(surface['ra_crit'])
+        logger.info('minimum Ra_crit = {:.5g} at kx = {:.5g}'.format(surface['ra_crit'][j], surface['kx'][j]))
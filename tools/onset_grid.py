@@ -0,0 +1,205 @@
+import pathlib
+import h5py
+import numpy as np
+import logging
+from mpi4py import MPI
+logger = logging.getLogger(__name__.split('.')[-1])
+
+TAG_READY = 1
+TAG_WORK  = 2
+TAG_STOP  = 3
+
+class OnsetGrid:
+    """Dynamically scheduled, resumable grid of eigenvalue solves.
+
+    Builds the same parameter grid as eigentools' CriticalFinder.grid_generator,
+    but hands grid points out one at a time from a master rank (rank 0) to
+    worker ranks as they become free, rather than statically splitting the
+    grid.  Every completed point is written to the grid file immediately, so
+    a run killed at walltime can be resumed and only the missing points are
+    solved.
+
+    The grid file uses the CriticalFinder.save_grid format ('grid' and 'xyz_i'
+    datasets) with an additional boolean 'done' dataset, so it can still be
+    read with CriticalFinder.load_grid.
+    """
+    def __init__(self, func, comm, mins, maxs, dims, logs=None, store=None):
+        """
+        Parameters
+        ----------
+        func : callable
+            Function called as func(*values) for each grid point, returning a
+            complex growth rate.
+        comm : MPI communicator
+            Communicator to distribute the grid points across.
+        mins, maxs : array-like
+            Minimum and maximum parameter values along each grid axis.
+        dims : array-like
+            Number of points along each grid axis.
+        logs : array-like, optional
+            If True along an axis, space points logarithmically.  Default is linear.
+        store : EigenStore, optional
+            Persistent result store.  Points found in the store are not solved
+            again, and newly solved points are added to it (master only).
+        """
+        self.func = func
+        self.store = store
+        self.comm = comm
+        self.rank = comm.rank
+        self.size = comm.size
+
+        self.dims = np.array(dims, dtype=np.int64)
+        if logs is None:
+            logs = np.array([False]*len(self.dims))
+        self.logs = np.array(logs)
+        self.N = len(self.dims)
+
+        self.axes = []
+        for i in range(self.N):
+            if self.logs[i]:
+                self.axes.append(np.logspace(np.log10(mins[i]), np.log10(maxs[i]), self.dims[i], dtype=np.float64))
+            else:
+                self.axes.append(np.linspace(mins[i], maxs[i], self.dims[i], dtype=np.float64))
+        self.xyz_grids = np.meshgrid(*self.axes, indexing='ij')
+        self.grid = np.zeros(self.dims, dtype=np.complex128)
+        self.done = np.zeros(self.dims, dtype=bool)
+
+    def values(self, index):
+        """Parameter values at a flat grid index."""
+        indices = np.unravel_index(index, self.dims)
+        return tuple(axis[i] for axis, i in zip(self.axes, indices))
+
+    def load(self, filename):
+        """Load completed points from a previous (possibly partial) grid file.
+
+        Returns True if the file matched this grid and was loaded.  Files
+        written before the 'done' dataset existed were only saved once the
+        whole grid was solved, and are treated as complete.
+        """
+        loaded = False
+        if self.rank == 0:
+            try:
+                with h5py.File(filename, 'r') as infile:
+                    grid = infile['grid'][:]
+                    xyz_grids = [infile['xyz_{}'.format(i)][:] for i in range(self.N)]
+                    if 'done' in infile:
+                        done = infile['done'][:]
+                    else:
+                        done = np.ones(grid.shape, dtype=bool)
+                if grid.shape == tuple(self.dims) and \
+                   all(np.allclose(a, b) for a, b in zip(xyz_grids, self.xyz_grids)):
+                    self.grid[:] = grid
+                    self.done[:] = done
+                    loaded = True
+                else:
+                    logger.info("grid in {} does not match requested grid; starting over".format(filename))
+            except (OSError, KeyError):
+                logger.info("could not load grid from {}; starting over".format(filename))
+        loaded = self.comm.bcast(loaded, root=0)
+        if loaded:
+            self.comm.Bcast(self.grid, root=0)
+            self.comm.Bcast(self.done, root=0)
+            logger.info("loaded {}/{} completed points from {}".format(np.sum(self.done), self.done.size, filename))
+        return loaded
+
+    def save(self, filename):
+        """Write the full grid file (master only)."""
+        if self.rank != 0:
+            return
+        with h5py.File(filename, 'w') as outfile:
+            outfile.create_dataset('grid', data=self.grid)
+            for i, grid in enumerate(self.xyz_grids):
+                outfile.create_dataset('xyz_{}'.format(i), data=grid)
+            outfile.create_dataset('done', data=self.done)
+
+    def _lookup(self, filename, todo):
+        """Fill points from the result store, returning those still to solve."""
+        remaining = []
+        for index in todo:
+            value = self.store.get(*self.values(index))
+            if value is None:
+                remaining.append(index)
+            else:
+                self._record(filename, index, value, store=False)
+        if len(remaining) < len(todo):
+            logger.info("{}/{} grid points found in result store {}".format(
+                        len(todo)-len(remaining), len(todo), self.store.filename))
+        return remaining
+
+    def _record(self, filename, index, value, store=True):
+        """Store a single completed point in memory and on disk."""
+        indices = np.unravel_index(index, self.dims)
+        if store and self.store is not None:
+            self.store.put(self.values(index), value)
+        self.grid[indices] = value
+        self.done[indices] = True
+        with h5py.File(filename, 'r+') as outfile:
+            outfile['grid'][indices] = value
+            outfile['done'][indices] = True
+
+    def solve(self, filename):
+        """Solve all points not already done, saving each one as it completes.
+
+        Rank 0 acts as the master and hands out grid points on request; with
+        a single process the points are solved serially.  On return, every
+        rank holds the full grid.
+        """
+        filename = str(pathlib.Path(filename))
+        todo = [int(i) for i in np.flatnonzero(~self.done.ravel())]
+        self.save(filename)
+        if self.rank == 0 and self.store is not None:
+            todo = self._lookup(filename, todo)
+        if self.rank == 0:
+            logger.info("solving {}/{} grid points on {} processes".format(len(todo), self.done.size, self.size))
+
+        if self.size == 1:
+            for n, index in enumerate(todo):
+                value = np.complex128(self.func(*self.values(index)))
+                self._record(filename, index, value)
+                logger.info("grid point {}/{} done".format(n+1, len(todo)))
+        elif self.rank == 0:
+            self._master(filename, todo)
+        else:
+            self._worker()
+
+        self.comm.Bcast(self.grid, root=0)
+        self.comm.Bcast(self.done, root=0)
+
+    def _master(self, filename, todo):
+        status = MPI.Status()
+        queue = list(todo)
+        n_done = 0
+        active_workers = self.size - 1
+        while active_workers > 0:
+            result = self.comm.recv(source=MPI.ANY_SOURCE, tag=TAG_READY, status=status)
+            worker = status.Get_source()
+            if result is not None:
+                index, value = result
+                self._record(filename, index, value)
+                n_done += 1
+                logger.info("grid point {}/{} done on process {}: {} -> {:.8g}".format(
+                            n_done, len(todo), worker, self.values(index), value))
+            if queue:
+                index = queue.pop(0)
+                self.comm.send((index, self.values(index)), dest=worker, tag=TAG_WORK)
+            else:
+                self.comm.send(None, dest=worker, tag=TAG_STOP)
+                active_workers -= 1
+
+    def _worker(self):
+        status = MPI.Status()
+        result = None
+        while True:
+            self.comm.send(result, dest=0, tag=TAG_READY)
+            task = self.comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+            if status.Get_tag() == TAG_STOP:
+                break
+            index, values = task
+            result = (index, np.complex128(self.func(*values)))
+
+    def attach(self, cf):
+        """Hand the solved grid to an eigentools CriticalFinder."""
+        cf.N = self.N
+        cf.logs = self.logs
+        cf.xyz_grids = self.xyz_grids
+        cf.grid = self.grid
@@ -0,0 +1,738 @@
+import os
+import re
+import json
+import time
+import socket
+import pathlib
+import itertools
+import h5py
+import numpy as np
+from mpi4py import MPI
+
+from dedalus.core.evaluator import FileHandler
+from dedalus.tools import post
+from dedalus.tools.general import natural_sort
+
+import logging
+logger = logging.getLogger(__name__.split('.')[-1])
+
+SINGLE_PRECISION = {np.dtype(np.float64): np.dtype(np.float32),
+                    np.dtype(np.complex128): np.dtype(np.complex64)}
+
+def chunk_shape(shape, itemsize, chunk_bytes=2**20):
+    """
+    Chunks of a task dataset of shape (writes,) + spatial shape: one write,
+    split along the first spatial axis into chunks of about chunk_bytes.
+    True (automatic chunking) for scalar and empty tasks.
+    """
+    spatial_shape = tuple(shape[1:])
+    if np.prod(spatial_shape) <= 1:
+        return True
+    row_bytes = np.prod(spatial_shape[1:], dtype=int)*itemsize
+    rows = int(min(spatial_shape[0], max(1, chunk_bytes // row_bytes)))
+    return (1, rows) + spatial_shape[1:]
+
+def dataset_options(shape, dtype, compression=None, compression_opts=None, shuffle=False, chunk_bytes=2**20):
+    """h5py create_dataset keyword arguments for the storage options of a task dataset."""
+    if compression is None and not shuffle:
+        return {}
+    return {'chunks': chunk_shape(shape, np.dtype(dtype).itemsize, chunk_bytes),
+            'compression': compression,
+            'compression_opts': compression_opts,
+            'shuffle': shuffle}
+
+def crop_indices(basis, size, modes):
+    """
+    Indices of the lowest modes of the size coefficients of basis: the first
+    modes wavenumbers of a real Fourier basis, the wavenumbers |k| < modes of
+    a complex Fourier basis, and the first modes Chebyshev coefficients of
+    each subbasis of a compound basis.
+    """
+    indices = np.arange(size)
+    subbases = getattr(basis, 'subbases', None)
+    if subbases is not None:
+        offsets = np.cumsum([0] + [subbasis.coeff_size for subbasis in subbases])
+        return np.concatenate([offset + np.arange(min(modes, subbasis.coeff_size))
+                               for offset, subbasis in zip(offsets, subbases)])
+    if basis.element_label == 'k' and basis.grid_dtype != np.float64:
+        # complex transform: wavenumbers 0..kmax, -kmax..-1
+        wavenumbers = np.where(indices <= (size-1)//2, indices, indices - size)
+        return indices[np.abs(wavenumbers) < modes]
+    return indices[:modes]
+
+def runs(indices):
+    """(start, count) of the runs of consecutive integers in sorted indices."""
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    return [(run[0], len(run)) for run in np.split(indices, breaks) if len(run) > 0]
+
+class StorageFileHandler(FileHandler):
+    """
+    FileHandler with HDF5 storage options for its task datasets: chunking,
+    shuffle and lossless compression, single precision storage, and
+    cropping coefficient space tasks to their lowest modes.
+
+    The data is still written from the double precision task fields; HDF5
+    converts it to the stored type.  Single precision is for analysis
+    output only, never for checkpoints or other output restarts read.
+    Filters and cropping need per-process files (parallel=False).
+
+    Cropped tasks are stored with only the kept modes, in order; the
+    dataset attributes crop_full_shape and crop_kept_<axis> (for each
+    cropped axis) give the full coefficient shape and the indices of the
+    stored modes, from which tools.analysis.Coeff reconstructs the full
+    spectra.
+    """
+    def __init__(self, base_path, *args, compression=None, compression_opts=None, shuffle=False,
+                 single_precision=False, chunk_bytes=2**20, crop=None, **kw):
+        """
+        Parameters (in addition to those of FileHandler)
+        ----------
+        compression : str, optional
+            HDF5 compression filter: 'gzip', 'lzf' or None (default: None).
+        compression_opts : int, optional
+            Compression level of 'gzip', 0 to 9 (default: 4).
+        shuffle : bool, optional
+            Byte shuffle the data before compressing, which helps floating
+            point data compress (default: False).
+        single_precision : bool, optional
+            Store float64 and complex128 tasks as float32 and complex64 (default: False).
+        chunk_bytes : int, optional
+            Approximate size of the chunks of filtered datasets; each chunk
+            is part of a single write (default: 1 MB).
+        crop : dict, optional
+            Number of modes kept in coefficient space tasks, by basis name,
+            e.g. {'x': 64, 'z': 96} (see crop_indices).  Bases not in crop,
+            and tasks in grid space, are stored in full (default: None).
+        """
+        FileHandler.__init__(self, base_path, *args, **kw)
+        if (compression is not None or shuffle or crop) and self.parallel:
+            raise ValueError("HDF5 filters and cropping need per-process files (parallel=False)")
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = shuffle
+        self.single_precision = single_precision
+        self.chunk_bytes = chunk_bytes
+        self.crop = dict(crop or {})
+
+    def kept_indices(self, layout, scales, constant):
+        """Global indices of the stored modes along each axis, or None where all are stored."""
+        kept = []
+        global_shape = layout.global_shape(scales)
+        for axis, basis in enumerate(self.domain.bases):
+            modes = self.crop.get(basis.name)
+            if modes is None or layout.grid_space[axis] or constant[axis]:
+                kept.append(None)
+            else:
+                kept.append(crop_indices(basis, global_shape[axis], modes))
+        return kept
+
+    def _local_kept(self, layout, scales, constant):
+        """Per cropped axis: local indices of the stored modes, and the kept indices below the local start."""
+        start = layout.start(scales)
+        local_shape = layout.local_shape(scales)
+        local = []
+        for axis, kept in enumerate(self.kept_indices(layout, scales, constant)):
+            if kept is None:
+                local.append(None)
+            else:
+                in_block = (kept >= start[axis]) & (kept < start[axis] + local_shape[axis])
+                local.append((kept[in_block] - start[axis], np.count_nonzero(kept < start[axis]), len(kept)))
+        return local
+
+    def get_write_stats(self, layout, scales, constant, index):
+        """FileHandler.get_write_stats, for the stored modes of cropped tasks."""
+        stats = FileHandler.get_write_stats(self, layout, scales, constant, index)
+        if not self.crop:
+            return stats
+        gnc_shape, gnc_start, write_shape, write_start, write_count = stats
+        for axis, local in enumerate(self._local_kept(layout, scales, np.array(constant))):
+            if local is not None:
+                local_indices, kept_start, kept_size = local
+                gnc_shape[axis] = kept_size
+                gnc_start[axis] = kept_start
+                write_count[axis] = len(local_indices)
+        return gnc_shape, gnc_start, write_count, 0*write_start, write_count
+
+    def get_hdf5_spaces(self, layout, scales, constant, index):
+        """FileHandler.get_hdf5_spaces, selecting the stored modes of cropped tasks."""
+        constant = np.array(constant)
+        local = self._local_kept(layout, scales, constant)
+        if all(axis_local is None for axis_local in local):
+            return FileHandler.get_hdf5_spaces(self, layout, scales, constant, index)
+        gnc_shape, gnc_start, write_shape, write_start, write_count = self.get_write_stats(layout, scales, constant, index)
+        # memory: the union of the blocks of consecutive stored modes
+        axis_runs = []
+        for axis, axis_local in enumerate(local):
+            if axis_local is None:
+                axis_runs.append([(0, write_count[axis])])
+            else:
+                axis_runs.append(runs(axis_local[0]))
+        memory_space = h5py.h5s.create_simple(tuple(layout.local_shape(scales)))
+        memory_space.select_none()
+        for block in itertools.product(*axis_runs):
+            block_start, block_count = zip(*block)
+            memory_space.select_hyperslab(tuple(block_start), tuple(block_count), op=h5py.h5s.SELECT_OR)
+        # file: the stored modes, in order
+        file_space = h5py.h5s.create_simple((index+1,) + tuple(write_shape))
+        file_space.select_hyperslab((index,) + tuple(write_start), (1,) + tuple(write_count))
+        return memory_space, file_space
+
+    def setup_file(self, file):
+        FileHandler.setup_file(self, _StorageFile(file, self))
+        for task in self.tasks:
+            layout, scales = task['layout'], task['scales']
+            constant = np.array(task['operator'].meta[:]['constant'])
+            kept = self.kept_indices(layout, scales, constant)
+            if any(axis_kept is not None for axis_kept in kept):
+                dset = file['tasks'][task['name']]
+                dset.attrs['crop_full_shape'] = layout.global_shape(scales)
+                for axis, axis_kept in enumerate(kept):
+                    if axis_kept is not None:
+                        dset.attrs['crop_kept_{:d}'.format(axis)] = axis_kept
+
+    def create_task_dataset(self, group, name, shape, dtype, **kw):
+        """Create a task dataset in group, with the storage options of the handler."""
+        dtype = np.dtype(dtype)
+        if self.single_precision:
+            dtype = SINGLE_PRECISION.get(dtype, dtype)
+        options = dataset_options(kw.get('maxshape', shape), dtype, compression=self.compression,
+                                  compression_opts=self.compression_opts, shuffle=self.shuffle,
+                                  chunk_bytes=self.chunk_bytes)
+        kw.update(options)
+        return group.create_dataset(name=name, shape=shape, dtype=dtype, **kw)
+
+class _StorageFile:
+    """An h5py file, creating its task datasets with the storage options of handler."""
+    def __init__(self, file, handler):
+        self._file = file
+        self._handler = handler
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __getitem__(self, name):
+        return self._file[name]
+
+    def create_group(self, name):
+        group = self._file.create_group(name)
+        if name == 'tasks':
+            return _StorageGroup(group, self._handler)
+        return group
+
+class _StorageGroup:
+    def __init__(self, group, handler):
+        self._group = group
+        self._handler = handler
+
+    def __getattr__(self, name):
+        return getattr(self._group, name)
+
+    def __getitem__(self, name):
+        return self._group[name]
+
+    def create_dataset(self, name, shape, dtype, **kw):
+        return self._handler.create_task_dataset(self._group, name, shape, dtype, **kw)
+
+def add_file_handler(solver, base_path, **kw):
+    """Add a StorageFileHandler to the solver's evaluator, like evaluator.add_file_handler."""
+    evaluator = solver.evaluator
+    handler = StorageFileHandler(base_path, evaluator.domain, evaluator.vars, **kw)
+    return evaluator.add_handler(handler)
+
+def storage_summary(handler):
+    """Short description of the storage options of a file handler."""
+    options = []
+    if getattr(handler, 'single_precision', False):
+        options.append('single precision')
+    if getattr(handler, 'shuffle', False):
+        options.append('shuffle')
+    if getattr(handler, 'compression', None) is not None:
+        options.append(handler.compression if handler.compression_opts is None
+                       else '{}{}'.format(handler.compression, handler.compression_opts))
+    if getattr(handler, 'crop', None):
+        options.append('cropped to ' + ', '.join('{:d} {} modes'.format(modes, name)
+                                                 for name, modes in sorted(handler.crop.items())))
+    return ', '.join(options) if options else 'uncompressed'
+
+def merge_setup(joint_file, proc_path, chunk_bytes=2**20):
+    """
+    post.merge_setup, keeping the dtype and filters of the process file task
+    datasets, so that joined files stay compressed.
+    """
+    proc_path = pathlib.Path(proc_path)
+    logger.debug("Merging setup from {}".format(proc_path))
+
+    with h5py.File(str(proc_path), mode='r') as proc_file:
+        # File metadata
+        try:
+            joint_file.attrs['set_number'] = proc_file.attrs['set_number']
+        except KeyError:
+            joint_file.attrs['set_number'] = proc_file.attrs['file_number']
+        joint_file.attrs['handler_name'] = proc_file.attrs['handler_name']
+        try:
+            joint_file.attrs['writes'] = writes = proc_file.attrs['writes']
+        except KeyError:
+            joint_file.attrs['writes'] = writes = len(proc_file['scales']['write_number'])
+        # Copy scales (distributed files all have global scales)
+        proc_file.copy('scales', joint_file)
+        # Tasks
+        joint_tasks = joint_file.create_group('tasks')
+        proc_tasks = proc_file['tasks']
+        for taskname in proc_tasks:
+            proc_dset = proc_tasks[taskname]
+            spatial_shape = proc_dset.attrs['global_shape']
+            joint_shape = (writes,) + tuple(spatial_shape)
+            options = dataset_options(joint_shape, proc_dset.dtype, compression=proc_dset.compression,
+                                      compression_opts=proc_dset.compression_opts, shuffle=proc_dset.shuffle,
+                                      chunk_bytes=chunk_bytes)
+            # automatic chunking if unfiltered, as post.merge_setup
+            options.setdefault('chunks', True)
+            joint_dset = joint_tasks.create_dataset(name=proc_dset.name,
+                                                    shape=joint_shape,
+                                                    dtype=proc_dset.dtype,
+                                                    **options)
+            # Dataset metadata
+            joint_dset.attrs['task_number'] = proc_dset.attrs['task_number']
+            joint_dset.attrs['constant'] = proc_dset.attrs['constant']
+            joint_dset.attrs['grid_space'] = proc_dset.attrs['grid_space']
+            joint_dset.attrs['scales'] = proc_dset.attrs['scales']
+            for name, value in proc_dset.attrs.items():
+                if name.startswith('crop_'):
+                    joint_dset.attrs[name] = value
+            # Dimension scales
+            for i, proc_dim in enumerate(proc_dset.dims):
+                joint_dset.dims[i].label = proc_dim.label
+                for scalename in proc_dim:
+                    scale = joint_file['scales'][scalename]
+                    joint_dset.dims.create_scale(scale, scalename)
+                    joint_dset.dims[i].attach_scale(scale)
+
+def merge_data(joint_file, proc_path, max_bytes=2**28):
+    """
+    post.merge_data, copying at most about max_bytes of a task at a time;
+    returns the number of bytes copied.
+    """
+    proc_path = pathlib.Path(proc_path)
+    logger.debug("Merging data from {}".format(proc_path))
+
+    nbytes = 0
+    with h5py.File(str(proc_path), mode='r') as proc_file:
+        for taskname in proc_file['tasks']:
+            joint_dset = joint_file['tasks'][taskname]
+            proc_dset = proc_file['tasks'][taskname]
+            # Merge across spatial distribution
+            start = proc_dset.attrs['start']
+            count = proc_dset.attrs['count']
+            spatial_slices = tuple(slice(s, s+c) for (s,c) in zip(start, count))
+            # Copy blocks of writes
+            write_bytes = np.prod(proc_dset.shape[1:], dtype=int)*proc_dset.dtype.itemsize
+            block = max(1, max_bytes // max(1, write_bytes))
+            writes = proc_dset.shape[0]
+            for first in range(0, writes, block):
+                write_slice = slice(first, min(first+block, writes))
+                joint_dset[(write_slice,) + spatial_slices] = proc_dset[write_slice]
+            nbytes += writes*write_bytes
+    return nbytes
+
+def merge_process_files_single_set(set_path, cleanup=False, max_bytes=2**28):
+    """
+    post.merge_process_files_single_set, keeping the storage options of the
+    process files and copying at most about max_bytes at a time; returns the
+    number of bytes copied.
+    """
+    set_path = pathlib.Path(set_path)
+    logger.debug("Merging set {}".format(set_path))
+
+    proc_paths = process_files(set_path)
+    joint_path = joined_path(set_path)
+
+    # Create joint file, overwriting if it already exists
+    with h5py.File(str(joint_path), mode='w') as joint_file:
+        # Setup joint file based on first process file (arbitrary)
+        merge_setup(joint_file, proc_paths[0])
+        # Merge data from all process files
+        nbytes = 0
+        for proc_path in proc_paths:
+            nbytes += merge_data(joint_file, proc_path, max_bytes=max_bytes)
+        # Mark the join complete
+        joint_file.attrs['joined_processes'] = len(proc_paths)
+    # Cleanup after completed merge, if directed
+    if cleanup:
+        remove_process_files(set_path)
+    return nbytes
+
+def merge_process_files(base_path, cleanup=False, comm=MPI.COMM_WORLD):
+    """post.merge_process_files, keeping the storage options of the process files."""
+    logger.info("Merging files from {}".format(base_path))
+
+    set_paths = post.get_assigned_sets(base_path, distributed=True, comm=comm)
+    for set_path in set_paths:
+        merge_process_files_single_set(set_path, cleanup=cleanup)
+
+def process_files(set_path):
+    """Per-process files of a set, in process order."""
+    set_path = pathlib.Path(set_path)
+    return natural_sort(set_path.glob("{}_p*.h5".format(set_path.stem)))
+
+def joined_path(set_path):
+    """Joined file of a set."""
+    set_path = pathlib.Path(set_path)
+    return set_path.parent.joinpath("{}.h5".format(set_path.stem))
+
+def remove_process_files(set_path):
+    for proc_path in process_files(set_path):
+        proc_path.unlink()
+    pathlib.Path(set_path).rmdir()
+
+def is_joined(set_path):
+    """
+    True if the joined file of a set was completed from all of its process
+    files, after their last write.
+    """
+    joint_path = joined_path(set_path)
+    proc_paths = process_files(set_path)
+    if not joint_path.exists() or not proc_paths:
+        return False
+    try:
+        with h5py.File(str(joint_path), mode='r') as joint_file:
+            if joint_file.attrs.get('joined_processes') != len(proc_paths):
+                return False
+    except OSError:
+        return False
+    return joint_path.stat().st_mtime >= max(path.stat().st_mtime for path in proc_paths)
+
+def closed_sets(base_path):
+    """
+    Distributed sets of a file handler that will not be written again.
+
+    Each process closes its file of a set before creating its file of the
+    next set, so a set is closed once a later set has at least as many
+    process files.
+    """
+    set_paths = distributed_sets(base_path)
+    closed = []
+    later_files = 0
+    for set_path in reversed(set_paths):
+        files = len(process_files(set_path))
+        if 0 < files <= later_files:
+            closed.append(set_path)
+        later_files = max(later_files, files)
+    return closed[::-1]
+
+def distributed_sets(base_path):
+    """Sets of a file handler that are still split into per-process files."""
+    base_path = pathlib.Path(base_path)
+    if not base_path.is_dir():
+        return []
+    return natural_sort(path for path in base_path.glob("{}_s*".format(base_path.stem)) if path.is_dir())
+
+def set_bytes(set_path):
+    """Size of the per-process files of a set."""
+    return sum(path.stat().st_size for path in pathlib.Path(set_path).glob('*.h5'))
+
+def assign_sets(set_paths, size):
+    """Divide sets between size processes, largest first to the least loaded."""
+    assigned = [[] for i in range(size)]
+    loads = np.zeros(size)
+    for nbytes, set_path in sorted(((set_bytes(path), path) for path in set_paths), key=lambda pair: -pair[0]):
+        rank = int(np.argmin(loads))
+        assigned[rank].append(set_path)
+        loads[rank] += nbytes
+    return assigned
+
+def merge_handlers(base_paths, cleanup=False, comm=MPI.COMM_WORLD, max_bytes=2**28):
+    """
+    Merge the per-process files of every set of several file handlers.
+
+    The sets of all the handlers are divided between the processes of comm
+    by size, rather than handler by handler, so that every process is busy
+    until the join is done.  Each process copies at most about max_bytes of
+    a task at a time.
+
+    Returns
+    -------
+    nbytes : int
+        Bytes joined, over all processes.
+    elapsed : float
+        Wall time of the join, in seconds.
+    """
+    start_time = time.time()
+    if comm.rank == 0:
+        set_paths = []
+        for base_path in base_paths:
+            for set_path in distributed_sets(base_path):
+                if not is_joined(set_path):
+                    set_paths.append(set_path)
+                elif cleanup:
+                    # already joined during the run (see StreamingJoiner)
+                    remove_process_files(set_path)
+        assigned = assign_sets(set_paths, comm.size)
+    else:
+        set_paths, assigned = None, None
+    local_sets = comm.scatter(assigned, root=0)
+    if comm.rank == 0:
+        logger.info("Merging {:d} sets from {}".format(len(set_paths), ', '.join(str(path) for path in base_paths)))
+
+    nbytes = 0
+    for set_path in local_sets:
+        nbytes += merge_process_files_single_set(set_path, cleanup=cleanup, max_bytes=max_bytes)
+    nbytes = comm.allreduce(nbytes, op=MPI.SUM)
+    elapsed = comm.allreduce(time.time() - start_time, op=MPI.MAX)
+    if comm.rank == 0 and set_paths:
+        logger.info("joined {:d} sets on {:d} processes: {:.3g} MB in {:.3g} sec ({:.3g} MB/sec)".format(
+                    len(set_paths), comm.size, nbytes/1e6, elapsed, nbytes/1e6/max(elapsed, 1e-6)))
+    return nbytes, elapsed
+
+TIME_SCALES = ('sim_time', 'world_time', 'wall_time', 'timestep', 'iteration', 'write_number')
+
+def set_number(path):
+    return int(re.search(r'_s(\d+)', pathlib.Path(path).name).group(1))
+
+def set_sources(base_path):
+    """
+    Files holding each set of a file handler, in set order: the joined (or
+    parallel) file if it is complete, otherwise the per-process files.
+    """
+    base_path = pathlib.Path(base_path)
+    stem = base_path.stem
+    sets = {}
+    for path in base_path.glob("{}_s*".format(stem)):
+        if path.is_dir():
+            if not is_joined(path):
+                sets[set_number(path)] = process_files(path)
+        elif path.suffix in ('.h5', '.hdf5'):
+            sets.setdefault(set_number(path), [path])
+    return [sets[number] for number in sorted(sets) if sets[number]]
+
+def virtual_join(base_path, virtual_path=None):
+    """
+    Join the sets of a file handler without copying, into a file of HDF5
+    virtual datasets mapping onto the joined, parallel or per-process files
+    of each set.
+
+    The virtual file has the layout of a joined file, with the writes of all
+    sets along the first axis, and reads like one (tools.analysis readers
+    take it in place of the set files).  Source paths are stored relative to
+    the virtual file, so the data directory can be moved, but the sets must
+    stay where they are; data missing from the sources reads as zero.
+
+    Parameters
+    ----------
+    base_path : str or pathlib.Path
+        Base path of the file handler output.
+    virtual_path : str or pathlib.Path, optional
+        Virtual file (default: <base_path>_virtual.h5, beside the handler
+        directory, so that globs of the handler directory do not find it).
+
+    Returns
+    -------
+    virtual_path : pathlib.Path
+    """
+    base_path = pathlib.Path(os.path.normpath(str(base_path)))
+    if virtual_path is None:
+        virtual_path = base_path.parent.joinpath("{}_virtual.h5".format(base_path.stem))
+    virtual_path = pathlib.Path(virtual_path)
+    sources = set_sources(base_path)
+    if not sources:
+        raise FileNotFoundError("no sets in {}".format(base_path))
+    logger.info("Virtual join of {:d} sets from {} into {}".format(len(sources), base_path, virtual_path))
+
+    def relative(path):
+        return os.path.relpath(str(path), str(virtual_path.parent))
+
+    # writes of each set, from its first file
+    writes = []
+    for paths in sources:
+        with h5py.File(str(paths[0]), mode='r') as file:
+            writes.append(len(file['scales']['sim_time']))
+    offsets = np.concatenate([[0], np.cumsum(writes)])
+    total_writes = int(offsets[-1])
+
+    with h5py.File(str(virtual_path), mode='w') as virtual_file, \
+         h5py.File(str(sources[0][0]), mode='r') as first_file:
+        virtual_file.attrs['set_number'] = 0
+        virtual_file.attrs['handler_name'] = first_file.attrs['handler_name']
+        virtual_file.attrs['writes'] = total_writes
+        virtual_file.attrs['sets'] = len(sources)
+
+        # Scales: time scales over all sets, spatial scales from the first set
+        scale_group = virtual_file.create_group('scales')
+        for name in first_file['scales']:
+            if name in TIME_SCALES:
+                dset = first_file['scales'][name]
+                layout = h5py.VirtualLayout(shape=(total_writes,), dtype=dset.dtype)
+                for paths, start, count in zip(sources, offsets, writes):
+                    layout[start:start+count] = h5py.VirtualSource(relative(paths[0]), dset.name, shape=(count,))
+                scale_group.create_virtual_dataset(name, layout)
+            else:
+                first_file.copy(first_file['scales'][name], scale_group)
+
+        # Tasks: writes of all sets, and the blocks of all processes
+        task_group = virtual_file.create_group('tasks')
+        for taskname in first_file['tasks']:
+            first_dset = first_file['tasks'][taskname]
+            if 'global_shape' in first_dset.attrs:
+                spatial_shape = tuple(first_dset.attrs['global_shape'])
+            else:
+                spatial_shape = first_dset.shape[1:]
+            layout = h5py.VirtualLayout(shape=(total_writes,) + spatial_shape, dtype=first_dset.dtype)
+            for paths, start, count in zip(sources, offsets, writes):
+                for path in paths:
+                    with h5py.File(str(path), mode='r') as file:
+                        dset = file['tasks'][taskname]
+                        if len(paths) > 1:
+                            spatial_slices = tuple(slice(s, s+c) for (s, c) in zip(dset.attrs['start'], dset.attrs['count']))
+                        else:
+                            spatial_slices = tuple(slice(None) for n in spatial_shape)
+                        source = h5py.VirtualSource(relative(path), dset.name, shape=dset.shape)
+                    layout[(slice(start, start+count),) + spatial_slices] = source[:count]
+            virtual_dset = task_group.create_virtual_dataset(taskname, layout, fillvalue=0)
+            # Dataset metadata
+            for name, value in first_dset.attrs.items():
+                if name not in ('global_shape', 'start', 'count') and not name.startswith('DIMENSION_'):
+                    virtual_dset.attrs[name] = value
+            virtual_dset.dims[0].label = 't'
+            for name in TIME_SCALES:
+                if name in scale_group:
+                    scale = scale_group[name]
+                    if not scale.is_scale:
+                        scale.make_scale(name)
+                    virtual_dset.dims[0].attach_scale(scale)
+    return virtual_path
+
+JOINER_LOCK = 'streaming_join.lock'
+JOINER_STOP = 'streaming_join.stop'
+
+class StreamingJoiner:
+    """
+    Join the sets of file handlers while the run is still writing them.
+
+    Run as a separate process alongside the simulation (see
+    join_streaming.py), it joins each set as soon as it is closed, so that
+    analysis can start during the run and only the last sets are left for
+    the end-of-run join, which skips sets that are already joined.
+
+    While it runs, the joiner keeps a lock file in the data directory; the
+    run asks it to stop before its own join (stop_streaming_join), so the
+    two never write the same set.
+    """
+    def __init__(self, data_dir, base_paths, cleanup=False, max_bytes=2**28):
+        """
+        Parameters
+        ----------
+        data_dir : str or pathlib.Path
+            Run output directory, holding the lock and stop files.
+        base_paths : list of str or pathlib.Path
+            Base paths of the file handlers to join.
+        cleanup : bool, optional
+            Delete the process files of each set once it is joined (default: False).
+        max_bytes : int, optional
+            Largest block of a task copied at a time (default: 256 MB).
+        """
+        self.data_dir = pathlib.Path(data_dir)
+        self.base_paths = [pathlib.Path(base_path) for base_path in base_paths]
+        self.cleanup = cleanup
+        self.max_bytes = max_bytes
+        self.lock_path = self.data_dir.joinpath(JOINER_LOCK)
+        self.stop_path = self.data_dir.joinpath(JOINER_STOP)
+        self.sets = 0
+        self.nbytes = 0
+        self.elapsed = 0.
+
+    def stopping(self):
+        return self.stop_path.exists()
+
+    def poll(self):
+        """Join every closed set that is not joined yet; returns the number joined."""
+        joined = 0
+        for base_path in self.base_paths:
+            for set_path in closed_sets(base_path):
+                if self.stopping():
+                    return joined
+                proc_paths = process_files(set_path)
+                start_time = time.time()
+                try:
+                    if not proc_paths or is_joined(set_path):
+                        continue
+                    nbytes = merge_process_files_single_set(set_path, cleanup=self.cleanup, max_bytes=self.max_bytes)
+                except OSError:
+                    if all(path.exists() for path in proc_paths):
+                        raise
+                    # deleted by the run (e.g. pruned) while it was being joined
+                    logger.info("{} was removed while joining; skipping it".format(set_path))
+                    if joined_path(set_path).exists():
+                        joined_path(set_path).unlink()
+                    continue
+                elapsed = time.time() - start_time
+                logger.info("joined {}: {:.3g} MB in {:.3g} sec".format(set_path, nbytes/1e6, elapsed))
+                self.sets += 1
+                self.nbytes += nbytes
+                self.elapsed += elapsed
+                joined += 1
+        return joined
+
+    def run(self, interval=60):
+        """Poll every interval seconds until the run asks the joiner to stop."""
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        if self.lock_path.exists():
+            logger.warning("{} exists; another joiner may be running on this data".format(self.lock_path))
+        if self.stop_path.exists():
+            self.stop_path.unlink()
+        self.lock_path.write_text("{}:{:d}\n".format(socket.gethostname(), os.getpid()))
+        try:
+            while not self.stopping():
+                if self.poll() == 0:
+                    time.sleep(interval)
+        finally:
+            self.lock_path.unlink()
+            if self.stop_path.exists():
+                self.stop_path.unlink()
+            self.log_summary()
+
+    def log_summary(self):
+        logger.info("streaming join: {:d} sets, {:.3g} MB in {:.3g} sec ({:.3g} MB/sec)".format(
+                    self.sets, self.nbytes/1e6, self.elapsed, self.nbytes/1e6/max(self.elapsed, 1e-6)))
+
+def stop_streaming_join(data_dir, timeout=600, poll=1):
+    """
+    Ask a StreamingJoiner working on data_dir to stop, and wait for it to
+    finish the set it is joining; returns False if it did not stop within
+    timeout seconds.  Call on one process only.
+    """
+    data_dir = pathlib.Path(data_dir)
+    lock_path = data_dir.joinpath(JOINER_LOCK)
+    if not lock_path.exists():
+        return True
+    data_dir.joinpath(JOINER_STOP).touch()
+    start_time = time.time()
+    while lock_path.exists():
+        if time.time() - start_time > timeout:
+            logger.warning("streaming joiner ({}) did not stop within {:g} sec".format(lock_path.read_text().strip(), timeout))
+            return False
+        time.sleep(poll)
+    return True
+
+def read_storage(storage):
+    """
+    Storage options by handler name, from a dictionary, a JSON string or a
+    JSON file, e.g. {"volumes": {"compression": "gzip", "shuffle": true,
+    "single_precision": true}, "checkpoint": {"compression": "lzf"}}.
+    """
+    if storage is None:
+        return {}
+    if isinstance(storage, dict):
+        return storage
+    path = pathlib.Path(storage)
+    if path.is_file():
+        storage = path.read_text()
+    return json.loads(storage)
+
+def read_crop(crop, names):
+    """
+    Crop option of StorageFileHandler from comma-separated numbers of modes,
+    one for each basis in names, e.g. read_crop('64,96', ('x', 'z')).
+    """
+    modes = [int(n) for n in crop.split(',')]
+    if len(modes) != len(names):
+        raise ValueError("need {:d} numbers of modes ({}), not {}".format(len(names), ','.join(names), crop))
+    return dict(zip(names, modes))
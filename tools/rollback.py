@@ -0,0 +1,179 @@
+from collections import deque
+
+import numpy as np
+
+from tools.diagnostics import spectral_tail
+
+import logging
+logger = logging.getLogger(__name__.split('.')[-1])
+
+class Rollback:
+    """In-memory snapshots of the solver state, for recovering from blow-ups.
+
+    Every `cadence` iterations the spectral tail of the state is checked and,
+    if it is healthy, a copy of the state in coefficient space (with the sim
+    time, iteration and timestep) is pushed onto a ring of the last `depth`
+    snapshots.  When a blow-up or one of its precursors is detected --- a
+    non-finite timestep or flow property, a spike in a flow property maximum,
+    or growth of the energy in the highest z modes --- the last good snapshot
+    is restored and the CFL safety factor is reduced before carrying on.  A
+    second recovery before a new snapshot is taken goes one snapshot further
+    back.
+
+    Only valid for timesteppers without history (the Runge-Kutta schemes used
+    by the drivers).  Output handlers are not rewound, so output between the
+    restored snapshot and the blow-up is not rewritten.
+    """
+    def __init__(self, solver, flow, cadence=100, depth=3, safety_reduction=0.5, max_recoveries=5,
+                 spike_property='Re', spike_factor=10, spike_window=10, tail_fraction=0.1, tail_growth=1e2):
+        """
+        Parameters
+        ----------
+        solver : dedalus solver
+            Initial value solver being timestepped (Runge-Kutta).
+        flow : tools.diagnostics.FlowDiagnostics
+            Flow properties and CFL of the run.
+        cadence : int, optional
+            Iterations between snapshots (default: 100).
+        depth : int, optional
+            Number of snapshots kept (default: 3).
+        safety_reduction : float, optional
+            Factor applied to the CFL safety factors on each recovery (default: 0.5).
+        max_recoveries : int, optional
+            Recoveries allowed before giving up (default: 5).
+        spike_property : str, optional
+            Flow property whose maximum is checked for spikes (default: 'Re').
+            If None, only non-finite values are trapped.
+        spike_factor : float, optional
+            A maximum more than spike_factor times the median of the previous
+            spike_window reports is a spike (default: 10).
+        spike_window : int, optional
+            Number of reports the spike reference is taken over (default: 10).
+        tail_fraction : float, optional
+            Fraction of the highest z modes counted as the spectral tail (default: 0.1).
+        tail_growth : float, optional
+            Growth of the tail energy fraction, relative to the smallest in the
+            snapshot ring, that triggers a recovery (default: 100).
+        """
+        if not hasattr(solver.timestepper, 'stages'):
+            raise ValueError("Rollback needs a Runge-Kutta timestepper (no step history)")
+        self.solver = solver
+        self.flow = flow
+        self.cadence = cadence
+        self.safety_reduction = safety_reduction
+        self.max_recoveries = max_recoveries
+        self.spike_property = spike_property
+        self.spike_factor = spike_factor
+        self.tail_fraction = tail_fraction
+        self.tail_growth = tail_growth
+
+        self.snapshots = deque(maxlen=depth)
+        self.spike_history = deque(maxlen=spike_window)
+        self.recoveries = 0
+        self._stale = False
+
+    @property
+    def CFLs(self):
+        return [self.flow.CFL] + [CFL for name, CFL in self.flow.report_CFLs]
+
+    def snapshot(self, tail=None):
+        """Push a copy of the current state onto the snapshot ring."""
+        solver = self.solver
+        if tail is None:
+            tail = self.tail_energy()
+        data = [np.copy(field['c']) for field in solver.state.fields]
+        self.snapshots.append({'data':      data,
+                               'sim_time':  solver.sim_time,
+                               'iteration': solver.iteration,
+                               'dt':        self.flow.CFL.stored_dt,
+                               'tail':      tail})
+        self._stale = False
+
+    def restore(self):
+        """Restore the last good snapshot; returns it, or None if there is none."""
+        if self._stale and len(self.snapshots) > 1:
+            self.snapshots.pop()
+        if not self.snapshots:
+            return None
+        snapshot = self.snapshots[-1]
+        solver = self.solver
+        for field, data in zip(solver.state.fields, snapshot['data']):
+            field['c'] = data
+        solver.sim_time = snapshot['sim_time']
+        solver.iteration = snapshot['iteration']
+        # the CFL frequencies and flow properties still hold the values from
+        # the blow-up: evaluate them on the restored state, and again on
+        # schedule on the iterations being retaken
+        handlers = [CFL.frequencies for CFL in self.CFLs] + [self.flow.properties]
+        solver.evaluate_handlers_now(snapshot['dt'], handlers=handlers)
+        for handler in handlers:
+            handler.last_iter_div = (solver.iteration - 1) // handler.iter
+        self.spike_history.clear()
+        self._stale = True
+        return snapshot
+
+    def tail_energy(self):
+        """Global fraction of state coefficient energy in the highest tail_fraction of z modes."""
+        return spectral_tail(self.solver, self.tail_fraction)
+
+    def check_flow(self):
+        """Reason for a recovery from the last flow report, or None if it looks healthy."""
+        flow = self.flow
+        for name in flow.names:
+            for value in (flow.grid_average(name), flow.max(name)):
+                if not np.isfinite(value):
+                    return '{} = {}'.format(name, value)
+        if self.spike_property is not None:
+            value = flow.max(self.spike_property)
+            if len(self.spike_history) == self.spike_history.maxlen:
+                reference = np.median(self.spike_history)
+                if value > self.spike_factor*reference:
+                    return 'max {} = {:.3e}, {:.3g} times the recent median'.format(
+                           self.spike_property, value, value/reference)
+            self.spike_history.append(value)
+        return None
+
+    def check_spectrum(self):
+        """Reason for a recovery from the spectral tail, or None; also returns the tail fraction."""
+        tail = self.tail_energy()
+        if not np.isfinite(tail):
+            return 'spectral tail = {}'.format(tail), tail
+        if self.snapshots:
+            reference = min(snapshot['tail'] for snapshot in self.snapshots)
+            if reference > 0 and tail > self.tail_growth*reference:
+                return 'spectral tail fraction {:.3e}, grown {:.3g} times'.format(tail, tail/reference), tail
+        return None, tail
+
+    def after_step(self):
+        """Check the spectrum and take a snapshot if due.  Returns a reason for a recovery, or None."""
+        if self.solver.iteration % self.cadence != 0:
+            return None
+        reason, tail = self.check_spectrum()
+        if reason is None:
+            self.snapshot(tail=tail)
+        return reason
+
+    def recover(self, reason):
+        """Roll back to the last good snapshot with a reduced CFL safety factor.
+
+        Returns False if there is nothing to roll back to or too many
+        recoveries have been made, in which case the run should stop.
+        """
+        solver = self.solver
+        logger.info('Blow-up detected at iteration {:d}, time {:.6e}: {}'.format(solver.iteration, solver.sim_time, reason))
+        if self.recoveries >= self.max_recoveries:
+            logger.info('Maximum number of recoveries ({:d}) reached.'.format(self.max_recoveries))
+            return False
+        snapshot = self.restore()
+        if snapshot is None:
+            logger.info('No snapshot to roll back to.')
+            return False
+        self.recoveries += 1
+        for CFL in self.CFLs:
+            CFL.safety *= self.safety_reduction
+        dt = self.safety_reduction*snapshot['dt']
+        self.flow.CFL.stored_dt = max(min(dt, self.flow.CFL.max_dt), self.flow.CFL.min_dt)
+        logger.info('Rolled back to iteration {:d}, time {:.6e} (recovery {:d}/{:d}); CFL safety now {:.3g}, dt {:.3e}'.format(
+                    solver.iteration, solver.sim_time, self.recoveries, self.max_recoveries,
+                    self.flow.CFL.safety, self.flow.CFL.stored_dt))
+        return True
@@ -0,0 +1,500 @@
+import time
+import signal
+import pathlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import h5py
+import numpy as np
+from mpi4py import MPI
+
+from tools import output
+from tools.checkpointing import Checkpoint
+from tools.telemetry import Telemetry
+
+import logging
+logger = logging.getLogger(__name__.split('.')[-1])
+
+PHASES = ('step', 'cfl', 'flow', 'evaluator', 'checkpoint', 'join')
+
+class PhaseTimers:
+    """Exclusive wall-clock timers for nested phases of a run.
+
+    Time spent in a phase entered while another is active is charged only to
+    the inner phase, so the totals add up to the time spent inside any phase.
+    """
+    def __init__(self, phases=PHASES):
+        self.totals = OrderedDict((phase, 0.) for phase in phases)
+        self.counts = OrderedDict((phase, 0) for phase in phases)
+        self._stack = []
+        self._start = None
+
+    def add_phases(self, *names):
+        """Add phases beyond the default set (no-op for existing phases)."""
+        for name in names:
+            self.totals.setdefault(name, 0.)
+            self.counts.setdefault(name, 0)
+
+    @contextmanager
+    def phase(self, name):
+        now = time.time()
+        if self._stack:
+            self.totals[self._stack[-1]] += now - self._start
+        self._stack.append(name)
+        self._start = now
+        try:
+            yield
+        finally:
+            now = time.time()
+            self.totals[name] += now - self._start
+            self.counts[name] += 1
+            self._stack.pop()
+            self._start = now
+
+    def wrap(self, function, name):
+        """Return function, timed under phase name."""
+        def timed(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+        return timed
+
+
+class RunController:
+    """Main loop, diagnostics, checkpointing and shutdown shared by the FC drivers.
+
+    Owns timestepping with a tools.diagnostics.FlowDiagnostics object, traps
+    non-finite timesteps and flow properties, writes the final checkpoint,
+    joins output, and reports run statistics.  The time spent in each phase
+    (step, cfl, flow, evaluator, checkpoint, join) is accumulated on every
+    process and written to an HDF5 timing log in the data directory, and
+    per-iteration timings are recorded with tools.telemetry.Telemetry.
+
+    The run stops early enough before solver.stop_wall_time to write the final
+    checkpoint and join output, using the checkpoint and join times of this
+    and previous runs (from the timing log) plus a margin, or on any of
+    shutdown_signals (e.g. SIGTERM from the batch system).  The stop decision
+    costs one extra Allreduce per iteration, carrying the wall time and the
+    signal flag, so every process stops on the same iteration.
+    """
+    def __init__(self, solver, atmosphere, flow, data_dir, checkpoint=None, analysis_tasks=None,
+                 hermitian=None, trap_property='Re', initial_time=None, timing_file='timing.h5',
+                 telemetry=True, detailed_telemetry=False, walltime_margin=60,
+                 shutdown_signals=(signal.SIGTERM, signal.SIGUSR1), rollback=None, safety=None,
+                 streaming_join_timeout=300):
+        """
+        Parameters
+        ----------
+        solver : dedalus solver
+            Initial value solver to timestep.
+        atmosphere : stratified_dynamics atmosphere
+            Atmosphere the problem was built from (used for time units and resolution).
+        flow : tools.diagnostics.FlowDiagnostics
+            Flow properties and CFL; provides the timestep.
+        data_dir : str
+            Run output directory.
+        checkpoint : tools.checkpointing.Checkpoint, optional
+            Periodic checkpoint, already set on the solver.
+        analysis_tasks : dict, optional
+            Analysis file handlers to join at the end of the run.
+        hermitian : tools.hermitian.HermitianMonitor, optional
+            If set, enforce Hermitian symmetry of the state when it has drifted (3D).
+        trap_property : str, optional
+            Flow property checked for finiteness on each report (default: 'Re').
+        initial_time : float, optional
+            Wall time the script started, for startup time statistics.
+        timing_file : str, optional
+            Name of the timing log, relative to data_dir (default: 'timing.h5').
+        telemetry : bool, optional
+            Record per-iteration telemetry to data_dir/telemetry.h5 (default: True).
+        detailed_telemetry : bool, optional
+            Include transforms, transposes and pencil solves in the telemetry (default: False).
+        walltime_margin : float, optional
+            Seconds reserved before solver.stop_wall_time on top of the estimated
+            final checkpoint and join time (default: 60).
+        shutdown_signals : tuple of signals, optional
+            Signals that start a graceful shutdown (default: SIGTERM, SIGUSR1).
+        rollback : tools.rollback.Rollback, optional
+            If set, recover from blow-ups by rolling back to an in-memory
+            snapshot instead of stopping the run.
+        safety : tools.cfl.SafetyController, optional
+            If set, adapt the CFL safety factor during the run.
+        streaming_join_timeout : float, optional
+            Seconds to wait for a streaming joiner (join_streaming.py) to
+            finish its current set before the end-of-run join (default: 300).
+        """
+        self.solver = solver
+        self.atmosphere = atmosphere
+        self.flow = flow
+        self.data_dir = data_dir
+        self.checkpoint = checkpoint
+        if analysis_tasks is None:
+            analysis_tasks = OrderedDict()
+        self.analysis_tasks = analysis_tasks
+        self.hermitian = hermitian
+        self.trap_property = trap_property
+        self.comm = solver.domain.dist.comm_cart
+        if initial_time is None:
+            initial_time = time.time()
+        self.initial_time = initial_time
+        self.timing_file = pathlib.Path(data_dir).joinpath(timing_file)
+
+        self.timers = PhaseTimers()
+        self.good_solution = True
+        self.dt = None
+        self.start_time = None
+        self.start_iter = solver.iteration
+        self.start_sim_time = solver.sim_time
+        self.walltime_margin = walltime_margin
+        self.shutdown_signals = shutdown_signals
+        self._signal = 0
+        self._old_handlers = {}
+        self._step_time = 0.
+        self._join = True
+        self._world_time = np.zeros(2, dtype=np.float64)
+        self._write_history, self._join_history = self._read_timing_history()
+        self.rollback = rollback
+        self.safety = safety
+        self.streaming_join_timeout = streaming_join_timeout
+        if rollback is not None:
+            self.timers.add_phases('rollback')
+        if hermitian is not None:
+            self.timers.add_phases('hermitian_check', 'hermitian')
+        self._instrument()
+        self.telemetry = None
+        if telemetry:
+            self.telemetry = Telemetry(solver, self.timers, data_dir, detailed=detailed_telemetry)
+
+    def _instrument(self):
+        """Time evaluator output and checkpoint writes inside solver.step."""
+        evaluator = self.solver.evaluator
+        evaluator.evaluate_scheduled = self.timers.wrap(evaluator.evaluate_scheduled, 'evaluator')
+        if self.checkpoint is not None:
+            handler = self.checkpoint.checkpoint
+            handler.process = self.timers.wrap(handler.process, 'checkpoint')
+
+    def _read_timing_history(self):
+        """Longest mean checkpoint write and join times of previous runs (rank 0; 0 elsewhere)."""
+        write, join = 0., 0.
+        if self.comm.rank != 0 or not self.timing_file.exists():
+            return write, join
+        try:
+            with h5py.File(str(self.timing_file), 'r') as infile:
+                for run in infile.values():
+                    if 'checkpoint' in run and run['checkpoint'].attrs['count'] > 0:
+                        write = max(write, run['checkpoint'][:].max()/run['checkpoint'].attrs['count'])
+                    if 'join' in run:
+                        join = max(join, run['join'][:].max())
+        except (OSError, KeyError):
+            logger.warning('cannot read timing history from {}'.format(self.timing_file))
+        return write, join
+
+    def shutdown_reserve(self):
+        """Wall time (sec) needed to take one more step, write the final checkpoint and join."""
+        if self.checkpoint is not None and self.checkpoint.asynchronous and self.checkpoint.writes:
+            # the checkpoint timer only sees the main loop part of asynchronous writes, but the final checkpoint is synchronous
+            write = np.mean([elapsed for nbytes, elapsed in self.checkpoint.writes])
+        elif self.timers.counts['checkpoint'] > 0:
+            write = self.timers.totals['checkpoint']/self.timers.counts['checkpoint']
+        else:
+            write = self._write_history
+        join = self._join_history if self._join else 0.
+        return self.walltime_margin + self._step_time + write + join
+
+    def _handle_signal(self, signum, frame):
+        logger.info('Received signal {:d}; shutting down after this iteration.'.format(signum))
+        self._signal = signum
+
+    def _set_signal_handlers(self):
+        self._old_handlers = {}
+        for signum in self.shutdown_signals:
+            try:
+                self._old_handlers[signum] = signal.signal(signum, self._handle_signal)
+            except ValueError:
+                # not in the main thread
+                break
+
+    def _restore_signal_handlers(self):
+        for signum, handler in self._old_handlers.items():
+            signal.signal(signum, handler)
+        self._old_handlers = {}
+
+    def proceed(self):
+        """Check the solver stop conditions, signals and the wall time reserved for shutdown.
+
+        Replaces solver.proceed, with a single allreduce of the wall time (plus
+        shutdown reserve) and received signal, so that all processes agree.
+        """
+        solver = self.solver
+        if solver.sim_time >= solver.stop_sim_time:
+            logger.info('Simulation stop time reached.')
+            return False
+        if solver.iteration >= solver.stop_iteration:
+            logger.info('Stop iteration reached.')
+            return False
+        reserve = self.shutdown_reserve()
+        self._world_time[0] = time.time() + reserve
+        self._world_time[1] = self._signal
+        self.comm.Allreduce(MPI.IN_PLACE, self._world_time, op=MPI.MAX)
+        if self._world_time[1]:
+            logger.info('Shutdown signal {:d} received.'.format(int(self._world_time[1])))
+            return False
+        if self._world_time[0] - solver.start_time >= solver.stop_wall_time:
+            logger.info('Wall stop time reached (reserved {:.1f} sec for final checkpoint and join).'.format(reserve))
+            return False
+        return True
+
+    @property
+    def effective_iter(self):
+        return self.solver.iteration - self.start_iter
+
+    def log_string(self, dt):
+        """Default report: iteration, time, dt and all flow properties."""
+        log_string = 'Iteration: {:5d}, Time: {:8.3e} ({:8.3e}), dt: {:8.3e}'.format(
+                     self.effective_iter, self.solver.sim_time,
+                     (self.solver.sim_time-self.start_sim_time)/self.atmosphere.buoyancy_time, dt)
+        for name in self.flow.names:
+            log_string += ', {}: {:8.3e}/{:8.3e}'.format(name, self.flow.grid_average(name), self.flow.max(name))
+        return log_string
+
+    def step(self, report=None):
+        """Take one timestep, reporting diagnostics if they are due.
+
+        Returns False if the run should stop because of a non-finite timestep
+        or trapped flow property.
+        """
+        solver, flow = self.solver, self.flow
+        start_time = time.time()
+        with self.timers.phase('flow' if flow.fresh() else 'cfl'):
+            dt = flow.compute_dt()
+        if not np.isfinite(dt):
+            return self._trap("timestep = {}".format(dt))
+        with self.timers.phase('step'):
+            solver.step(dt)
+            self.dt = dt
+        if self.hermitian is not None and self.hermitian.due():
+            with self.timers.phase('hermitian_check'):
+                project = self.hermitian.check()
+            if project:
+                with self.timers.phase('hermitian'):
+                    self.hermitian.project()
+
+        if flow.reported:
+            with self.timers.phase('flow'):
+                if report is None:
+                    logger.info(self.log_string(dt))
+                else:
+                    logger.info(report(self, dt))
+                if self.rollback is not None:
+                    reason = self.rollback.check_flow()
+                    if reason is not None:
+                        return self._trap(reason)
+                elif self.trap_property is not None:
+                    value = flow.grid_average(self.trap_property)
+                    if not np.isfinite(value):
+                        return self._trap("{} = {}".format(self.trap_property, value))
+                if self.safety is not None:
+                    self.safety.report()
+        if self.rollback is not None:
+            with self.timers.phase('rollback'):
+                reason = self.rollback.after_step()
+            if reason is not None:
+                return self._trap(reason)
+        if self.safety is not None:
+            with self.timers.phase('cfl'):
+                self.safety.after_step(dt)
+        self._step_time = time.time()-start_time
+        if self.telemetry is not None:
+            self.telemetry.record(dt, self._step_time)
+        return True
+
+    def _trap(self, reason):
+        """Roll back if possible, otherwise stop the run.  Returns False if the run should stop."""
+        if self.rollback is not None:
+            with self.timers.phase('rollback'):
+                if self.rollback.recover(reason):
+                    return True
+        logger.info("Terminating run.  Trapped on {}".format(reason))
+        self.good_solution = False
+        return False
+
+    def run(self, report=None, first_step=None, final_checkpoint=True, join=True, cleanup=False):
+        """Timestep until the solver stops, then shut down.
+
+        Parameters
+        ----------
+        report : callable, optional
+            Called as report(controller, dt) on report iterations; returns the
+            string to log.  Default is RunController.log_string.
+        first_step : callable, optional
+            Called as first_step(solver) after the first iteration.  The main
+            loop timer is restarted afterwards, so it excludes first-step setup.
+        final_checkpoint, join, cleanup : bool, optional
+            Passed to shutdown.
+        """
+        self._join = join
+        self._set_signal_handlers()
+        try:
+            logger.info('starting main loop')
+            if np.isfinite(self.solver.stop_wall_time):
+                logger.info('reserving {:.1f} sec before wall stop time for final checkpoint and join'.format(
+                            self.shutdown_reserve()))
+            self.start_time = time.time()
+            self.start_iter = self.solver.iteration
+            self.start_sim_time = self.solver.sim_time
+            if self.rollback is not None:
+                self.rollback.snapshot()
+            first = True
+            while self.good_solution and self.proceed():
+                if not self.step(report=report):
+                    break
+                if first:
+                    if first_step is not None:
+                        first_step(self.solver)
+                    first = False
+                    self.start_time = time.time()
+        except:
+            logger.error('Exception raised, triggering end of main loop.')
+            raise
+        finally:
+            self.end_time = time.time()
+            try:
+                self.shutdown(final_checkpoint=final_checkpoint, join=join, cleanup=cleanup)
+            finally:
+                self._restore_signal_handlers()
+
+    def save_final_checkpoint(self):
+        """Write the current state to data_dir/final_checkpoint, without taking another step."""
+        if self.dt is None:
+            return
+        try:
+            final_checkpoint = Checkpoint(self.data_dir, checkpoint_name='final_checkpoint')
+            # per-process files, joined below into final_checkpoint_s1.h5 as restarts expect
+            final_checkpoint.set_checkpoint(self.solver, mode="append", parallel=False)
+            handler = final_checkpoint.checkpoint
+            handler.process = self.timers.wrap(handler.process, 'checkpoint')
+            self.solver.evaluate_handlers_now(self.dt, handlers=[handler])
+            with self.timers.phase('join'):
+                output.merge_process_files(self.data_dir+'/final_checkpoint/', cleanup=False, comm=self.comm)
+        except:
+            logger.error('cannot save final checkpoint')
+
+    def join(self, cleanup=False):
+        """Merge per-process checkpoint and analysis files."""
+        with self.timers.phase('join'):
+            logger.info('beginning join operation')
+            if self.comm.rank == 0:
+                # a streaming joiner (join_streaming.py) may be joining sets during the run
+                output.stop_streaming_join(self.data_dir, timeout=self.streaming_join_timeout)
+            base_paths = [task.base_path for task in self.analysis_tasks.values()]
+            if self.checkpoint is not None:
+                base_paths.insert(0, self.data_dir+'/checkpoint/')
+            output.merge_handlers(base_paths, cleanup=cleanup, comm=self.comm)
+
+    def shutdown(self, final_checkpoint=True, join=True, cleanup=False):
+        """Final checkpoint, join, run statistics and timing log."""
+        solver = self.solver
+        end_time = self.end_time
+        if self.start_time is None:
+            self.start_time = end_time
+        elapsed_time = end_time - self.start_time
+        N_iterations = solver.iteration - self.start_iter
+        logger.info('main loop time: {:e}'.format(elapsed_time))
+        logger.info('Iterations: {:d}'.format(N_iterations))
+        if elapsed_time > 0:
+            logger.info('iter/sec: {:g}'.format(N_iterations/elapsed_time))
+        if N_iterations > 0:
+            logger.info('Average timestep: {:e}'.format((solver.sim_time - self.start_sim_time)/N_iterations))
+        if self.safety is not None:
+            self.safety.log_summary()
+        if self.hermitian is not None:
+            self.hermitian.log_summary()
+        if self.checkpoint is not None:
+            self.checkpoint.wait()
+            self.checkpoint.log_summary()
+
+        if final_checkpoint:
+            self.save_final_checkpoint()
+        if join:
+            self.join(cleanup=cleanup)
+
+        if self.telemetry is not None:
+            self.telemetry.close()
+        self.write_timing(elapsed_time, N_iterations)
+
+        if self.comm.rank == 0:
+            N_TOTAL_CPU = self.comm.size
+            nx, nz = self.atmosphere.nx, self.atmosphere.nz
+            print('-' * 40)
+            total_time = end_time-self.initial_time
+            main_loop_time = elapsed_time
+            startup_time = self.start_time-self.initial_time
+            n_steps = N_iterations
+            print('  startup time:', startup_time)
+            print('main loop time:', main_loop_time)
+            print('    total time:', total_time)
+            if n_steps > 0:
+                print('    iterations:', n_steps)
+                print(' loop sec/iter:', main_loop_time/n_steps)
+                print('    average dt:', (solver.sim_time - self.start_sim_time)/n_steps)
+                print("          N_cores, Nx, Nz, startup     main loop,   main loop/iter, main loop/iter/grid, n_cores*main loop/iter/grid")
+                print('scaling:',
+                    ' {:d} {:d} {:d}'.format(N_TOTAL_CPU,nx,nz),
+                    ' {:8.3g} {:8.3g} {:8.3g} {:8.3g} {:8.3g}'.format(startup_time,
+                                                                    main_loop_time,
+                                                                    main_loop_time/n_steps,
+                                                                    main_loop_time/n_steps/(nx*nz),
+                                                                    N_TOTAL_CPU*main_loop_time/n_steps/(nx*nz)))
+                print('phase times (max over processes, sec/iter):')
+                for phase, total in self._max_totals.items():
+                    print('  {:>10s}: {:8.3g}'.format(phase, total/n_steps))
+            print('-' * 40)
+
+    def write_timing(self, elapsed_time, N_iterations):
+        """Gather phase timers from all processes and write the timing log (rank 0)."""
+        totals = np.array(list(self.timers.totals.values()), dtype=np.float64)
+        counts = np.array(list(self.timers.counts.values()), dtype=np.int64)
+        all_totals = np.zeros((self.comm.size, len(totals)), dtype=np.float64) if self.comm.rank == 0 else None
+        self.comm.Gather(totals, all_totals, root=0)
+        self._max_totals = OrderedDict()
+        if self.comm.rank != 0:
+            return
+        for i, phase in enumerate(self.timers.totals.keys()):
+            self._max_totals[phase] = all_totals[:,i].max()
+        mode = 'a' if self.timing_file.exists() else 'w'
+        with h5py.File(str(self.timing_file), mode) as outfile:
+            run = outfile.create_group('run_{:d}'.format(len(outfile.keys())))
+            run.attrs['start_iteration'] = self.start_iter
+            run.attrs['iterations'] = N_iterations
+            run.attrs['main_loop_time'] = elapsed_time
+            run.attrs['startup_time'] = self.start_time - self.initial_time
+            run.attrs['processes'] = self.comm.size
+            run.attrs['nx'] = self.atmosphere.nx
+            run.attrs['nz'] = self.atmosphere.nz
+            for i, phase in enumerate(self.timers.totals.keys()):
+                dset = run.create_dataset(phase, data=all_totals[:,i])
+                dset.attrs['count'] = counts[i]
+        logger.info('timing log written to {}'.format(self.timing_file))
+
+
+def plot_sparsity_patterns(solver, data_dir, markersize=1, dpi=1200):
+    """Plot the sparsity of the first pencil's L matrix and LU factorization."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import scipy.sparse.linalg as sla
+    fig = plt.figure()
+    ax = fig.add_subplot(1,1,1)
+    ax.spy(solver.pencils[0].L, markersize=markersize, markeredgewidth=0.0)
+    fig.savefig(data_dir+"sparsity_pattern.png", dpi=dpi)
+
+    LU = sla.splu(solver.pencils[0].LHS.tocsc(), permc_spec='NATURAL')
+    fig = plt.figure()
+    ax = fig.add_subplot(1,2,1)
+    ax.spy(LU.L.A, markersize=1, markeredgewidth=0.0)
+    ax = fig.add_subplot(1,2,2)
+    ax.spy(LU.U.A, markersize=1, markeredgewidth=0.0)
+    fig.savefig(data_dir+"sparsity_pattern_LU.png", dpi=1200)
+
+    logger.info("{} nonzero entries in LU".format(LU.nnz))
+    logger.info("{} nonzero entries in LHS".format(solver.pencils[0].LHS.tocsc().nnz))
+    logger.info("{} fill in factor".format(LU.nnz/solver.pencils[0].LHS.tocsc().nnz))
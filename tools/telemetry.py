@@ -0,0 +1,137 @@
+import pathlib
+
+import h5py
+import numpy as np
+from mpi4py import MPI
+
+import logging
+logger = logging.getLogger(__name__.split('.')[-1])
+
+DETAILED_PHASES = ('transform', 'transpose', 'factor', 'solve')
+
+class Telemetry:
+    """Per-iteration performance record of a run.
+
+    Records the iteration, sim time, dt and wall time of every iteration, and
+    the time spent in each phase of a tools.run_controller.PhaseTimers during
+    that iteration.  With detailed=True the distributor transforms and
+    transposes and the pencil matrix factorizations and solves are timed as
+    well; these calls are frequent, so this adds some overhead and is off by
+    default.  Phase timers are exclusive, so e.g. transforms done while
+    evaluating output are charged to 'transform' rather than 'evaluator'.
+
+    Records are buffered and reduced (max over processes) every flush_cadence
+    iterations, with a single collective, then appended by rank 0 to a group
+    run_N in an HDF5 file in the data directory.  See analyze_telemetry.py.
+    """
+    def __init__(self, solver, timers, data_dir, detailed=False, flush_cadence=1000,
+                 filename='telemetry.h5'):
+        """
+        Parameters
+        ----------
+        solver : dedalus solver
+            Initial value solver being timestepped.
+        timers : tools.run_controller.PhaseTimers
+            Phase timers of the run.
+        data_dir : str
+            Run output directory.
+        detailed : bool, optional
+            Also time transforms, transposes and pencil solves (default: False).
+        flush_cadence : int, optional
+            Iterations buffered between writes (default: 1000).
+        filename : str, optional
+            Name of the telemetry file, relative to data_dir (default: 'telemetry.h5').
+        """
+        self.solver = solver
+        self.timers = timers
+        self.comm = solver.domain.dist.comm_cart
+        self.filename = pathlib.Path(data_dir).joinpath(filename)
+        self.detailed = detailed
+        self.flush_cadence = flush_cadence
+        if detailed:
+            self._instrument()
+        self.phases = list(self.timers.totals.keys())
+
+        self._iteration = np.zeros(flush_cadence, dtype=np.int64)
+        self._sim_time = np.zeros(flush_cadence, dtype=np.float64)
+        self._dt = np.zeros(flush_cadence, dtype=np.float64)
+        # wall time, then per-phase times; reduced together
+        self._times = np.zeros((flush_cadence, 1+len(self.phases)), dtype=np.float64)
+        self._n = 0
+        self._last_totals = np.array(list(self.timers.totals.values()))
+        self._group = None
+
+    def _instrument(self):
+        """Time distributor transforms/transposes and pencil factorizations/solves."""
+        timers = self.timers
+        timers.add_phases(*DETAILED_PHASES)
+        for path in self.solver.domain.dist.paths:
+            name = 'transpose' if type(path).__name__ == 'Transpose' else 'transform'
+            path.increment = timers.wrap(path.increment, name)
+            path.decrement = timers.wrap(path.decrement, name)
+
+        matsolver = self.solver.matsolver
+        def timed_matsolver(matrix, solver):
+            with timers.phase('factor'):
+                LHS_solver = matsolver(matrix, solver)
+            LHS_solver.solve = timers.wrap(LHS_solver.solve, 'solve')
+            return LHS_solver
+        self.solver.matsolver = timed_matsolver
+
+    def record(self, dt, wall_time):
+        """Record the iteration just taken, with timestep dt and wall_time seconds."""
+        totals = np.array(list(self.timers.totals.values()))
+        i = self._n
+        self._iteration[i] = self.solver.iteration
+        self._sim_time[i] = self.solver.sim_time
+        self._dt[i] = dt
+        self._times[i,0] = wall_time
+        self._times[i,1:] = totals - self._last_totals
+        self._last_totals = totals
+        self._n += 1
+        if self._n == self.flush_cadence:
+            self.flush()
+
+    def flush(self):
+        """Reduce buffered records across processes and append them to the file (rank 0)."""
+        n = self._n
+        if n == 0:
+            return
+        times = self._times[:n].copy()
+        max_times = np.zeros_like(times) if self.comm.rank == 0 else None
+        self.comm.Reduce(times, max_times, op=MPI.MAX, root=0)
+        if self.comm.rank == 0:
+            self._append(n, max_times)
+        self._n = 0
+
+    def _append(self, n, times):
+        mode = 'a' if self.filename.exists() else 'w'
+        with h5py.File(str(self.filename), mode) as outfile:
+            if self._group is None:
+                self._group = 'run_{:d}'.format(len(outfile.keys()))
+                run = outfile.create_group(self._group)
+                run.attrs['processes'] = self.comm.size
+                run.attrs['detailed'] = self.detailed
+                for name in ('iteration', 'sim_time', 'dt', 'wall_time'):
+                    dtype = np.int64 if name == 'iteration' else np.float64
+                    run.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(1024,))
+                phases = run.create_group('phases')
+                for phase in self.phases:
+                    phases.create_dataset(phase, shape=(0,), maxshape=(None,), dtype=np.float64, chunks=(1024,))
+            run = outfile[self._group]
+            columns = [('iteration', self._iteration[:n]),
+                       ('sim_time',  self._sim_time[:n]),
+                       ('dt',        self._dt[:n]),
+                       ('wall_time', times[:,0])]
+            columns += [('phases/'+phase, times[:,j+1]) for j, phase in enumerate(self.phases)]
+            for name, data in columns:
+                dset = run[name]
+                size = dset.shape[0]
+                dset.resize((size+n,))
+                dset[size:] = data
+
+    def close(self):
+        """Flush any remaining records."""
+        self.flush()
+        if self.comm.rank == 0 and self._group is not None:
+            logger.info('telemetry written to {}'.format(self.filename))
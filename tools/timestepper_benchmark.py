@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import pathlib
+import tempfile
+import contextlib
+
+import numpy as np
+from mpi4py import MPI
+import dedalus.public as de
+
+from tools.cfl import CFL
+from tools.diagnostics import spectral_tail
+
+import logging
+logger = logging.getLogger(__name__.split('.')[-1])
+
+CANDIDATES = ('RK222', 'RK443', 'SBDF2', 'SBDF3', 'CNAB2')
+# CFL safety of each scheme relative to --safety_factor (RK222 and RK443 as the drivers have always used)
+SAFETY_SCALE = {'RK111': 1, 'RK222': 2, 'RK443': 4,
+                'SBDF1': 1, 'SBDF2': 1, 'SBDF3': 1, 'SBDF4': 1,
+                'CNAB1': 1, 'CNAB2': 1, 'MCNAB2': 1, 'CNLF2': 1}
+
+def problem_config(problem, atmosphere):
+    """Configuration of a problem, for recognizing identical benchmarks: the
+    atmosphere class, resolution, process count, equations, boundary
+    conditions and scalar parameters."""
+    domain = problem.domain
+    parameters = {name: float(np.real(value)) for name, value in problem.parameters.items()
+                  if np.isscalar(value)}
+    return {'atmosphere':  type(atmosphere).__name__,
+            'shape':       [int(n) for n in domain.global_coeff_shape],
+            'processes':   domain.dist.comm_cart.size,
+            'equations':   [eq['raw_equation'] for eq in problem.equations],
+            'bcs':         [bc['raw_equation'] for bc in problem.bcs],
+            'parameters':  parameters}
+
+def config_key(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+def copy_state(solver_from, solver_to):
+    """Copy the state, sim time and iteration between solvers of the same problem."""
+    for field_from, field_to in zip(solver_from.state.fields, solver_to.state.fields):
+        field_to['c'] = field_from['c']
+    solver_to.sim_time = solver_from.sim_time
+    solver_to.iteration = solver_to.initial_iteration = solver_from.iteration
+
+def rebuild(problem, solver, timestepper):
+    """New solver for problem with the named timestepper, starting from solver's state."""
+    new_solver = problem.build_solver(getattr(de.timesteppers, timestepper))
+    copy_state(solver, new_solver)
+    return new_solver
+
+def burst(problem, solver, timestepper, safety, max_dt, velocities, n_steps=50, n_warmup=5, tail_growth=10):
+    """
+    Take n_steps CFL-limited steps with timestepper, starting from solver's
+    state.  velocities is a list of velocity vectors (tuples of components)
+    added to the CFL.
+
+    Returns the mean dt and wall time (max over processes) per step after the
+    first n_warmup steps, or (nan, nan) if the burst was unstable.
+    """
+    bench = rebuild(problem, solver, timestepper)
+    comm = bench.domain.dist.comm_cart
+    bench_CFL = CFL(bench, initial_dt=max_dt, cadence=1, safety=safety,
+                    max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1)
+    for components in velocities:
+        bench_CFL.add_velocities(components)
+    tail = spectral_tail(bench)
+    dts = []
+    for i in range(n_steps):
+        if i == n_warmup:
+            start_time = time.time()
+        dt = bench_CFL.compute_dt()
+        if not np.isfinite(dt):
+            return np.nan, np.nan
+        bench.step(dt)
+        if i >= n_warmup:
+            dts.append(dt)
+    wall_time = comm.allreduce(time.time() - start_time, op=MPI.MAX)
+    end_tail = spectral_tail(bench)
+    if not np.isfinite(end_tail) or (tail > 0 and end_tail > tail_growth*tail):
+        return np.nan, np.nan
+    return np.mean(dts), wall_time/len(dts)
+
+def benchmark(problem, solver, safety_factor, max_dt, velocities, candidates=CANDIDATES,
+              n_steps=50, n_warmup=5, max_doublings=2):
+    """
+    Benchmark candidate timesteppers from solver's current state.
+
+    Each candidate runs a burst at its usual safety (safety_factor times
+    SAFETY_SCALE), and then at doubled safety while it stays stable, to
+    measure the largest stable dt.
+
+    Returns:
+        A dictionary, keyed by timestepper, of dictionaries with the stable
+        dt and safety, the wall time per step and sim time per wall second.
+    """
+    logger.info('benchmarking timesteppers {} (up to {:d} solver builds of {:d} steps each)'.format(
+                ', '.join(candidates), len(candidates)*(max_doublings+1), n_steps))
+    start_time = time.time()
+    n_bursts = 0
+    results = {}
+    for timestepper in candidates:
+        safety = safety_factor*SAFETY_SCALE[timestepper]
+        result = {'safety': np.nan, 'dt': np.nan, 'wall_per_step': np.nan, 'sim_time_per_wall': 0.}
+        for doubling in range(max_doublings+1):
+            dt, wall_per_step = burst(problem, solver, timestepper, safety, max_dt, velocities,
+                                      n_steps=n_steps, n_warmup=n_warmup)
+            n_bursts += 1
+            if not np.isfinite(dt):
+                break
+            result = {'safety': safety, 'dt': dt, 'wall_per_step': wall_per_step,
+                      'sim_time_per_wall': dt/wall_per_step}
+            if dt >= max_dt:
+                # not CFL limited; more safety won't help
+                break
+            safety *= 2
+        logger.info('{:>6s}: stable dt {:.3e} (safety {:.3g}), {:.3e} sec/step, {:.3e} sim time/sec'.format(
+                    timestepper, result['dt'], result['safety'], result['wall_per_step'], result['sim_time_per_wall']))
+        results[timestepper] = result
+    logger.info('timestepper benchmark took {:d} solver builds, {:.1f} sec'.format(n_bursts, time.time()-start_time))
+    return results
+
+@contextlib.contextmanager
+def locked(path):
+    """Hold an exclusive lock on path (through path.lock) for the duration of the block."""
+    with open(str(path)+'.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def read_records(path):
+    path = pathlib.Path(path)
+    if not path.exists():
+        return {}
+    with open(str(path)) as infile:
+        return json.load(infile)
+
+def write_record(path, key, record):
+    """
+    Add record under key to the benchmark records in path.  The records are
+    re-read and replaced atomically under a lock, so that runs sharing the
+    file (e.g. the members of an ensemble) don't lose each other's records or
+    read a half-written file.
+    """
+    path = pathlib.Path(path)
+    with locked(path):
+        records = read_records(path)
+        records[key] = record
+        fd, temp_name = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(records, outfile, indent=1, sort_keys=True)
+            os.replace(temp_name, str(path))
+        except BaseException:
+            os.remove(temp_name)
+            raise
+
+def select(problem, atmosphere, solver, safety_factor, max_dt, velocities, filename='timestepper_benchmarks.json',
+           candidates=CANDIDATES, **kwargs):
+    """
+    Best timestepper for this problem: the one with the most sim time per
+    wall second, from an earlier benchmark of an identical configuration in
+    filename if there is one, otherwise benchmarked now and recorded there.
+    The record file may be shared by concurrent runs; see write_record.
+    """
+    comm = solver.domain.dist.comm_cart
+    config = problem_config(problem, atmosphere)
+    key = config_key(config)
+    record = None
+    if comm.rank == 0:
+        record = read_records(filename).get(key)
+    record = comm.bcast(record, root=0)
+    if record is not None and set(candidates) <= set(record['results']):
+        logger.info('using timestepper benchmark {} from {}'.format(key[:8], filename))
+        results = record['results']
+    else:
+        results = benchmark(problem, solver, safety_factor, max_dt, velocities, candidates=candidates, **kwargs)
+        if comm.rank == 0:
+            write_record(filename, key, {'config': config, 'results': results})
+    results = {timestepper: results[timestepper] for timestepper in candidates}
+    best = max(results, key=lambda timestepper: results[timestepper]['sim_time_per_wall'])
+    if not results[best]['sim_time_per_wall'] > 0:
+        logger.warning('no stable timestepper in benchmark; using RK443')
+        best = 'RK443'
+    logger.info('selected timestepper {}'.format(best))
+    return best